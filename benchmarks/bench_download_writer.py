@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uframe_async.hyrax import write_response_to_file, DOWNLOAD_BUFFER_SIZE
+from uframe_async.session import create_session
+
+def main(args):
+    '''Compare the throughput of the buffered readinto download writer against the
+    original iter_content(chunk_size=1024) + flush-per-chunk loop by downloading a
+    generated file from a local HTTP server.  Prints MB/s for each writer.'''
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src_file = os.path.join(tmp_dir, 'bench.nc')
+        with open(src_file, 'wb') as fid:
+            for i in range(args.size_mb):
+                fid.write(os.urandom(1024 * 1024))
+
+        handler = partial(_QuietHandler, directory=tmp_dir)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = 'http://127.0.0.1:{:d}/bench.nc'.format(server.server_address[1])
+
+        session = create_session()
+        dest_file = os.path.join(tmp_dir, 'dest.nc')
+        writers = [('iter_content_1k_flush', _iter_content_writer),
+            ('readinto_{:d}k'.format(args.buffer_size // 1024), partial(write_response_to_file, buffer_size=args.buffer_size))]
+
+        results = {}
+        for (name, writer) in writers:
+            timings = []
+            for i in range(args.repeat):
+                t0 = time.perf_counter()
+                r = session.get(url, stream=True)
+                with open(dest_file, 'wb') as fid:
+                    writer(r, fid)
+                r.close()
+                timings.append(time.perf_counter() - t0)
+
+            best = min(timings)
+            results[name] = {'seconds' : best, 'MB/s' : args.size_mb / best}
+
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.json:
+        sys.stdout.write('{:s}\n'.format(json.dumps(results)))
+        return 0
+
+    for (name, result) in results.items():
+        sys.stdout.write('{:s}: {:0.1f} MB/s ({:0.3f} s for {:d} MB)\n'.format(name, result['MB/s'], result['seconds'], args.size_mb))
+
+    return 0
+
+def _iter_content_writer(r, fid):
+    '''Download loop used by download_hyrax_nc_from_url before the buffered
+    writer.'''
+
+    for chunk in r.iter_content(chunk_size=1024):
+        if chunk:
+            fid.write(chunk)
+            fid.flush()
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('-s', '--size',
+        dest='size_mb',
+        type=int,
+        default=256,
+        help='Size of the downloaded file in MB (default: 256)')
+    arg_parser.add_argument('-b', '--buffer-size',
+        dest='buffer_size',
+        type=int,
+        default=DOWNLOAD_BUFFER_SIZE,
+        help='readinto buffer size in bytes (default: {:d})'.format(DOWNLOAD_BUFFER_SIZE))
+    arg_parser.add_argument('-r', '--repeat',
+        dest='repeat',
+        type=int,
+        default=3,
+        help='Number of downloads per writer; the fastest is reported (default: 3)')
+    arg_parser.add_argument('-j', '--json',
+        dest='json',
+        action='store_true',
+        help='Print the results as json.')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
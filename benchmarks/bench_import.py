@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from uframe_async.cli import COMMANDS
+
+# Modules timed on their own with python -c 'import MODULE'
+MODULES = ['uframe_async',
+    'uframe_async.poller',
+    'uframe_async.hyrax',
+    'uframe_async.validate',
+    'netCDF4']
+
+def main(args):
+    '''Measure how long the uframe-async subcommands and package modules take to
+    start.  Each command is run as a fresh interpreter with -h, which exits
+    right after the imports and argument parsing, so the wall time is the
+    startup cost paid by every cron invocation.  Prints the median and minimum
+    of --repeat runs, or with --json a machine readable report.  --importtime
+    also lists the slowest imports of each command (python -X importtime).'''
+
+    commands = list(COMMANDS.keys())
+    if args.commands:
+        commands = args.commands.split(',')
+        for command in commands:
+            if command not in COMMANDS:
+                sys.stderr.write('Invalid command: {:s} (choose from {:s})\n'.format(command, ','.join(COMMANDS.keys())))
+                return 1
+
+    report = {'config' : vars(args),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'baseline' : time_command([sys.executable, '-c', 'pass'], args.repeat),
+        'commands' : {},
+        'modules' : {}}
+
+    for command in commands:
+        cmd = [sys.executable, os.path.join(ROOT_DIR, 'uframe-async'), command, '-h']
+        report['commands'][command] = time_command(cmd, args.repeat)
+        if args.importtime:
+            report['commands'][command]['slowest_imports'] = slowest_imports(cmd, args.importtime)
+
+    if not args.no_modules:
+        for module in MODULES:
+            cmd = [sys.executable, '-c', 'import {:s}'.format(module)]
+            report['modules'][module] = time_command(cmd, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(report, fid, indent=2)
+
+    if args.json:
+        sys.stdout.write('{:s}\n'.format(json.dumps(report)))
+        return 0
+
+    sys.stdout.write('python startup: {:0.1f} ms\n'.format(report['baseline']['median_ms']))
+    for (section, results) in (('command', report['commands']), ('module', report['modules'])):
+        for (name, result) in results.items():
+            sys.stdout.write('{:s} {:s}: median={:0.1f} ms, min={:0.1f} ms\n'.format(section, name, result['median_ms'], result['min_ms']))
+            for (module, ms) in result.get('slowest_imports', []):
+                sys.stdout.write('    {:8.1f} ms  {:s}\n'.format(ms, module))
+
+    return 0
+
+def time_command(cmd, repeat):
+    '''Run cmd repeat times and return the median and minimum wall time in
+    milliseconds.'''
+
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - t0) * 1000)
+
+    return {'runs' : repeat,
+        'median_ms' : statistics.median(times),
+        'min_ms' : min(times)}
+
+def slowest_imports(cmd, num_imports):
+    '''Return [(module, cumulative ms), ...] for the num_imports slowest top
+    level imports made by cmd.'''
+
+    r = subprocess.run([cmd[0], '-X', 'importtime'] + cmd[1:], cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+
+    imports = []
+    for line in r.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        match = re.match(r'^import time:\s+\d+\s+\|\s+(\d+)\s+\|\s(\s*)(\S+)$', line)
+        # Only the imports made directly by the script, not their dependencies
+        if match and len(match.group(2)) <= 1:
+            imports.append((match.group(3), int(match.group(1)) / 1000))
+
+    return sorted(imports, key=lambda i: i[1], reverse=True)[:num_imports]
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('-c', '--commands',
+        dest='commands',
+        help='Comma separated commands to time (default: all)')
+    arg_parser.add_argument('-n', '--repeat',
+        dest='repeat',
+        type=int,
+        default=10,
+        help='Number of runs of each command (default: 10)')
+    arg_parser.add_argument('--importtime',
+        dest='importtime',
+        type=int,
+        default=0,
+        help='Also list this many of the slowest imports of each command')
+    arg_parser.add_argument('--no-modules',
+        dest='no_modules',
+        action='store_true',
+        help='Only time the commands, not the individual modules')
+    arg_parser.add_argument('-j', '--json',
+        dest='json',
+        action='store_true',
+        help='Print the report as json.')
+    arg_parser.add_argument('-o', '--output',
+        dest='output',
+        help='Also write the json report to this file')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
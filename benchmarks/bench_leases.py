@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from mock_uframe import MockUFrameServer, add_server_arguments
+from uframe_async.store import RequestStore, STATUS_COMPLETE
+
+def main(args):
+    '''Measure how polling throughput scales with the number of worker processes
+    sharing one request state database under leases.  For each worker count a
+    fresh database of --requests queued requests is polled to completion by that
+    many poll_queued_requests.py --lease processes against a local mock UFrame
+    server.  Reports the wall time, completions/s, status polls and how many
+    requests were completed more than once.  --kill-after SIGKILLs the first
+    worker part way through, so its leases must expire and be reclaimed by the
+    others.  Exits with status 1 if any run leaves requests uncompleted or
+    completes a request twice.'''
+
+    worker_counts = [int(w) for w in args.workers.split(',')]
+
+    server = MockUFrameServer(latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        complete_after=args.complete_after,
+        num_dirs=args.dirs,
+        num_files=args.files,
+        file_size=args.file_size)
+
+    report = {'config' : vars(args),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'results' : {}}
+
+    with server:
+        for num_workers in worker_counts:
+            report['results'][num_workers] = bench_workers(server, num_workers, args)
+
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(report, fid, indent=2)
+
+    failed = [n for (n, result) in report['results'].items() if result['completed'] != result['requests'] or result['duplicates']]
+
+    if args.json:
+        sys.stdout.write('{:s}\n'.format(json.dumps(report)))
+    else:
+        for (num_workers, result) in report['results'].items():
+            sys.stdout.write('workers={:d}: {:s}\n'.format(num_workers, ', '.join(['{:s}={:s}'.format(k, _format_value(v)) for (k, v) in result.items()])))
+
+    if failed:
+        sys.stderr.write('Requests left uncompleted or completed twice with workers={:s}\n'.format(','.join([str(n) for n in failed])))
+        return 1
+
+    return 0
+
+def bench_workers(server, num_workers, args):
+    '''Poll a fresh database of args.requests requests with num_workers
+    processes.'''
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmp_dir, 'requests.db')
+        with RequestStore(db_file) as store:
+            for i in range(args.requests):
+                request_uuid = str(uuid.uuid4())
+                store.add_request({'requestUUID' : request_uuid,
+                    'outputURL' : '{:s}/thredds/catalog/ooi/_nouser/{:s}/catalog.html'.format(server.url, request_uuid),
+                    'request_time' : '2018-01-01T00:00:{:06.3f}Z'.format(i / 1000.0)})
+
+        server.reset_counters()
+
+        out_files = []
+        workers = []
+        t0 = time.perf_counter()
+        for i in range(num_workers):
+            out_files.append(os.path.join(tmp_dir, 'completed_{:d}.csv'.format(i)))
+            cmd = [sys.executable, os.path.join(ROOT_DIR, 'poll_queued_requests.py'),
+                '--db', db_file,
+                '--lease', str(args.lease),
+                '--claim', str(args.claim),
+                '--worker-id', 'worker-{:d}'.format(i),
+                '-c', str(args.concurrency),
+                '--min-interval', '0',
+                '--max-interval', '0',
+                '-o', out_files[-1]]
+            workers.append(subprocess.Popen(cmd, cwd=ROOT_DIR, stderr=subprocess.DEVNULL))
+
+        if args.kill_after is not None:
+            time.sleep(args.kill_after)
+            workers[0].send_signal(signal.SIGKILL)
+
+        for worker in workers:
+            worker.wait()
+        elapsed = time.perf_counter() - t0
+
+        completions = []
+        for out_file in out_files:
+            if not os.path.isfile(out_file):
+                continue
+            with open(out_file, 'r') as fid:
+                rows = list(csv.DictReader(fid))
+            completions.extend([r['requestUUID'] for r in rows])
+
+        with RequestStore(db_file) as store:
+            completed = store.counts().get(STATUS_COMPLETE, 0)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {'requests' : args.requests,
+        'completed' : completed,
+        'duplicates' : len(completions) - len(set(completions)),
+        'polls' : server.hits['status'],
+        'seconds' : elapsed,
+        'completions/s' : completed / elapsed if elapsed else 0}
+
+def _format_value(v):
+
+    if isinstance(v, float):
+        return '{:0.2f}'.format(v)
+
+    return str(v)
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        default='1,2,4',
+        help='Comma separated numbers of worker processes to run (default: 1,2,4)')
+    arg_parser.add_argument('-n', '--requests',
+        dest='requests',
+        type=int,
+        default=500,
+        help='Number of queued requests polled (default: 500)')
+    arg_parser.add_argument('-c', '--concurrency',
+        dest='concurrency',
+        type=int,
+        default=4,
+        help='Maximum number of status checks in flight in each worker (default: 4)')
+    arg_parser.add_argument('--lease',
+        dest='lease',
+        type=float,
+        default=10,
+        help='Lease time in seconds (default: 10)')
+    arg_parser.add_argument('--claim',
+        dest='claim',
+        type=int,
+        default=50,
+        help='Maximum number of requests each worker holds leases on (default: 50)')
+    arg_parser.add_argument('--kill-after',
+        dest='kill_after',
+        type=float,
+        help='SIGKILL the first worker after this many seconds')
+    add_server_arguments(arg_parser)
+    arg_parser.add_argument('-j', '--json',
+        dest='json',
+        action='store_true',
+        help='Print the report as json.')
+    arg_parser.add_argument('-o', '--output',
+        dest='output',
+        help='Also write the json report to this file')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_uframe import MockUFrameServer, MOCK_TELEMETRY, MOCK_STREAM, add_server_arguments
+from uframe_async.hyrax import download_hyrax_nc_files, DOWNLOAD_WORKERS
+from uframe_async.metadata import StreamMetadataCache, set_metadata_cache
+from uframe_async.metrics import Metrics, set_metrics
+from uframe_async.planner import build_async_url
+from uframe_async.poller import RequestPoller
+from uframe_async.retry import RetryPolicy, RETRY_BACKOFF
+from uframe_async.session import create_session
+from uframe_async.submit import send_async_requests
+
+STAGES = ['submit', 'poll', 'download']
+
+def main(args):
+    '''Measure end to end throughput against a local mock UFrame/Hyrax server:
+    requests/s for submitting asynchronous requests, polls/s for checking
+    status.txt and MB/s for download_hyrax_nc_files.  Server latency, error rate
+    and file sizes are configurable so runs are repeatable.  Prints a summary,
+    or with --json a machine readable report.'''
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            sys.stderr.write('Invalid stage: {:s} (choose from {:s})\n'.format(stage, ','.join(STAGES)))
+            return 1
+
+    server = MockUFrameServer(latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        complete_after=args.complete_after,
+        num_dirs=args.dirs,
+        num_files=args.files,
+        file_size=args.file_size)
+
+    report = {'config' : vars(args),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'results' : {}}
+
+    metrics = set_metrics(Metrics())
+
+    with server:
+        session = create_session(pool_maxsize=args.concurrency,
+            retry_policy=RetryPolicy(backoff=args.retry_backoff))
+
+        statuses = []
+        if 'submit' in stages or 'poll' in stages:
+            (result, statuses) = bench_submit(server, session, args)
+            if 'submit' in stages:
+                report['results']['submit'] = result
+
+        if 'poll' in stages:
+            report['results']['poll'] = bench_poll(server, session, statuses, args)
+
+        if 'download' in stages:
+            report['results']['download'] = bench_download(server, session, args)
+
+        session.close()
+
+    report['stages'] = metrics.summary()
+
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(report, fid, indent=2)
+
+    if args.json:
+        sys.stdout.write('{:s}\n'.format(json.dumps(report)))
+        return 0
+
+    for (stage, result) in report['results'].items():
+        sys.stdout.write('{:s}: {:s}\n'.format(stage, ', '.join(['{:s}={:s}'.format(k, _format_value(v)) for (k, v) in result.items()])))
+
+    return 0
+
+def bench_submit(server, session, args):
+    '''Submit args.requests requests spread over args.instruments reference
+    designators.  Returns (result, statuses).'''
+
+    urls = []
+    for i in range(args.requests):
+        instrument = 'CE{:02d}SHSM-RID27-03-CTDBPC000'.format(i % args.instruments)
+        urls.append(build_async_url(server.sensor_inv_url,
+            instrument,
+            MOCK_TELEMETRY,
+            MOCK_STREAM,
+            '2016-01-01T00:00:00.000Z',
+            '2016-02-01T00:{:02d}:{:02d}.000Z'.format((i // 60) % 60, i % 60)))
+
+    # Start from an empty metadata cache so the lookups are measured too
+    set_metadata_cache(StreamMetadataCache(session=session))
+    server.reset_counters()
+
+    statuses = []
+    def collect(url, status):
+        if status and status.get('requestUUID'):
+            statuses.append(status)
+
+    t0 = time.perf_counter()
+    send_async_requests(urls,
+        collect,
+        max_concurrency=args.concurrency,
+        max_per_host=args.concurrency,
+        session=session)
+    elapsed = time.perf_counter() - t0
+
+    result = {'requests' : len(urls),
+        'succeeded' : len(statuses),
+        'seconds' : elapsed,
+        'requests/s' : len(urls) / elapsed,
+        'server_hits' : dict(server.hits),
+        'server_errors' : dict(server.errors)}
+
+    return (result, statuses)
+
+def bench_poll(server, session, statuses, args):
+    '''Poll the status.txt of every submitted request until it completes.'''
+
+    server.reset_counters()
+
+    completed = []
+    poller = RequestPoller(completed.append,
+        concurrency=args.concurrency,
+        min_interval=0,
+        max_interval=0,
+        jitter=0,
+        session=session)
+    for status in statuses:
+        poller.add(dict(status))
+
+    t0 = time.perf_counter()
+    pending = poller.run()
+    elapsed = time.perf_counter() - t0
+    polls = server.hits['status']
+
+    return {'requests' : len(statuses),
+        'completed' : len(completed),
+        'pending' : pending,
+        'polls' : polls,
+        'seconds' : elapsed,
+        'polls/s' : polls / elapsed if elapsed else 0,
+        'server_errors' : dict(server.errors)}
+
+def bench_download(server, session, args):
+    '''Crawl and download every NetCDF file under the mock Hyrax results url.'''
+
+    server.reset_counters()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        t0 = time.perf_counter()
+        nc_files = download_hyrax_nc_files(server.hyrax_url, tmp_dir, False, session=session, max_workers=args.workers) or []
+        elapsed = time.perf_counter() - t0
+        num_bytes = sum([os.path.getsize(nc_file) for nc_file in nc_files])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {'files' : len(nc_files),
+        'expected_files' : args.dirs * args.files,
+        'bytes' : num_bytes,
+        'seconds' : elapsed,
+        'MB/s' : num_bytes / (1024 * 1024) / elapsed if elapsed else 0,
+        'server_hits' : dict(server.hits),
+        'server_errors' : dict(server.errors)}
+
+def _format_value(v):
+
+    if isinstance(v, float):
+        return '{:0.2f}'.format(v)
+
+    return str(v)
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('-s', '--stages',
+        dest='stages',
+        default=','.join(STAGES),
+        help='Comma separated stages to run (default: {:s})'.format(','.join(STAGES)))
+    arg_parser.add_argument('-n', '--requests',
+        dest='requests',
+        type=int,
+        default=500,
+        help='Number of requests submitted and polled (default: 500)')
+    arg_parser.add_argument('-i', '--instruments',
+        dest='instruments',
+        type=int,
+        default=20,
+        help='Number of distinct reference designators the requests are spread over (default: 20)')
+    arg_parser.add_argument('-c', '--concurrency',
+        dest='concurrency',
+        type=int,
+        default=16,
+        help='Maximum number of submissions and status checks in flight (default: 16)')
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help='Number of concurrent directory crawls and downloads (default: {:d})'.format(DOWNLOAD_WORKERS))
+    arg_parser.add_argument('--retry-backoff',
+        dest='retry_backoff',
+        type=float,
+        default=RETRY_BACKOFF,
+        help='Seconds before the first retry of a failed request (default: {:0.1f})'.format(RETRY_BACKOFF))
+    add_server_arguments(arg_parser)
+    arg_parser.add_argument('-j', '--json',
+        dest='json',
+        action='store_true',
+        help='Print the report as json.')
+    arg_parser.add_argument('-o', '--output',
+        dest='output',
+        help='Also write the json report to this file')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
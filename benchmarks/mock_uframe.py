@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Telemetry and stream served for every reference designator
+MOCK_TELEMETRY = 'telemetered'
+MOCK_STREAM = 'ctdbp_cdef_dcl_instrument'
+MOCK_STREAM_BEGIN = '2014-01-01T00:00:00.000Z'
+MOCK_STREAM_END = '2018-01-01T00:00:00.000Z'
+# Hyrax directory the mock request results are listed under
+MOCK_RESULTS_PATH = '/opendap/hyrax/async_results/_nouser/bench/'
+# Last-Modified of every .nc file
+MOCK_LAST_MODIFIED = 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+_METADATA_REGEXP = re.compile(r'^/sensor/inv/\w+/\w+/[\w\-]+/metadata/times$')
+_SUBMIT_REGEXP = re.compile(r'^/sensor/inv/(\w+)/(\w+)/([\w\-]+)/\w+/\w+$')
+_RESULT_DIR_REGEXP = re.compile(r'^(.*/)(\d{10}\-\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12})/(.*)$')
+_RESULTS_ROOT_REGEXP = re.compile(r'^({:s}|/thredds/catalog/ooi/_nouser/[\w\-]+/)contents\.html$'.format(re.escape(MOCK_RESULTS_PATH)))
+
+class MockUFrameServer(object):
+    '''Local stand-in for the UFrame asynchronous request endpoints and the Hyrax
+    results server:
+
+        /sensor/inv/SUBSITE/NODE/SENSOR/metadata/times
+        /sensor/inv/SUBSITE/NODE/SENSOR/TELEMETRY/STREAM?beginDT=...  (submit)
+        .../status.txt  ('complete' after complete_after polls of the url,
+            with an ETag; 304 if If-None-Match matches)
+        ROOT contents.html, num_dirs result directories
+        ROOT DIR/contents.html, num_files .nc files per directory
+        ROOT DIR/FILE.nc  (file_size bytes, with an ETag and Last-Modified;
+            304 if If-None-Match matches)
+
+    where ROOT is MOCK_RESULTS_PATH or the directory of a submitted request's
+    outputURL.  Each ROOT has its own result directory names.
+
+    Every response is delayed by latency seconds (+/- latency_jitter) and a
+    fraction error_rate of requests fail with 503.  hits counts the requests
+    served by endpoint.  The server runs on a background thread between start()
+    and stop().'''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0, complete_after=1, num_dirs=4, num_files=4, file_size=1024 * 1024):
+
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.complete_after = complete_after
+        self.num_dirs = num_dirs
+        self.num_files = num_files
+        self.file_size = file_size
+
+        self.hits = Counter()
+        self.errors = Counter()
+        self.bytes_sent = 0
+        self._status_polls = Counter()
+        self._lock = threading.Lock()
+        # Every .nc file has the same content: a NetCDF classic header followed
+        # by random bytes
+        self._nc_data = b'CDF\x01' + os.urandom(max(0, file_size - 4))
+        self.nc_etag = '"{:08x}"'.format(zlib.crc32(self._nc_data))
+
+        self._server = ThreadingHTTPServer((host, port), _MockHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        '''Base url of the server (ie: http://127.0.0.1:PORT).'''
+
+        (host, port) = self._server.server_address[:2]
+        return 'http://{:s}:{:d}'.format(host, port)
+
+    @property
+    def sensor_inv_url(self):
+        return '{:s}/sensor/inv'.format(self.url)
+
+    @property
+    def hyrax_url(self):
+        '''Hyrax contents.html url listing the mock result directories.'''
+
+        return '{:s}{:s}contents.html'.format(self.url, MOCK_RESULTS_PATH)
+
+    @property
+    def total_bytes(self):
+        '''Total size of the .nc files listed under hyrax_url.'''
+
+        return self.num_dirs * self.num_files * self.file_size
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset_counters(self):
+
+        with self._lock:
+            self.hits.clear()
+            self.errors.clear()
+            self.bytes_sent = 0
+            self._status_polls.clear()
+
+    def respond(self, path, request_headers=None):
+        '''Return (status_code, content_type, body, headers) for path.'''
+
+        (path, sep, query) = path.partition('?')
+
+        if _METADATA_REGEXP.match(path):
+            return self._reply('metadata', 200, 'application/json', json.dumps([{'stream' : MOCK_STREAM,
+                'method' : MOCK_TELEMETRY,
+                'beginTime' : MOCK_STREAM_BEGIN,
+                'endTime' : MOCK_STREAM_END}]))
+
+        if _SUBMIT_REGEXP.match(path) and query:
+            request_uuid = str(uuid.uuid4())
+            output_url = '{:s}/thredds/catalog/ooi/_nouser/{:s}/catalog.html'.format(self.url, request_uuid)
+            return self._reply('submit', 200, 'application/json', json.dumps({'requestUUID' : request_uuid,
+                'outputURL' : output_url}))
+
+        if path.endswith('/status.txt'):
+            with self._lock:
+                self._status_polls[path] += 1
+                polls = self._status_polls[path]
+            status = 'complete' if polls >= self.complete_after else 'pending'
+            etag = '"{:s}"'.format(status)
+            if request_headers and request_headers.get('If-None-Match') == etag:
+                return self._reply('status_not_modified', 304, 'text/plain', b'', {'ETag' : etag})
+            return self._reply('status', 200, 'text/plain', status, {'ETag' : etag})
+
+        match = _RESULTS_ROOT_REGEXP.match(path)
+        if match:
+            links = ['<a href="{:s}/contents.html">{:s}</a>'.format(d, d) for d in self._result_dirs(match.group(1))]
+            return self._reply('listing', 200, 'text/html', _html_page(links))
+
+        match = _RESULT_DIR_REGEXP.match(path)
+        if match and match.group(2) in self._result_dirs(match.group(1)):
+            nc_files = self._nc_files(match.group(1), match.group(2))
+            if match.group(3) == 'contents.html':
+                rows = ['<tr><td><a href="{0:s}">{0:s}</a></td><td>2018-01-01T00:00:00</td><td>{1:d}</td></tr>'.format(f, self.file_size) for f in nc_files]
+                return self._reply('listing', 200, 'text/html', _html_page(['<table>'] + rows + ['</table>']))
+            if match.group(3) in nc_files:
+                nc_headers = {'ETag' : self.nc_etag, 'Last-Modified' : MOCK_LAST_MODIFIED}
+                if request_headers and request_headers.get('If-None-Match') == self.nc_etag:
+                    return self._reply('not_modified', 304, 'application/x-netcdf', b'', nc_headers)
+                return self._reply('download', 200, 'application/x-netcdf', self._nc_data, nc_headers)
+
+        return self._reply('other', 404, 'text/plain', 'Not Found')
+
+    def _result_dirs(self, root):
+
+        root_id = zlib.crc32(root.encode('utf-8'))
+        return ['20180101{:02d}-{:08x}-0000-0000-0000-{:012d}'.format(i % 24, root_id, i) for i in range(self.num_dirs)]
+
+    def _nc_files(self, root, result_dir):
+
+        i = self._result_dirs(root).index(result_dir)
+        return ['deployment{:04d}_CE02SHSM-RID27-03-CTDBPC000-{:s}-{:s}_{:d}.nc'.format(i, MOCK_TELEMETRY, MOCK_STREAM, j) for j in range(self.num_files)]
+
+    def _reply(self, endpoint, status_code, content_type, body, headers=None):
+
+        if self.latency or self.latency_jitter:
+            time.sleep(max(0, self.latency + random.uniform(-self.latency_jitter, self.latency_jitter)))
+
+        with self._lock:
+            self.hits[endpoint] += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors[endpoint] += 1
+                status_code = 503
+                content_type = 'text/plain'
+                body = 'Service Unavailable'
+                headers = None
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        return (status_code, content_type, body, headers or {})
+
+class _MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are sent in separate writes: with Nagle on, each
+    # keep-alive response would wait ~40 ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._send(True)
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def _send(self, send_body):
+
+        mock = self.server.mock
+        (status_code, content_type, body, headers) = mock.respond(self.path, self.headers)
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        with mock._lock:
+            mock.bytes_sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+def _html_page(lines):
+    return '<html><body>\n{:s}\n</body></html>\n'.format('\n'.join(lines))
+
+def main(args):
+    '''Run a local mock UFrame asynchronous request and Hyrax results server
+    until interrupted.'''
+
+    server = MockUFrameServer(host=args.host,
+        port=args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        complete_after=args.complete_after,
+        num_dirs=args.dirs,
+        num_files=args.files,
+        file_size=args.file_size)
+    server.start()
+
+    sys.stdout.write('Sensor inventory: {:s}\n'.format(server.sensor_inv_url))
+    sys.stdout.write('Hyrax results: {:s}\n'.format(server.hyrax_url))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+    return 0
+
+def add_server_arguments(arg_parser):
+    '''Add the mock server options to arg_parser.'''
+
+    arg_parser.add_argument('--latency',
+        dest='latency',
+        type=float,
+        default=0.0,
+        help='Seconds each response is delayed (default: 0)')
+    arg_parser.add_argument('--latency-jitter',
+        dest='latency_jitter',
+        type=float,
+        default=0.0,
+        help='Random +/- variation of the response delay in seconds (default: 0)')
+    arg_parser.add_argument('--error-rate',
+        dest='error_rate',
+        type=float,
+        default=0.0,
+        help='Fraction of requests answered with 503 (default: 0)')
+    arg_parser.add_argument('--complete-after',
+        dest='complete_after',
+        type=int,
+        default=2,
+        help='Number of status.txt polls before a request reports complete (default: 2)')
+    arg_parser.add_argument('--dirs',
+        dest='dirs',
+        type=int,
+        default=4,
+        help='Number of Hyrax result directories (default: 4)')
+    arg_parser.add_argument('--files',
+        dest='files',
+        type=int,
+        default=4,
+        help='Number of NetCDF files in each result directory (default: 4)')
+    arg_parser.add_argument('--file-size',
+        dest='file_size',
+        type=int,
+        default=8 * 1024 * 1024,
+        help='Size of each NetCDF file in bytes (default: 8388608)')
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('--host',
+        dest='host',
+        default='127.0.0.1',
+        help='Address to listen on (default: 127.0.0.1)')
+    arg_parser.add_argument('-p', '--port',
+        dest='port',
+        type=int,
+        default=12576,
+        help='Port to listen on (default: 12576)')
+    add_server_arguments(arg_parser)
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
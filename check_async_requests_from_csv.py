@@ -1,76 +1,83 @@
 #!/usr/bin/env python
 
-import csv
 import argparse
+import sys
 from uframe_async import *
+from uframe_async.poller import status_url_from_output_url
+from uframe_async.store import RequestStore
+from uframe_async.requestfile import open_request_reader, request_writer_from_args, add_request_file_arguments
+from uframe_async.status import add_status_arguments, status_checker_from_args
+from uframe_async.metrics import add_metrics_arguments, configure_metrics_from_args
     
 def main(args):
     '''Check the availability of one or more asynchronous UFrame requests, contained in 
     a file.  Print the request responses to STDOUT'''
     
-    responses = []
+    checker = status_checker_from_args(args)
     
-    fid = open(args.request_csv, 'r')
-    csv_reader = csv.reader(fid)
-    cols = csv_reader.next()
-    col_range = range(0,len(cols))
-    if 'completion_time' not in cols:
-        cols.append('completion_time')
+    store = None
+    if args.db:
+        store = RequestStore(args.db)
         
-    for r in csv_reader:
+    # Each request is read, checked and written before the next is read, so
+    # memory use does not grow with the file and every request already checked
+    # is in the output if the run is interrupted
+    reader = open_request_reader(args.request_csv, fmt=args.format)
+    cols = reader.cols
+    if cols is not None and 'completion_time' not in cols:
+        cols = cols + ['completion_time']
+    writer = request_writer_from_args(args, fmt=reader.fmt, cols=cols)
+    
+    writer.write_rows(check_requests(reader, checker, store=store, tds=args.tds))
         
-        if r[0].startswith('#'):
-            continue
-            
-        request_meta = {cols[i]:r[i] for i in col_range}
+    reader.close()
+    writer.close()
+    checker.save()
+    if store:
+        store.close()
+        
+    return 0
+    
+def check_requests(rows, checker, store=None, tds=False):
+    '''Check the status of each request dictionary in rows that has not yet
+    completed and yield it with its completion_time filled in, if it has
+    completed.  Requests with no outputURL are reported and dropped.'''
+    
+    for request_meta in rows:
         
-        if not request_meta['outputURL']:
-            sys.stderr.write('No destination url specified: {:s}\n'.format(request_meta['request_url']))
+        if not request_meta.get('outputURL'):
+            sys.stderr.write('No destination url specified: {:s}\n'.format(request_meta.get('request_url') or ''))
             sys.stderr.flush()
             continue
             
-        if 'completion_time' not in request_meta.keys():
-            request_meta['completion_time'] = None
-        
-        if not request_meta['completion_time']:
-            request_url = request_meta['outputURL']
-            
-            # Currently, we can only validate agains hyrax, not tds.
-            if not args.tds:
-                request_url = re.sub('8090/thredds/catalog/ooi/_nouser',
-                    '8080/opendap/hyrax/async_results/_nouser',
-                    request_meta['outputURL'])
-                
-            # Replace the url endpoint to point to the status.txt
-            request_url = re.sub('catalog.html$', 'status.txt', request_url)
-            completion_time = check_async_request_availability(request_url)
+        if not request_meta.get('completion_time'):
+            request_url = status_url_from_output_url(request_meta['outputURL'], tds=tds)
+            completion_time = checker.check(request_url)
             request_meta['completion_time'] = completion_time   
+            if completion_time and store:
+                store.mark_complete(request_meta.get('requestUUID'), completion_time)
         else:
-            sys.stderr.write('Request already completed: {:s}\n'.format(request_meta['outputURL']))
-
-        # Add the request to the output array
-        responses.append(request_meta)
-        
-    fid.close()
-        
-    csv_writer = csv.writer(sys.stdout)
-    csv_writer.writerow(cols)
-    for x in responses:
-        x_keys = x.keys()
-        csv_writer.writerow([x[k] for k in cols if k in x_keys])
-        
-    return 0
+            checker.log('Request already completed: {:s}\n'.format(request_meta['outputURL']))
+            
+        yield request_meta
         
 if __name__ == '__main__':
 
     arg_parser = argparse.ArgumentParser(description=main.__doc__)
     arg_parser.add_argument('request_csv',
-            help='CSV filename containing queued UFrame request.')
+            help='CSV or JSONL filename containing queued UFrame request (- for STDIN).')
     arg_parser.add_argument('--tds',
         help='Validate agains THREDDS, not hyrax (default)\n',
         dest='tds',
         action='store_true')
+    add_request_file_arguments(arg_parser)
+    add_status_arguments(arg_parser)
+    arg_parser.add_argument('--db',
+        dest='db',
+        help='SQLite request state database to record completions in')
+    add_metrics_arguments(arg_parser)
 
     parsed_args = arg_parser.parse_args()
+    configure_metrics_from_args(parsed_args)
 
     sys.exit(main(parsed_args))
@@ -59,8 +59,8 @@ do
 	# File containing the requests and associated metadata.  Create this file
 	# using send_async_requests_from_urlcsv.py > queued_requests.csv
 	REQUEST_CSV=$f;
-	# Create a temporary file to write the results of the checks to
-	REQUEST_QUEUE_TMP_CSV=$(mktemp);
+	# Lock file shared by every copy of this script working on $REQUEST_CSV
+	REQUEST_LOCK=${REQUEST_CSV}.lock;
 
 #    echo "REQUEST CSV: $REQUEST_CSV";
 #    echo "TEMP REQUEST CSV: $REQUEST_QUEUE_TMP_CSV";
@@ -72,11 +72,33 @@ do
 	    return 1;
 	fi
 	
+	# Skip the file if another copy of this script is checking it, rather than
+	# checking it twice and racing on the mv.  The lock is held on fd 9 until
+	# the file has been replaced
+	exec 9>>$REQUEST_LOCK;
+	if ! flock -n 9
+	then
+	    echo "Request queue CSV locked by another process: $REQUEST_CSV" >&2;
+	    exec 9>&-;
+	    continue;
+	fi
+	
+	# Create a temporary file, next to $REQUEST_CSV so the mv is atomic, to
+	# write the results of the checks to
+	REQUEST_QUEUE_TMP_CSV=$(mktemp ${REQUEST_CSV}.XXXXXX);
+	
 	# Check the request status
 	check_async_requests_from_csv.py $REQUEST_CSV > $REQUEST_QUEUE_TMP_CSV;
 	
+	# mktemp creates the file readable by its owner only, so give it the mode
+	# of $REQUEST_CSV before it replaces it
+	chmod --reference=$REQUEST_CSV $REQUEST_QUEUE_TMP_CSV;
+	
 	# Move $REQUEST_QUEUE_TMP_CSV to $REQUEST_CSV
 	mv $REQUEST_QUEUE_TMP_CSV $REQUEST_CSV;
+	
+	# Release the lock
+	exec 9>&-;
 
 done
 	
@@ -2,28 +2,45 @@
 
 import requests
 import json
-import re
 import os
 import sys
 import argparse
 #import shutil
 #from netCDF4 import Dataset
 from uframe_async.hyrax import *
+from uframe_async.pipeline import hyrax_url_from_output_url
+from uframe_async.session import configure_session
+from uframe_async.ratelimit import add_rate_limit_arguments, rate_limit_from_args
+from uframe_async.cache import DownloadCache
+from uframe_async.metrics import add_metrics_arguments, configure_metrics_from_args
 
 def main(args):
     '''Download all NetCDF files located under the specified Hyrax url.  Individual
     NetCDF files correspond to the UFrame bin sizes.  The list of downloaded files
     is printed to STDOUT.'''
     
-    hyrax_url = re.sub('8090/thredds/catalog/ooi/_nouser', '8080/opendap/hyrax/async_results/_nouser', args.hyrax_url)
-    
-    nc_files = download_hyrax_nc_files(hyrax_url, args.destdir, args.verbose)
-    if not nc_files:
-        sys.stderr.write('No Hyrax NetCDF files found at: {:s}\n'.format(args.hyrax_url))
-        return
+    if args.rate:
+        configure_session(rate_limit=rate_limit_from_args(args, args.workers))
+        
+    hyrax_url = hyrax_url_from_output_url(args.hyrax_url)
     
-    if args.timestamp_files:
-        nc_files = timestamp_nc_files(nc_files)
+    cache = None
+    if args.cache:
+        cache = DownloadCache(args.cache)
+        
+    # The cache is closed however the download ends, so its database is not
+    # left open
+    try:
+        nc_files = download_hyrax_nc_files(hyrax_url, args.destdir, args.verbose, max_workers=args.workers, cache=cache)
+        if not nc_files:
+            sys.stderr.write('No Hyrax NetCDF files found at: {:s}\n'.format(args.hyrax_url))
+            return
+        
+        if args.timestamp_files:
+            nc_files = timestamp_nc_files(nc_files, max_workers=None, cache=cache)
+    finally:
+        if cache:
+            cache.close()
         
     if args.json:
         sys.stdout.write('{:s}'.format(json.dumps(nc_files)))
@@ -47,6 +64,12 @@ if __name__ == '__main__':
         dest='json',
         action='store_true',
         help='Dump the downloaded NetCDF files names as a json array.')
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help='Number of concurrent directory crawls and downloads (default: {:d})'.format(DOWNLOAD_WORKERS))
+    add_rate_limit_arguments(arg_parser)
     arg_parser.add_argument('-v', '--verbose',
         dest='verbose',
         action='store_true',
@@ -55,7 +78,12 @@ if __name__ == '__main__':
         dest='timestamp_files',
         action='store_true',
         help='Rename each downloaded file to include the start and end timestamps.')
+    arg_parser.add_argument('--cache',
+        dest='cache',
+        help='SQLite download cache file.  Files that have not changed since they were last downloaded are not transferred again')
+    add_metrics_arguments(arg_parser)
         
     parsed_args = arg_parser.parse_args()
+    configure_metrics_from_args(parsed_args)
     
     main(parsed_args)
\ No newline at end of file
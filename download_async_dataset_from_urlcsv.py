@@ -1,67 +1,169 @@
 #!/usr/bin/env python
 
-import csv
 import argparse
 import sys
 import os
+import time
 from uframe_async import *
 from uframe_async.hyrax import *
+from uframe_async.poller import status_url_from_output_url
+from uframe_async.pipeline import hyrax_url_from_output_url
+from uframe_async.session import configure_session
+from uframe_async.ratelimit import add_rate_limit_arguments, rate_limit_from_args
+from uframe_async.store import RequestStore, LeaseRenewer, add_lease_arguments, STATUS_COMPLETE, DEFAULT_MAX_FAILURES
+from uframe_async.cache import DownloadCache
+from uframe_async.requestfile import open_request_reader, add_request_file_arguments
+from uframe_async.status import add_status_arguments, status_checker_from_args
+from uframe_async.metrics import add_metrics_arguments, configure_metrics_from_args
     
 def main(args):
     '''Check the availability of one or more asynchronous UFrame requests, contained in 
-    a file.  Print the request responses to STDOUT'''
+    a file.  Print the request responses to STDOUT
     
-    responses = []
+    With --db and --lease, the completed requests in the database are also
+    downloaded, --claim at a time under leases, so several copies of this
+    script on the same host can share the downloads.  A worker only exits once
+    no completed requests are left, waiting out the leases of other workers.
+    Requests whose downloads fail are released straight away and retried by
+    whichever worker claims them, until they have failed --max-failures
+    times.  Leases only work between
+    processes on one host: the database must be on a local disk, so requests
+    are split between hosts by giving each its own database.'''
     
-    fid = open(args.request_csv, 'r')
-    csv_reader = csv.reader(fid)
-    cols = csv_reader.next()
-    col_range = range(0,len(cols))
-    if 'completion_time' not in cols:
-        cols.append('completion_time')
+    if args.rate:
+        configure_session(rate_limit=rate_limit_from_args(args, args.workers))
         
-    for r in csv_reader:
+    store = None
+    renewer = None
+    if args.db:
+        store = RequestStore(args.db)
+        if args.lease:
+            reclaimed = store.reclaim_expired()
+            if reclaimed:
+                sys.stderr.write('Reclaimed {:d} expired leases\n'.format(reclaimed))
+            renewer = LeaseRenewer(store, args.worker_id, args.lease).start()
+            
+    if not args.request_csv and not renewer:
+        sys.stderr.write('No request CSV specified\n')
+        return 1
         
-        request_meta = {cols[i]:r[i] for i in col_range}
+    cache = None
+    if args.cache:
+        cache = DownloadCache(args.cache)
         
-        if 'completion_time' not in request_meta.keys():
-            request_meta['completion_time'] = None
+    checker = status_checker_from_args(args)
+    
+    # Requests are timestamped on this thread once the scheduler has returned,
+    # with the header reads on a pool of processes, rather than one at a time
+    # in the download threads
+    finished = []
+    def request_done(request_meta, nc_files, failed):
+        finished.append((request_meta, nc_files, failed))
         
-        if not request_meta['completion_time']:
-            completion_time = check_async_request_availability(request_meta)
-            request_meta['completion_time'] = completion_time   
-            hyrax_url = re.sub('8090/thredds/catalog/ooi/_nouser',
-                '8080/opendap/hyrax/async_results/_nouser',
-                request_meta['outputURL'])
-            if completion_time:
-                if args.debug:
-                    sys.stdout.write('Request completed but skipping NetCDF downloads: {:s}\n'.format(hyrax_url))
-                    sys.stdout.flush()
-                    continue
-                
-                sys.stdout.write('Request completed, downloading NetCDF files: {:s}\n'.format(hyrax_url))    
-                nc_files = download_hyrax_nc_files(hyrax_url, args.destdir, True)
-                if not nc_files:
-                    continue
-                    
-                nc_files = timestamp_nc_files(nc_files)
+    def timestamp_finished():
+        while finished:
+            (request_meta, nc_files, failed) = finished.pop(0)
+            if nc_files:
+                nc_files = timestamp_nc_files(nc_files, max_workers=None, cache=cache)
                 for nc_file in nc_files:
                     sys.stdout.write('Downloaded: {:s}\n'.format(nc_file))
-                    sys.stdout.flush()
-        else:
-            sys.stderr.write('Request already completed: {:s}\n'.format(request_meta['outputURL']))
-            sys.stderr.flush()
+                sys.stdout.flush()
+            # Neither is recorded if the lease expired and another worker
+            # reclaimed the request
+            if store and not failed:
+                store.mark_downloaded(request_meta.get('requestUUID'), worker_id=args.worker_id if renewer else None)
+            elif renewer:
+                request_failed(request_meta)
+            if renewer:
+                renewer.discard(request_meta.get('requestUUID'))
+                
+    def request_failed(request_meta):
+        failures = store.record_failure(request_meta['requestUUID'], worker_id=args.worker_id)
+        if failures >= args.max_failures:
+            sys.stderr.write('Giving up on request after {:d} failed attempts: {:s}\n'.format(failures, request_meta['requestUUID']))
+                
+    # The files of all completed requests are queued and downloaded together,
+    # in --order, once every request has been checked
+    scheduler = DownloadScheduler(args.destdir,
+        policy=args.order,
+        max_workers=args.workers,
+        bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None,
+        min_free_space=int(args.min_free * 1024 ** 3),
+        verbose=args.verbose,
+        cache=cache,
+        on_request_done=request_done)
+        
+    if args.request_csv:
+        # Requests are read and checked one at a time; the completed ones are
+        # queued for the scheduler
+        reader = open_request_reader(args.request_csv, fmt=args.format)
+        for request_meta in reader:
+            
+            if not request_meta.get('outputURL'):
+                sys.stderr.write('No destination url specified: {:s}\n'.format(request_meta.get('request_url') or ''))
+                continue
+                
+            if not request_meta.get('completion_time'):
+                completion_time = checker.check(status_url_from_output_url(request_meta['outputURL']))
+                request_meta['completion_time'] = completion_time   
+                if completion_time and store:
+                    store.mark_complete(request_meta.get('requestUUID'), completion_time)
+                hyrax_url = hyrax_url_from_output_url(request_meta['outputURL'])
+                if completion_time:
+                    if args.debug:
+                        sys.stdout.write('Request completed but skipping NetCDF downloads: {:s}\n'.format(hyrax_url))
+                        sys.stdout.flush()
+                        continue
+                    
+                    sys.stdout.write('Request completed, queueing NetCDF files: {:s}\n'.format(hyrax_url))    
+                    scheduler.add_request(hyrax_url, request_meta)
+            else:
+                checker.log('Request already completed: {:s}\n'.format(request_meta['outputURL']))
+                
+        reader.close()
+    checker.save()
+    
+    if scheduler.pending():
+        scheduler.run()
+        timestamp_finished()
+        
+    # Download the completed requests claimed from the database, a batch at a
+    # time, until there are none left.  Requests leased by other workers are
+    # waited for: if a worker died they are claimed here once its leases expire
+    while renewer:
+        rows = store.claim(args.worker_id, status=STATUS_COMPLETE, lease_time=args.lease, limit=args.claim_size, max_failures=args.max_failures)
+        if not rows:
+            expiry = store.next_lease_expiry(STATUS_COMPLETE, worker_id=args.worker_id)
+            if expiry is None:
+                break
+            time.sleep(max(1, expiry - time.time()))
+            continue
+        renewer.add([r['requestUUID'] for r in rows])
+        for request_meta in rows:
+            hyrax_url = hyrax_url_from_output_url(request_meta.get('outputURL') or '')
+            if args.debug:
+                sys.stdout.write('Request completed but skipping NetCDF downloads: {:s}\n'.format(hyrax_url))
+                sys.stdout.flush()
+                continue
+            sys.stdout.write('Request claimed, queueing NetCDF files: {:s}\n'.format(hyrax_url))
+            if not scheduler.add_request(hyrax_url, request_meta):
+                request_failed(request_meta)
+                renewer.discard(request_meta['requestUUID'])
+        if scheduler.pending():
+            scheduler.run()
+            timestamp_finished()
             
-        # Add the request to the output array
-        responses.append(request_meta)
+    if renewer:
+        renewer.stop()
         
-    fid.close()
+    stats = scheduler.stats
+    if stats['files_downloaded'] or stats['files_failed']:
+        sys.stderr.write('Downloaded {:d} files ({:d} bytes), {:d} failed\n'.format(stats['files_downloaded'], stats['bytes'], stats['files_failed']))
         
-    #csv_writer = csv.writer(sys.stdout)
-    #csv_writer.writerow(cols)
-    #for x in responses:
-    #    x_keys = x.keys()
-    #    csv_writer.writerow([x[k] for k in cols if k in x_keys])
+    if store:
+        store.close()
+    if cache:
+        cache.close()
         
     return 0
         
@@ -69,11 +171,32 @@ if __name__ == '__main__':
 
     arg_parser = argparse.ArgumentParser(description=main.__doc__)
     arg_parser.add_argument('request_csv',
-        help='CSV filename containing queued UFrame request.')
+        nargs='?',
+        help='CSV or JSONL filename containing queued UFrame request (- for STDIN).  Optional with --db and --lease')
     arg_parser.add_argument('-d', '--destdir',
         dest='destdir',
         default=os.getcwd(),
         help='Destination directory for writing NetCDF files if they are available')
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help='Number of concurrent directory crawls and downloads (default: {:d})'.format(DOWNLOAD_WORKERS))
+    arg_parser.add_argument('--order',
+        dest='order',
+        choices=SCHEDULE_POLICIES,
+        default=SCHEDULE_SMALLEST,
+        help='Download order: smallest file first, files of the oldest request first or a fair share of the bytes for each instrument (default: {:s})'.format(SCHEDULE_SMALLEST))
+    arg_parser.add_argument('--bandwidth',
+        dest='bandwidth',
+        type=float,
+        help='Cap the combined download rate at BANDWIDTH MB/s')
+    arg_parser.add_argument('--min-free',
+        dest='min_free',
+        type=float,
+        default=DOWNLOAD_MIN_FREE_SPACE / 1024 ** 3,
+        help='Pause downloads while fewer than MIN_FREE GB would be left free in destdir (default: {:0.0f})'.format(DOWNLOAD_MIN_FREE_SPACE / 1024 ** 3))
+    add_rate_limit_arguments(arg_parser)
     arg_parser.add_argument('-v', '--verbose',
         dest='verbose',
         action='store_true',
@@ -82,7 +205,23 @@ if __name__ == '__main__':
         dest='debug',
         action='store_true',
         help='Print the outputUrls for completed requests, but do not download the NetCDF files.')
+    arg_parser.add_argument('--db',
+        dest='db',
+        help='SQLite request state database to record completions and downloads in')
+    add_request_file_arguments(arg_parser, output=False)
+    add_lease_arguments(arg_parser)
+    arg_parser.add_argument('--max-failures',
+        dest='max_failures',
+        type=int,
+        default=DEFAULT_MAX_FAILURES,
+        help='With --lease, stop claiming a request once its downloads have failed this many times (default: {:d})'.format(DEFAULT_MAX_FAILURES))
+    add_status_arguments(arg_parser)
+    arg_parser.add_argument('--cache',
+        dest='cache',
+        help='SQLite download cache file.  Files that have not changed since they were last downloaded are not transferred again')
+    add_metrics_arguments(arg_parser)
 
     parsed_args = arg_parser.parse_args()
+    configure_metrics_from_args(parsed_args)
 
     sys.exit(main(parsed_args))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import csv
+import argparse
+import sys
+from uframe_async.planner import plan_async_requests, PLAN_COLUMNS
+
+def main(args):
+    '''Split each asynchronous UFrame request url in a file into smaller time
+    window requests, sized using the stream time bounds from the metadata.  The
+    chunked request urls are printed to STDOUT, ready for
+    send_async_requests_from_urlcsv.py.'''
+    
+    if not args.num_chunks and not args.chunk_days:
+        sys.stderr.write('Specify the number of chunks (-n) or the chunk size in days (--days)\n')
+        return 1
+        
+    groups_writer = None
+    if args.groups:
+        groups_fid = open(args.groups, 'w')
+        groups_writer = csv.writer(groups_fid)
+        groups_writer.writerow(PLAN_COLUMNS)
+        
+    fid = open(args.request_csv, 'r')
+    for url in fid:
+        
+        url = url.strip()
+        if not url or url.startswith('#'):
+            continue
+            
+        planned = plan_async_requests(url,
+            num_chunks=args.num_chunks,
+            chunk_days=args.chunk_days,
+            clip=not args.no_clip)
+        for chunk in planned:
+            sys.stdout.write('{:s}\n'.format(chunk.request_url))
+            if groups_writer:
+                groups_writer.writerow(chunk)
+        
+    fid.close()
+    if args.groups:
+        groups_fid.close()
+        
+    return 0
+        
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('request_csv',
+        help='Filename containing asynchronous UFrame request urls')
+    arg_parser.add_argument('-n', '--chunks',
+        dest='num_chunks',
+        type=int,
+        help='Split each request into this many equal time windows')
+    arg_parser.add_argument('--days',
+        dest='chunk_days',
+        type=float,
+        help='Split each request into time windows of at most this many days')
+    arg_parser.add_argument('-g', '--groups',
+        dest='groups',
+        help='Write the chunk groups (which chunks belong to which original request) to this CSV file')
+    arg_parser.add_argument('--no-clip',
+        dest='no_clip',
+        action='store_true',
+        help='Do not clip the request window to the stream time bounds')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import csv
+import argparse
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from uframe_async.poller import RequestPoller, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+from uframe_async.session import configure_session
+from uframe_async.ratelimit import add_rate_limit_arguments, rate_limit_from_args
+from uframe_async.store import RequestStore, LeaseRenewer, add_lease_arguments, STORE_COLUMNS, STATUS_QUEUED, STATUS_COMPLETE
+from uframe_async.status import add_status_arguments, status_checker_from_args
+from uframe_async.metrics import add_metrics_arguments, configure_metrics_from_args
+
+def main(args):
+    '''Load the queued asynchronous UFrame requests from one or more request CSV
+    files and/or a request state database and poll them concurrently until all
+    have completed.  Completed requests are written to STDOUT (or --output) and
+    the database the moment they are seen and each request CSV is rewritten with
+    the completion times on exit.
+
+    With --lease, several copies of this script on the same host can poll the
+    same database: each claims at most --claim pending requests at a time under
+    leases it renews while polling, and claims more as its requests complete.
+    A worker only exits once no pending requests are left, waiting out the
+    leases of other workers, so the requests of a worker that dies are polled
+    by the others once its leases expire.  Leases only work between processes
+    on one host: the database must be on a local disk, so requests are split
+    between hosts by giving each its own database.'''
+    
+    if args.output:
+        out_fid = open(args.output, 'a')
+    else:
+        out_fid = sys.stdout
+    csv_writer = csv.writer(out_fid)
+    
+    # Load all requests
+    request_files = []
+    out_cols = None
+    for request_csv in args.request_csv:
+        
+        if not os.path.isfile(request_csv):
+            sys.stderr.write('Request queue CSV not found: {:s}\n'.format(request_csv))
+            continue
+            
+        with open(request_csv, 'r') as fid:
+            csv_reader = csv.reader(fid)
+            cols = next(csv_reader)
+            if 'completion_time' not in cols:
+                cols.append('completion_time')
+            rows = []
+            for r in csv_reader:
+                if not r or r[0].startswith('#'):
+                    continue
+                request_meta = dict(zip(cols, r))
+                request_meta.setdefault('completion_time', '')
+                rows.append(request_meta)
+                
+        request_files.append((request_csv, cols, rows))
+        if out_cols is None:
+            out_cols = cols
+    
+    # Pending requests from the state database
+    store = None
+    renewer = None
+    db_rows = []
+    if args.db:
+        store = RequestStore(args.db)
+        if args.lease:
+            reclaimed = store.reclaim_expired()
+            if reclaimed:
+                sys.stderr.write('Reclaimed {:d} expired leases\n'.format(reclaimed))
+            renewer = LeaseRenewer(store, args.worker_id, args.lease).start()
+            db_rows = claim_requests(store, renewer, args)
+        else:
+            db_rows = store.pending()
+        if out_cols is None:
+            out_cols = STORE_COLUMNS
+            
+    # With leases, requests held by other workers are waited for
+    if not request_files and not db_rows and not (renewer and store.next_lease_expiry(STATUS_QUEUED, worker_id=args.worker_id)):
+        sys.stderr.write('No queued requests found\n')
+        if renewer:
+            renewer.stop()
+        return 1
+        
+    if not args.output or out_fid.tell() == 0:
+        csv_writer.writerow(out_cols)
+        out_fid.flush()
+        
+    def record_completion(request_meta):
+        if renewer:
+            renewer.discard(request_meta.get('requestUUID'))
+            # Another worker reclaimed the request after this worker's lease
+            # expired, and records the completion itself
+            if not store.mark_complete(request_meta.get('requestUUID'), request_meta['completion_time'], worker_id=args.worker_id):
+                return
+        elif store:
+            store.mark_complete(request_meta.get('requestUUID'), request_meta['completion_time'])
+        if 'status' in request_meta:
+            request_meta['status'] = STATUS_COMPLETE
+        csv_writer.writerow([request_meta.get(k) for k in out_cols])
+        out_fid.flush()
+        
+    if args.rate:
+        configure_session(pool_maxsize=args.concurrency,
+            rate_limit=rate_limit_from_args(args, args.concurrency))
+        
+    poller = RequestPoller(record_completion,
+        concurrency=args.concurrency,
+        min_interval=args.min_interval,
+        max_interval=args.max_interval,
+        tds=args.tds,
+        checker=status_checker_from_args(args))
+    
+    for (request_csv, cols, rows) in request_files:
+        for request_meta in rows:
+            if request_meta['completion_time']:
+                continue
+            poller.add(request_meta)
+    # Requests in both a CSV and the database are only polled once
+    queued = set([r.get('requestUUID') for (request_csv, cols, rows) in request_files for r in rows])
+    for request_meta in db_rows:
+        if request_meta['requestUUID'] not in queued:
+            poller.add(request_meta)
+    
+    sys.stderr.write('Polling {:d} queued requests\n'.format(poller.pending()))
+    sys.stderr.flush()
+    
+    # Keep claiming requests as the claimed ones complete, until none are left.
+    # Requests leased by other workers are waited for: if a worker died they are
+    # claimed here once its leases expire
+    stop_claiming = threading.Event()
+    def claim_more():
+        interval = max(1, min(args.min_interval, args.lease / 3.0))
+        wait = interval
+        while not stop_claiming.wait(wait):
+            wait = interval
+            for request_meta in claim_requests(store, renewer, args):
+                poller.add(request_meta)
+            if renewer.held():
+                continue
+            expiry = store.next_lease_expiry(STATUS_QUEUED, worker_id=args.worker_id)
+            if expiry is None:
+                poller.close()
+                return
+            wait = max(interval, expiry - time.time())
+    if renewer:
+        threading.Thread(target=claim_more, name='claim', daemon=True).start()
+        
+    # Finish the in-flight checks and save state on SIGTERM/SIGINT
+    def shutdown(signum, frame):
+        poller.stop()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    
+    pending = poller.run(wait_for_close=renewer is not None)
+    stop_claiming.set()
+    poller.checker.save()
+    # Requests still pending go back to the other workers
+    if renewer:
+        renewer.stop()
+    
+    # Write the completion times back to the request files
+    for (request_csv, cols, rows) in request_files:
+        write_request_csv(request_csv, cols, rows)
+    
+    if args.output:
+        out_fid.close()
+    if store:
+        store.close()
+        
+    sys.stderr.write('{:d} requests still pending ({:d} GET, {:d} HEAD status checks, {:d} unchanged)\n'.format(pending,
+        poller.checker.stats['get'],
+        poller.checker.stats['head'],
+        poller.checker.stats['unchanged']))
+    
+    return 0
+    
+def claim_requests(store, renewer, args):
+    '''Claim pending requests from store until renewer holds args.claim_size
+    leases.  Returns the claimed rows.'''
+    
+    limit = args.claim_size - renewer.held()
+    if limit <= 0:
+        return []
+        
+    rows = store.claim(args.worker_id, status=STATUS_QUEUED, lease_time=args.lease, limit=limit)
+    renewer.add([r['requestUUID'] for r in rows])
+    
+    return rows
+    
+def write_request_csv(request_csv, cols, rows):
+    '''Atomically replace request_csv with rows.'''
+    
+    (fd, tmp_csv) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(request_csv)), suffix='.csv')
+    with os.fdopen(fd, 'w') as fid:
+        csv_writer = csv.writer(fid)
+        csv_writer.writerow(cols)
+        for request_meta in rows:
+            csv_writer.writerow([request_meta.get(k) for k in cols])
+    os.replace(tmp_csv, request_csv)
+        
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('request_csv',
+        nargs='*',
+        help='CSV filenames containing queued UFrame requests.')
+    arg_parser.add_argument('--db',
+        dest='db',
+        help='SQLite request state database to load pending requests from and record completions in')
+    arg_parser.add_argument('-o', '--output',
+        dest='output',
+        help='Append completed requests to this CSV file instead of STDOUT')
+    arg_parser.add_argument('-c', '--concurrency',
+        dest='concurrency',
+        type=int,
+        default=16,
+        help='Maximum number of status checks in flight at once (default: 16)')
+    add_rate_limit_arguments(arg_parser)
+    arg_parser.add_argument('--min-interval',
+        dest='min_interval',
+        type=float,
+        default=POLL_MIN_INTERVAL,
+        help='Seconds before a pending request is first re-checked (default: {:d})'.format(POLL_MIN_INTERVAL))
+    arg_parser.add_argument('--max-interval',
+        dest='max_interval',
+        type=float,
+        default=POLL_MAX_INTERVAL,
+        help='Maximum seconds between checks of a pending request (default: {:d})'.format(POLL_MAX_INTERVAL))
+    arg_parser.add_argument('--tds',
+        help='Validate agains THREDDS, not hyrax (default)\n',
+        dest='tds',
+        action='store_true')
+    add_lease_arguments(arg_parser)
+    add_status_arguments(arg_parser)
+    add_metrics_arguments(arg_parser)
+
+    parsed_args = arg_parser.parse_args()
+    configure_metrics_from_args(parsed_args)
+
+    sys.exit(main(parsed_args))
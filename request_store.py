@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+from uframe_async.store import RequestStore
+
+def main(args):
+    '''Import request CSV files into, or export requests from, a SQLite request
+    state database, print the number of requests in each state and leased by
+    each worker, or clear the expired leases of workers that died.'''
+    
+    store = RequestStore(args.db)
+    
+    if args.command == 'import':
+        for request_csv in args.request_csv:
+            count = store.import_csv(request_csv)
+            sys.stderr.write('Imported {:d} requests: {:s}\n'.format(count, request_csv))
+    elif args.command == 'export':
+        store.export_csv(sys.stdout, status=args.status)
+    elif args.command == 'reclaim':
+        sys.stderr.write('Reclaimed {:d} expired leases\n'.format(store.reclaim_expired()))
+    else:
+        for (status, count) in sorted(store.counts().items()):
+            sys.stdout.write('{:s}: {:d}\n'.format(status, count))
+        for (worker_id, count) in sorted(store.leases().items()):
+            sys.stdout.write('leased by {:s}: {:d}\n'.format(worker_id, count))
+        
+    store.close()
+    
+    return 0
+        
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('db',
+        help='SQLite request state database')
+    arg_parser.add_argument('command',
+        choices=['import', 'export', 'counts', 'reclaim'],
+        help='import request CSVs, export requests as CSV to STDOUT, print the number of requests in each state or clear expired leases')
+    arg_parser.add_argument('request_csv',
+        nargs='*',
+        help='Request CSV or JSONL (.jsonl) files to import')
+    arg_parser.add_argument('-s', '--status',
+        dest='status',
+        choices=['queued', 'complete', 'downloaded'],
+        help='Only export requests in this state')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
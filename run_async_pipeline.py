@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+import csv
+import argparse
+import os
+import signal
+import sys
+import threading
+from uframe_async.urls import ASYNC_REQUEST_COLUMNS
+from uframe_async.hyrax import DOWNLOAD_WORKERS
+from uframe_async.pipeline import AsyncRequestPipeline, PIPELINE_QUEUE_SIZE
+from uframe_async.poller import POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+from uframe_async.session import configure_session
+from uframe_async.ratelimit import add_rate_limit_arguments, rate_limit_from_args
+from uframe_async.store import RequestStore
+from uframe_async.cache import DownloadCache
+from uframe_async.metrics import add_metrics_arguments, configure_metrics_from_args
+
+def main(args):
+    '''Submit the asynchronous UFrame request urls contained in a file, poll each
+    request as soon as it is submitted, download its NetCDF files as soon as it
+    completes and rename each file with its time coverage as it lands.  The
+    submitted requests are appended to --requests as they are sent and the
+    final NetCDF files are printed to STDOUT as each request finishes.'''
+
+    configure_session(pool_maxsize=args.per_host, rate_limit=rate_limit_from_args(args, args.per_host))
+
+    if not os.path.isdir(args.destdir):
+        sys.stderr.write('Invalid destination: {:s}\n'.format(args.destdir))
+        return 1
+
+    store = None
+    queued = []
+    completed = []
+    if args.db:
+        store = RequestStore(args.db)
+        # Pick up where a previous run left off
+        if args.resume:
+            queued = store.pending()
+            completed = store.completed()
+
+    cache = None
+    if args.cache:
+        cache = DownloadCache(args.cache)
+
+    # Record every submitted request as soon as it is sent
+    requests_fid = None
+    requests_writer = None
+    if args.requests:
+        new_file = not os.path.isfile(args.requests) or not os.path.getsize(args.requests)
+        requests_fid = open(args.requests, 'a')
+        requests_writer = csv.writer(requests_fid)
+        if new_file:
+            requests_writer.writerow(ASYNC_REQUEST_COLUMNS)
+            requests_fid.flush()
+
+    # The callbacks are called from several stage threads
+    write_lock = threading.Lock()
+    def write_request(status):
+        if requests_writer:
+            with write_lock:
+                requests_writer.writerow([status.get(k) for k in ASYNC_REQUEST_COLUMNS])
+                requests_fid.flush()
+
+    def write_files(request_meta, nc_files, failed):
+        with write_lock:
+            if failed:
+                sys.stderr.write('{:d} NetCDF files failed to download: {:s}\n'.format(failed, request_meta.get('outputURL') or ''))
+            for nc_file in nc_files:
+                sys.stdout.write('{:s}\n'.format(nc_file))
+            sys.stdout.flush()
+
+    pipeline = AsyncRequestPipeline(args.destdir,
+        submit_workers=args.concurrency,
+        poll_concurrency=args.poll_concurrency,
+        download_workers=args.workers,
+        timestamp=args.timestamp_files,
+        queue_size=args.queue_size,
+        min_interval=args.min_interval,
+        max_interval=args.max_interval,
+        store=store,
+        cache=cache,
+        on_submitted=write_request,
+        on_downloaded=write_files)
+
+    # Stop submitting and polling on SIGTERM/SIGINT but finish the downloads
+    # already started
+    def shutdown(signum, frame):
+        pipeline.stop()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    urls = []
+    if args.request_csv:
+        fid = open(args.request_csv, 'r')
+        urls = (url.strip() for url in fid if url.strip() and not url.startswith('#'))
+
+    stats = pipeline.run(urls, queued=queued, completed=completed)
+
+    if args.request_csv:
+        fid.close()
+    if requests_fid:
+        requests_fid.close()
+    if store:
+        store.close()
+    if cache:
+        cache.close()
+
+    sys.stderr.write('Submitted {:d} ({:d} failed), completed {:d}, downloaded {:d} files ({:d} failed) for {:d} requests, {:d} requests still pending\n'.format(stats['submitted'],
+        stats['submit_failed'],
+        stats['completed'],
+        stats['files_downloaded'],
+        stats['files_failed'],
+        stats['requests_downloaded'],
+        pipeline.pending()))
+
+    if stats['submit_failed'] or stats['files_failed']:
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('request_csv',
+        nargs='?',
+        help='Filename containing valid asynchronous UFrame request urls')
+    arg_parser.add_argument('-d', '--destdir',
+        dest='destdir',
+        default=os.getcwd(),
+        help='Destination directory for writing NetCDF files')
+    arg_parser.add_argument('-r', '--requests',
+        dest='requests',
+        help='Append the submitted requests to this request CSV file')
+    arg_parser.add_argument('--db',
+        dest='db',
+        help='SQLite request state database to record the requests in')
+    arg_parser.add_argument('--resume',
+        dest='resume',
+        action='store_true',
+        help='Also poll and download the pending and completed requests in --db')
+    arg_parser.add_argument('--cache',
+        dest='cache',
+        help='SQLite download cache file.  Files that have not changed since they were last downloaded are not transferred again')
+    arg_parser.add_argument('-c', '--concurrency',
+        dest='concurrency',
+        type=int,
+        default=4,
+        help='Number of requests submitted at once (default: 4)')
+    arg_parser.add_argument('--poll-concurrency',
+        dest='poll_concurrency',
+        type=int,
+        default=16,
+        help='Maximum number of status checks in flight at once (default: 16)')
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help='Number of concurrent directory crawls and downloads (default: {:d})'.format(DOWNLOAD_WORKERS))
+    arg_parser.add_argument('--per-host',
+        dest='per_host',
+        type=int,
+        default=16,
+        help='Number of keep-alive connections kept open to each host (default: 16)')
+    add_rate_limit_arguments(arg_parser)
+    arg_parser.add_argument('--queue-size',
+        dest='queue_size',
+        type=int,
+        default=PIPELINE_QUEUE_SIZE,
+        help='Maximum number of items waiting between two stages (default: {:d})'.format(PIPELINE_QUEUE_SIZE))
+    arg_parser.add_argument('--min-interval',
+        dest='min_interval',
+        type=float,
+        default=POLL_MIN_INTERVAL,
+        help='Seconds before a pending request is first re-checked (default: {:d})'.format(POLL_MIN_INTERVAL))
+    arg_parser.add_argument('--max-interval',
+        dest='max_interval',
+        type=float,
+        default=POLL_MAX_INTERVAL,
+        help='Maximum seconds between checks of a pending request (default: {:d})'.format(POLL_MAX_INTERVAL))
+    arg_parser.add_argument('--no-timestamp',
+        dest='timestamp_files',
+        action='store_false',
+        help='Do not rename the downloaded files with their start and end timestamps')
+    add_metrics_arguments(arg_parser)
+
+    parsed_args = arg_parser.parse_args()
+    configure_metrics_from_args(parsed_args)
+
+    sys.exit(main(parsed_args))
@@ -1,54 +1,72 @@
 #!/usr/bin/env python
 
-import csv
 import argparse
 import sys
 from uframe_async import *
+from uframe_async.submit import send_async_requests
+from uframe_async.session import configure_session
+from uframe_async.ratelimit import add_rate_limit_arguments, rate_limit_from_args
+from uframe_async.metadata import StreamMetadataCache, set_metadata_cache
+from uframe_async.store import RequestStore
+from uframe_async.dedup import coalesce_async_requests, iter_request_history
+from uframe_async.requestfile import request_writer_from_args, add_request_file_arguments
+from uframe_async.metrics import add_metrics_arguments, configure_metrics_from_args
     
 def main(args):
     '''Validate and send one or more asynchronous UFrame requests, contained in 
     a file.  Print the request responses to STDOUT'''
     
-    csv_writer = csv.writer(sys.stdout)
-    cols = ['instrument',
-        'beginDT',
-        'endDT',
-        'status_code',
-        'reason',
-        'stream_beginDT',
-        'stream_endDT',
-        'valid',
-        'valid_time_interval',
-        'request_time',
-        'requestUUID',
-        'outputURL',
-        'request_url']
-    csv_writer.writerow(cols)
+    # Each response is written (and flushed) as soon as its request completes
+    writer = request_writer_from_args(args, cols=ASYNC_REQUEST_COLUMNS)
         
-    fid = open(args.request_csv, 'r')
-    success = True
-    for url in fid:
+    # Keep enough keep-alive connections open to serve every in-flight request
+    # to a host
+    configure_session(pool_maxsize=args.per_host, rate_limit=rate_limit_from_args(args, args.per_host))
+    
+    # Persist stream metadata between runs if a cache file was specified
+    if args.metadata_cache:
+        set_metadata_cache(StreamMetadataCache(cache_file=args.metadata_cache))
         
-        if url.startswith('#'):
-            continue
+    store = None
+    if args.db:
+        store = RequestStore(args.db)
         
-        #valid = validate_async_request(url.strip())
-        #if not valid:
-        #    continue
-          
-        #sys.stderr.write('Sending request: {:s}\n'.format(url.strip()))  
-        status = send_async_request(url.strip())
+    fid = open(args.request_csv, 'r')
+    urls = (url.strip() for url in fid if url.strip() and not url.startswith('#'))
+    
+    # Drop duplicate, overlapping and already requested time windows
+    if args.dedup:
+        (urls, stats) = coalesce_async_requests(urls,
+            history=iter_request_history(args.history, store),
+            merge_adjacent=args.merge_adjacent)
+        sys.stderr.write('Deduplicated requests: {:d} in, {:d} duplicate, {:d} merged, {:d} already requested, {:d} out\n'.format(stats['input'],
+            stats['duplicate'],
+            stats['merged'],
+            stats['covered'],
+            stats['output']))
+    
+    # Write each response row as soon as its request completes
+    num_failed = [0]
+    def write_status(url, status):
         if not status:
-#            sys.stderr.write('Request failed: {:s}\n'.format(url.strip()))
-            success = False
-            continue
+            num_failed[0] += 1
+            return
             
-        status_keys = status.keys()
-        csv_writer.writerow([status[k] for k in cols if k in status_keys])
-            #responses.append(status)
+        writer.write(status)
+        if store:
+            store.add_request(status)
+        
+    send_async_requests(urls,
+        write_status,
+        max_concurrency=args.concurrency,
+        max_per_host=args.per_host)
 
     fid.close()
+    writer.close()
+    if store:
+        store.close()
     
+    success = not num_failed[0]
     if not success:
         sys.stderr.write('One or more request failed\n')
         
@@ -59,7 +77,39 @@ if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description=main.__doc__)
     arg_parser.add_argument('request_csv',
             help='Filename containing valid asynchronous UFrame request urls')
+    arg_parser.add_argument('-c', '--concurrency',
+        dest='concurrency',
+        type=int,
+        default=16,
+        help='Maximum number of requests in flight at once (default: 16)')
+    arg_parser.add_argument('--per-host',
+        dest='per_host',
+        type=int,
+        default=8,
+        help='Maximum number of requests in flight to a single host (default: 8)')
+    add_rate_limit_arguments(arg_parser)
+    arg_parser.add_argument('--metadata-cache',
+        dest='metadata_cache',
+        help='JSON file used to cache stream metadata/times lookups between runs')
+    arg_parser.add_argument('--dedup',
+        dest='dedup',
+        action='store_true',
+        help='Drop duplicate requests, merge overlapping time windows and skip windows already requested (see --history and --db)')
+    arg_parser.add_argument('--history',
+        dest='history',
+        action='append',
+        help='Request CSV or JSONL (.jsonl) file of previously sent requests used by --dedup.  May be repeated')
+    arg_parser.add_argument('--merge-adjacent',
+        dest='merge_adjacent',
+        action='store_true',
+        help='With --dedup, also merge touching windows, not only overlapping ones.  Do not use on chunks from plan_async_requests.py, which would be merged back together')
+    arg_parser.add_argument('--db',
+        dest='db',
+        help='SQLite request state database to add the sent requests to')
+    add_request_file_arguments(arg_parser, input_format=False)
+    add_metrics_arguments(arg_parser)
 
     parsed_args = arg_parser.parse_args()
+    configure_metrics_from_args(parsed_args)
 
     success = main(parsed_args)
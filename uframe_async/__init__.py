@@ -5,14 +5,18 @@ import json
 import sys
 import re
 import datetime
-from dateutil import parser
+from uframe_async.session import get_session
+from uframe_async.metadata import get_metadata_cache
+from uframe_async.metrics import get_metrics, STAGE_VALIDATE, STAGE_SUBMIT, STAGE_POLL
+from uframe_async.urls import ASYNC_REQUEST_COLUMNS, DT_REGEXP, AsyncRequestUrl, parse_async_url
 
-_PARAMETER_REGEXPS = {'beginDT' : r'^\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,}Z$',
-    'endDT' : r'^\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,}Z$',
-    'format' : r'^application/(\w{1,})$',
-    'limit' : r'^(\-\d{1,}|\d{1,})$',
-    'execDPA' : r'^true|false$',
-    'include_provenance' : r'^true|false$'}
+_PARAMETER_REGEXPS = {'beginDT' : DT_REGEXP,
+    'endDT' : DT_REGEXP,
+    'format' : re.compile(r'^application/(\w{1,})$'),
+    'limit' : re.compile(r'^(\-\d{1,}|\d{1,})$'),
+    'execDPA' : re.compile(r'^true|false$'),
+    'include_provenance' : re.compile(r'^true|false$'),
+    'user' : re.compile(r'^.+$')}
 _REQUIRED_PARAMETERS = ['beginDT',
     'endDT',
     'format',
@@ -59,68 +63,79 @@ _REQUIRED_PARAMETERS = ['beginDT',
 #        
 #    return 0
     
-def send_async_request(url, timeout=120, time_check=True):
+def send_async_request(url, timeout=120, time_check=True, session=None):
     '''Send an asynchronous UFrame data request and return the response and the
-    request metadata from the url.
+    request metadata from the url.  url may be a url string or an AsyncRequestUrl.
+    Requests are sent through session, which defaults to the package-level shared
+    session.
     '''
     
     status = {}
     
+    if session is None:
+        session = get_session()
+        
+    # Parse the url once and share the record with the validation step.  url may
+    # also be an already parsed AsyncRequestUrl
+    request = url
+    if not isinstance(request, AsyncRequestUrl):
+        request = parse_async_url(url)
+    else:
+        url = request.url
+    if not request:
+        sys.stderr.write('Invalid instrument specified: {:s}\n'.format(url))
+        return status
+        
     # Make sure the url is formatted properly and check that the beginDT and 
     # endDT fall within the stream bounds contained in the metadata
-    valid = validate_async_request(url, timeout=timeout, time_check=time_check)
+    with get_metrics().timer(STAGE_VALIDATE, url) as t:
+        valid = validate_async_request(request, timeout=timeout, time_check=time_check, session=session)
+        if not valid['valid']:
+            t.error()
     if not valid['valid']:
         sys.stderr.write('Invalid asynchronous data request: {:s} (Reason: {:s})\n'.format(url, valid['reason']))
         return status
     
-    # Parse url for status fields
-    match = re.compile(r'beginDT=(\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,}Z)').search(url)
-    if not match:
+    if not request.beginDT or not DT_REGEXP.match(request.beginDT):
         sys.stderr.write('Invalid beginDT specified: {:s}\n'.format(url))
         return status
-    beginDT = match.groups()[0]
-    
-    match = re.compile(r'endDT=(\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,}Z)').search(url)
-    if not match:
+        
+    if not request.endDT or not DT_REGEXP.match(request.endDT):
         sys.stderr.write('Invalid endDT specified: {:s}\n'.format(url))
         return status
-    endDT = match.groups()[0]
-    
-    # Instrument
-    INSTRUMENT_REGEXP = re.compile('/(\w{8,}/\w{5,}/\d{2}\-\w{9,})/')
-    match = INSTRUMENT_REGEXP.search(url)
-    if not match:
-        sys.stderr.write('Invalid instrument specified: {:s}\n'.format(url))
-        return status
-    instrument = '-'.join(match.groups()[0].split('/'))
     
     # Fill in the return value
     status['request_url'] = url
-    status['instrument'] = instrument
-    status['beginDT'] = beginDT
-    status['endDT'] = endDT
+    status['instrument'] = request.instrument
+    status['beginDT'] = request.beginDT
+    status['endDT'] = request.endDT
     status['status_code'] = None
     status['reason'] = None
     status['requestUUID'] = None
     status['outputURL'] = None
     status['request_time'] = None
-    status['user'] = '_nouser'
-    
-    # See if a user parameter was specified in the request url and pull out the
-    # user name if specified
-    match = re.search('&user=(.*)', url)
-    if match:
-        status['user'] = match.groups()[0]
+    status['user'] = request.user or '_nouser'
     
     # Add validation parameters
     for (k,v) in valid.items():
         status[k] = valid[k]
     
     # Time of request
-    rt = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%sZ')
+    rt = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
     
-    # Send request
-    r = requests.get(url, timeout=timeout)
+    # Send request.  Submissions are only retried by the session if they cannot
+    # have reached the server, so a failure here may still have queued the
+    # request
+    with get_metrics().timer(STAGE_SUBMIT, url) as t:
+        try:
+            r = session.get(url, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            t.error()
+            sys.stderr.write('Request Failed (Reason={:s}), not resent as it may have been queued: {:s}\n'.format(str(e), url))
+            return {}
+        t.add_bytes(len(r.content))
+        if r.status_code != 200:
+            t.error()
     
     # Store the server status code of the request
     status['status_code'] = r.status_code
@@ -143,10 +158,12 @@ def send_async_request(url, timeout=120, time_check=True):
 
     return status
     
-def validate_async_request(url, timeout=120, time_check=True):
-    '''Validates url to ensure that the request is formatted properly.  Set
+def validate_async_request(url, timeout=120, time_check=True, session=None, metadata_cache=None):
+    '''Validates url (a url string or an AsyncRequestUrl) to ensure that the
+    request is formatted properly.  Set
     time_check=True to check that the beginDT and endDT are within the specified
-    stream time bounds.'''
+    stream time bounds.  Stream metadata is looked up through metadata_cache, which
+    defaults to the package-level cache.'''
     
     valid = {'valid' : False,
         'valid_time_interval' : None,
@@ -154,86 +171,54 @@ def validate_async_request(url, timeout=120, time_check=True):
         'stream_endDT' : None,
         'reason' : ''}
 
-    # 2016-07-11: skip validation since we know we're creating good requests
-    valid['valid'] = True
-    return valid
-        
-    # Split the url and the parameters
-    url_tokens = url.split('?')
-    if len(url_tokens) != 2:
+    # dateutil is only needed here, so it is not imported by the scripts that
+    # just check request status
+    from dateutil import parser
+    
+    # Parse the url and the parameters.  url may also be an already parsed
+    # AsyncRequestUrl
+    request = url
+    if not isinstance(request, AsyncRequestUrl):
+        request = parse_async_url(url)
+    else:
+        url = request.url
+    if not request or not request.parameters:
         valid['reason'] = 'Request contains no parameters: {:s}\n'.format(url)
         return valid
         
-    parameters = url_tokens[1].split('&')
-    valid_parameters = _PARAMETER_REGEXPS.keys()
-    # Make sure all specified parameters are in valid_parameters and that the
+    # Make sure all specified parameters are in _PARAMETER_REGEXPS and that the
     # url has the _REQUIRED_PARAMETERS
-    required_count = 0
-    for parameter in parameters:
-        try:
-            (p,v) = parameter.split('=')
-        except ValueError as e:
-            valid['reason'] = 'Malformed parameter: {:s}\n'.format(parameter)
-            return valid
-        
-        if p not in valid_parameters:
-            valid['reason'] = 'Invalid parameter: {:s}\n'.format(p)
-            return valid    
-        
-        if p in _REQUIRED_PARAMETERS:
-            required_count += 1
-            
-        match = re.compile(_PARAMETER_REGEXPS[p]).search(v)
-        if not match:
-            valid['reason'] = 'Invalid parameter/value: {:s}\n'.format(parameter)
-            return valid
-            
-        # Special cases for checking values
-        # limit
-        if p == 'limit':
-            try:
-                val = int(v)
-                if val >= 0:
-                    valid['reason'] = 'URL is requesting a synchronouse request: {:s}={:s}\n'.format(p,v)
-                    return valid
-                    
-            except ValueError as e:
-                valid['reason'] = 'Invalid {:s} value: {:s}\n'.format(p, v)
-                return valid
+    reason = check_async_request_parameters(request, url)
+    if reason:
+        valid['reason'] = reason
+        return valid
         
-        # Convert beginDT to datetime
-        if p == 'beginDT':
-            beginDT = v
-            dt0 = parser.parse(beginDT)
+    # Convert beginDT and endDT to datetime
+    beginDT = request.beginDT
+    dt0 = parser.parse(beginDT)
+    endDT = request.endDT
+    dt1 = parser.parse(endDT)
         
-        # Convert endDT to datetime
-        if p == 'endDT':
-            endDT = v
-            dt1 = parser.parse(endDT)
-    
     # Make sure beginDT occurs before endDT    
     if dt0 > dt1:
         valid['reason'] = 'Invalid time bounds (beginDT={:s} > endDT={:s}): {:s}\n'.format(beginDT, endDT, url)
         return valid        
     
     # Fetch metadata to get stream beginTime and endTime    
-    METADATA_REGEXP = re.compile(r'^(http://.*/sensor/inv/\w{8}/\w{5}/\d{2}\-\w{9}/)(\w+)/(\w+)')
-    match = METADATA_REGEXP.search(url) 
-    if not match:
+    if not request.metadata_prefix:
         valid['reason'] = 'Time check ERROR: invalid url {:s}\n'.format(url)
         return valid
         
-    metadata_url = '{:s}metadata/times'.format(match.groups()[0])
-    telemetry = match.groups()[1]
-    stream = match.groups()[2]
-    # Send the metadata request
-    r = requests.get(metadata_url, timeout=timeout)
-    if r.status_code != 200:
-        valid['reason'] = 'Failed to fetch metadata: {:s}\n'.format(metadata_url)
-        sys.stderr.flush()
+    metadata_prefix = request.metadata_prefix
+    stream = request.stream
+    # Fetch the metadata, reusing the cached copy for this reference designator
+    # if there is one
+    if metadata_cache is None:
+        metadata_cache = get_metadata_cache()
+    metadata = metadata_cache.get(metadata_prefix, session=session, timeout=timeout)
+    if metadata is None:
+        valid['reason'] = 'Failed to fetch metadata: {:s}metadata/times\n'.format(metadata_prefix)
         return valid
-        
-    metadata = r.json()
      
     # Request is valid if we've made it here
     valid['valid'] = True
@@ -257,12 +242,12 @@ def validate_async_request(url, timeout=120, time_check=True):
         
         # dt0 must be >= stream_beginDT and dt1 must be <= stream_endDT
         if dt0 < stream_beginDT:
-            sys.stderr.write('Time check ERROR: Specified request beginDT is earlier than metadata beginDT ({:s} < {:s})'.format(beginDT, metadata[s_index]['beginTime']))
+            sys.stderr.write('Time check ERROR: Specified request beginDT is earlier than metadata beginDT ({:s} < {:s})\n'.format(beginDT, metadata[s_index]['beginTime']))
             valid['valid_time_interval'] = False
             return valid
             
         if dt1 > stream_endDT:
-            sys.stderr.write('Time check ERROR: Specified request endDT is later than metadata endDT ({:s} > {:s})'.format(endDT, metadata[s_index]['endTime']))
+            sys.stderr.write('Time check ERROR: Specified request endDT is later than metadata endDT ({:s} > {:s})\n'.format(endDT, metadata[s_index]['endTime']))
             valid['valid_time_interval'] = False
             return valid
         
@@ -271,10 +256,54 @@ def validate_async_request(url, timeout=120, time_check=True):
         
     return valid
     
-def check_async_request_availability(request_url):
+def check_async_request_parameters(request, url=None):
+    '''Check the query parameters of the parsed AsyncRequestUrl request: every
+    parameter must be one of _PARAMETER_REGEXPS with a matching value, limit must
+    request an asynchronous request and all of the _REQUIRED_PARAMETERS must be
+    present.  Returns the reason the parameters are invalid or an empty string if
+    they are valid.'''
+    
+    if url is None:
+        url = request.url
+        
+    required_count = 0
+    for (p,v) in request.parameters:
+        if v is None:
+            return 'Malformed parameter: {:s}\n'.format(p)
+        
+        if p not in _PARAMETER_REGEXPS:
+            return 'Invalid parameter: {:s}\n'.format(p)
+        
+        if p in _REQUIRED_PARAMETERS:
+            required_count += 1
+            
+        match = _PARAMETER_REGEXPS[p].search(v)
+        if not match:
+            return 'Invalid parameter/value: {:s}={:s}\n'.format(p, v)
+            
+        # Special cases for checking values
+        # limit
+        if p == 'limit':
+            try:
+                val = int(v)
+                if val >= 0:
+                    return 'URL is requesting a synchronouse request: {:s}={:s}\n'.format(p,v)
+                    
+            except ValueError as e:
+                return 'Invalid {:s} value: {:s}\n'.format(p, v)
+            
+    if required_count != len(_REQUIRED_PARAMETERS):
+        return 'Request is missing one or more required parameters ({:s}): {:s}\n'.format(', '.join(_REQUIRED_PARAMETERS), url)
+        
+    return ''
+    
+def check_async_request_availability(request_url, session=None):
     
     time_available = None
     
+    if session is None:
+        session = get_session()
+    
     #opendap_url_key = 'outputURL'
     #if opendap_url_key not in async_request.keys():
     #    sys.stderr.write('async_request is missing the outputURL\n')
@@ -284,7 +313,17 @@ def check_async_request_availability(request_url):
     #return time_available
     
     # Attempt to fetch the opendap url top-level directory page
-    r = requests.get(request_url)
+    with get_metrics().timer(STAGE_POLL, request_url) as t:
+        try:
+            r = session.get(request_url)
+        except requests.exceptions.RequestException as e:
+            t.error()
+            sys.stderr.write('Status check failed: {:s} ({:s})\n'.format(request_url, str(e)))
+            sys.stderr.flush()
+            return time_available
+        t.add_bytes(len(r.content))
+        if r.status_code != 200:
+            t.error()
     if r.status_code != 200:
         sys.stderr.write('Invalid request: {:s} ({:s})\n'.format(request_url, r.reason))
         sys.stderr.flush()
@@ -294,6 +333,6 @@ def check_async_request_availability(request_url):
         sys.stderr.flush()
         return time_available
         
-    time_available = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%sZ')
+    time_available = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
     
     return time_available
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import datetime
+
+# Hash computed while each file is streamed to disk
+CACHE_HASH = 'sha256'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    url TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    download_time TEXT
+);
+CREATE INDEX IF NOT EXISTS files_path_idx ON files (path);
+CREATE INDEX IF NOT EXISTS files_sha256_idx ON files (sha256, size);
+'''
+
+class DownloadCache(object):
+    '''SQLite record of every downloaded file keyed by url: the local path, size,
+    sha256 of the content and the ETag and Last-Modified validators the server
+    sent with it.  Re-downloads of a url whose local copy is still in place are
+    sent as conditional GETs, and a file whose content is identical to one
+    already on disk is replaced by a hardlink to it.  Every update is its own
+    transaction, so several scripts can share one cache file.'''
+
+    def __init__(self, db_file, timeout=60):
+
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, timeout=timeout, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while another process is writing
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, url):
+        '''Return the cache entry for url or None.'''
+
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM files WHERE url=?', (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(row)
+
+    def lookup(self, url):
+        '''Return the cache entry for url if its local file still exists with the
+        recorded size, otherwise None.'''
+
+        entry = self.get(url)
+        if entry is None or not _has_size(entry['path'], entry['size']):
+            return None
+
+        return entry
+
+    def conditional_headers(self, entry):
+        '''Return the If-None-Match/If-Modified-Since request headers for the
+        cache entry.'''
+
+        headers = {}
+        if not entry:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def record(self, url, path, size, sha256, etag=None, last_modified=None):
+        '''Record that url was downloaded to path.'''
+
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO files (url, path, size, sha256, etag, last_modified, download_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, path, size, sha256, etag, last_modified, _utc_now()))
+
+    def move(self, old_path, new_path):
+        '''Record that the file at old_path was renamed to new_path.'''
+
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE files SET path=? WHERE path=?', (new_path, old_path))
+
+    def forget(self, url):
+
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM files WHERE url=?', (url,))
+
+    def find_duplicate(self, sha256, size, exclude=None):
+        '''Return the path of an existing local file with the same sha256 and
+        size, other than exclude, or None.'''
+
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM files WHERE sha256=? AND size=?', (sha256, size)).fetchall()
+
+        for row in rows:
+            if row['path'] != exclude and _has_size(row['path'], size):
+                return row['path']
+
+        return None
+
+    def link_duplicate(self, path, sha256, size):
+        '''Replace path with a hardlink to an identical file already in the cache.
+        Returns the file path was linked to or None if there is none (or it is on
+        another filesystem).'''
+
+        dup_path = self.find_duplicate(sha256, size, exclude=path)
+        if not dup_path:
+            return None
+
+        if not link_file(dup_path, path):
+            return None
+
+        return dup_path
+
+def link_file(src, dest):
+    '''Atomically replace dest with a hardlink to src.  Returns False if the link
+    could not be made (ie: src and dest are on different filesystems).'''
+
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return True
+
+    tmp_dest = '{:s}.link'.format(dest)
+    try:
+        if os.path.lexists(tmp_dest):
+            os.remove(tmp_dest)
+        os.link(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+    except (IOError, OSError) as e:
+        sys.stderr.write('Failed to link {:s} to {:s}: {:s}\n'.format(dest, src, str(e)))
+        if os.path.lexists(tmp_dest):
+            os.remove(tmp_dest)
+        return False
+
+    return True
+
+def new_hasher():
+    return hashlib.new(CACHE_HASH)
+
+def hash_file(filename, hasher=None, buffer_size=1024 * 1024):
+    '''Update hasher (default: a new CACHE_HASH hasher) with the contents of
+    filename and return it.'''
+
+    if hasher is None:
+        hasher = new_hasher()
+
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(filename, 'rb') as fid:
+        while True:
+            n = fid.readinto(view)
+            if not n:
+                break
+            hasher.update(view[:n])
+
+    return hasher
+
+def _has_size(path, size):
+
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
+
+def _utc_now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
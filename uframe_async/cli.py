@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import runpy
+import sys
+from collections import OrderedDict
+
+# Directory containing the request scripts run by the subcommands
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Subcommand -> (script run for it, summary).  Nothing is imported until a
+# subcommand runs, and then only what its script needs
+COMMANDS = OrderedDict([('plan', ('plan_async_requests.py', 'Split request urls into smaller time windows')),
+    ('validate', ('validate_async_requests.py', 'Validate request urls without sending them')),
+    ('submit', ('send_async_requests_from_urlcsv.py', 'Validate and send request urls')),
+    ('check', ('check_async_requests_from_csv.py', 'Check the status of the requests in a request CSV')),
+    ('poll', ('poll_queued_requests.py', 'Poll queued requests until they complete')),
+    ('download', ('download_async_dataset.py', 'Download the NetCDF files of a request')),
+    ('download-csv', ('download_async_dataset_from_urlcsv.py', 'Download the NetCDF files of the completed requests in a request CSV')),
+    ('run', ('run_async_pipeline.py', 'Submit, poll, download and timestamp requests as one pipeline')),
+    ('timestamp', (None, 'Rename NetCDF files with their time coverage')),
+    ('store', ('request_store.py', 'Import, export or summarize a request state database'))])
+
+def main(argv=None):
+    '''Run a uframe-async subcommand.  The arguments after the subcommand are
+    passed to it; use uframe-async COMMAND -h for its options.  Returns the exit
+    status.'''
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    arg_parser = argparse.ArgumentParser(prog='uframe-async',
+        description='UFrame asynchronous request tools.',
+        epilog='Run uframe-async COMMAND -h for the options of a command.',
+        formatter_class=_CommandHelpFormatter)
+    arg_parser.add_argument('command',
+        metavar='COMMAND',
+        choices=list(COMMANDS.keys()),
+        help='One of:\n{:s}'.format('\n'.join(['  {:s} - {:s}'.format(c, h) for (c, (s, h)) in COMMANDS.items()])))
+    arg_parser.add_argument('args',
+        nargs=argparse.REMAINDER,
+        help=argparse.SUPPRESS)
+
+    parsed_args = arg_parser.parse_args(argv)
+
+    if parsed_args.command == 'timestamp':
+        return timestamp_main(parsed_args.args)
+
+    return run_script(COMMANDS[parsed_args.command][0], parsed_args.args)
+
+def run_script(script, args):
+    '''Run the request script (ie: check_async_requests_from_csv.py) in
+    SCRIPTS_DIR as __main__ with the command line arguments args.  Returns the
+    exit status.'''
+
+    script_file = os.path.join(SCRIPTS_DIR, script)
+    if not os.path.isfile(script_file):
+        sys.stderr.write('Script not found: {:s}\n'.format(script_file))
+        return 1
+
+    saved_argv = sys.argv
+    sys.argv = [script_file] + list(args)
+    try:
+        runpy.run_path(script_file, run_name='__main__')
+    except SystemExit as e:
+        return _exit_status(e.code)
+    finally:
+        sys.argv = saved_argv
+
+    return 0
+
+def timestamp_main(argv):
+    '''Rename each NetCDF file to include the reference designator and time
+    coverage and print the new filenames to STDOUT.  Files that fail the
+    integrity checks are quarantined.'''
+
+    arg_parser = argparse.ArgumentParser(prog='uframe-async timestamp', description=timestamp_main.__doc__)
+    arg_parser.add_argument('nc_files',
+        nargs='+',
+        help='NetCDF files to rename')
+    arg_parser.add_argument('-q', '--quarantine',
+        dest='quarantine_dir',
+        help='Directory files failing the integrity checks are moved to (default: a quarantine directory next to each file)')
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        type=int,
+        help='Number of processes reading the file headers (default: number of cpus)')
+    arg_parser.add_argument('--cache',
+        dest='cache',
+        help='SQLite download cache file to record the new filenames in')
+    arg_parser.add_argument('-j', '--json',
+        dest='json',
+        action='store_true',
+        help='Dump the renamed NetCDF files names as a json array.')
+
+    args = arg_parser.parse_args(argv)
+
+    from uframe_async.hyrax import timestamp_nc_files
+    from uframe_async.cache import DownloadCache
+
+    cache = None
+    if args.cache:
+        cache = DownloadCache(args.cache)
+
+    nc_files = timestamp_nc_files(args.nc_files, max_workers=args.workers, quarantine_dir=args.quarantine_dir, cache=cache)
+
+    if cache:
+        cache.close()
+
+    if args.json:
+        sys.stdout.write('{:s}'.format(json.dumps(nc_files)))
+    else:
+        for nc_file in nc_files:
+            sys.stdout.write('{:s}\n'.format(nc_file))
+
+    if len(nc_files) != len(args.nc_files):
+        return 1
+
+    return 0
+
+def _exit_status(code):
+    '''Convert a SystemExit code to an exit status as the interpreter does.'''
+
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return int(code)
+
+    sys.stderr.write('{:s}\n'.format(str(code)))
+    return 1
+
+class _CommandHelpFormatter(argparse.RawDescriptionHelpFormatter):
+    '''Keeps the line breaks of the COMMAND list in the help text.'''
+
+    def _split_lines(self, text, width):
+        return text.splitlines()
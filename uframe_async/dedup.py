@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import bisect
+import datetime
+from collections import OrderedDict
+from dateutil import parser
+from uframe_async.planner import format_dt, replace_time_window
+from uframe_async.requestfile import open_request_reader
+from uframe_async.urls import parse_async_url
+
+class IntervalIndex(object):
+    '''Sorted list of disjoint [begin, end] intervals.  Overlapping intervals
+    (and, if merge_adjacent=True, intervals that touch) are merged as they are
+    added.'''
+
+    def __init__(self, merge_adjacent=True):
+
+        self.merge_adjacent = merge_adjacent
+        self._begins = []
+        self._ends = []
+
+    def __len__(self):
+        return len(self._begins)
+
+    def __iter__(self):
+        return iter(zip(self._begins, self._ends))
+
+    def add(self, begin, end):
+        '''Add [begin, end], merging it with any intervals it overlaps.'''
+
+        i = self._first_touching(begin)
+        j = i
+        while j < len(self._begins) and self._touches(self._begins[j], end):
+            begin = min(begin, self._begins[j])
+            end = max(end, self._ends[j])
+            j += 1
+
+        self._begins[i:j] = [begin]
+        self._ends[i:j] = [end]
+
+    def covers(self, begin, end):
+        '''True if [begin, end] lies entirely within one interval.'''
+
+        i = bisect.bisect_right(self._begins, begin) - 1
+
+        return i >= 0 and self._ends[i] >= end
+
+    def uncovered(self, begin, end):
+        '''Return the (begin, end) pieces of [begin, end] not covered by any
+        interval.'''
+
+        gaps = []
+        i = max(0, bisect.bisect_right(self._begins, begin) - 1)
+        t = begin
+        while i < len(self._begins) and self._begins[i] < end:
+            if self._ends[i] > t:
+                if self._begins[i] > t:
+                    gaps.append((t, self._begins[i]))
+                t = self._ends[i]
+            i += 1
+        if t < end:
+            gaps.append((t, end))
+
+        return gaps
+
+    def _first_touching(self, begin):
+
+        i = bisect.bisect_left(self._ends, begin)
+        if self.merge_adjacent:
+            return i
+        # Only strictly overlapping intervals are merged
+        while i < len(self._ends) and self._ends[i] == begin:
+            i += 1
+        return i
+
+    def _touches(self, interval_begin, end):
+
+        if self.merge_adjacent:
+            return interval_begin <= end
+        return interval_begin < end
+
+def request_key(request):
+    '''Key identifying the data an asynchronous request asks for, apart from its
+    time window: the server/reference designator prefix, telemetry, stream and
+    the remaining query parameters.'''
+
+    prefix = request.url.split('?', 1)[0]
+    parameters = tuple(sorted([(p, v) for (p, v) in request.parameters if p not in ('beginDT', 'endDT')]))
+
+    return (prefix, parameters)
+
+def coalesce_async_requests(urls, history=None, merge_adjacent=False):
+    '''Remove redundant asynchronous requests from urls before submission.
+    Exact duplicates are dropped, overlapping (and, if merge_adjacent=True,
+    touching) windows for the same reference designator/stream are merged, and
+    time already covered by the previously queued or completed request urls in
+    history is removed.  Touching windows are kept apart by default, so the
+    chunks made by plan_async_requests are not merged back together.  Returns
+    (urls, stats) where urls is the list of request urls to send and stats
+    counts the input requests, the duplicates, those merged into another
+    request and those dropped because history already covers them.  Urls that
+    cannot be parsed are passed through unchanged.'''
+
+    stats = {'input' : 0,
+        'duplicate' : 0,
+        'merged' : 0,
+        'covered' : 0,
+        'output' : 0}
+
+    # Index of the windows already requested
+    submitted = {}
+    for url in (history or []):
+        request = parse_async_url(url)
+        if not request or not request.beginDT or not request.endDT:
+            continue
+        key = request_key(request)
+        if key not in submitted:
+            submitted[key] = IntervalIndex(merge_adjacent=True)
+        submitted[key].add(_parse_dt(request.beginDT), _parse_dt(request.endDT))
+
+    seen = set()
+    requests = OrderedDict()
+    passthrough = []
+    for url in urls:
+        stats['input'] += 1
+
+        if url in seen:
+            stats['duplicate'] += 1
+            continue
+        seen.add(url)
+
+        request = parse_async_url(url)
+        if not request or not request.beginDT or not request.endDT:
+            passthrough.append(url)
+            continue
+
+        key = request_key(request)
+        begin = _parse_dt(request.beginDT)
+        end = _parse_dt(request.endDT)
+        # Requests whose whole window was already requested are dropped
+        if key in submitted and not submitted[key].uncovered(begin, end):
+            stats['covered'] += 1
+            continue
+
+        if key not in requests:
+            requests[key] = (request, IntervalIndex(merge_adjacent=merge_adjacent), [])
+        (first, index, windows) = requests[key]
+        index.add(begin, end)
+        windows.append(request)
+
+    coalesced = list(passthrough)
+    for (key, (first, index, windows)) in requests.items():
+        stats['merged'] += len(windows) - len(index)
+        for (begin, end) in index:
+            pieces = [(begin, end)]
+            if key in submitted:
+                pieces = submitted[key].uncovered(begin, end)
+            for (t0, t1) in pieces:
+                coalesced.append(_replace_window(first, t0, t1, windows))
+
+    stats['output'] = len(coalesced)
+
+    return (coalesced, stats)
+
+def iter_request_history(request_csvs=None, store=None):
+    '''Yield the request_url of every previously sent request in the request CSV
+    (or JSONL, by extension) files request_csvs and/or the RequestStore
+    store.'''
+
+    for request_csv in (request_csvs or []):
+        reader = open_request_reader(request_csv)
+        try:
+            for row in reader:
+                if row.get('request_url') and row.get('requestUUID'):
+                    yield row['request_url']
+        finally:
+            reader.close()
+
+    if store:
+        for row in store.requests():
+            if row.get('request_url'):
+                yield row['request_url']
+
+def _replace_window(first, t0, t1, windows):
+
+    # Reuse an original url if the window was not changed
+    for request in windows:
+        if _parse_dt(request.beginDT) == t0 and _parse_dt(request.endDT) == t1:
+            return request.url
+
+    return replace_time_window(first, format_dt(t0), format_dt(t1))
+
+def _parse_dt(dt):
+
+    # Fast path for the fixed UFrame timestamp format
+    try:
+        return datetime.datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        pass
+
+    parsed = parser.parse(dt)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return parsed
@@ -7,17 +7,61 @@ import os
 import sys
 import argparse
 import shutil
-from netCDF4 import Dataset
+import heapq
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from uframe_async.session import get_session
+from uframe_async.cache import DownloadCache, link_file, new_hasher, hash_file
+from uframe_async.ratelimit import BandwidthLimiter
+from uframe_async.listing import iter_listing
+from uframe_async.metrics import get_metrics, STAGE_DOWNLOAD, STAGE_TIMESTAMP, STAGE_RENAME
+
+# Default number of threads used to crawl directory listings and download files
+DOWNLOAD_WORKERS = 4
+# Default size of the buffer each download is read into
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# DownloadScheduler orderings
+SCHEDULE_SMALLEST = 'smallest'
+SCHEDULE_OLDEST = 'oldest'
+SCHEDULE_FAIR = 'fair'
+SCHEDULE_POLICIES = (SCHEDULE_SMALLEST, SCHEDULE_OLDEST, SCHEDULE_FAIR)
+# Default number of bytes DownloadScheduler keeps free on the destination
+DOWNLOAD_MIN_FREE_SPACE = 1024 ** 3
+# Seconds between free space checks while downloads are paused
+_FREE_SPACE_CHECK_INTERVAL = 30
+
+# Request directory names under an async results url
+_HYRAX_UUID_DIR_REGEXP = re.compile(r'^\w{10}\-\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12}$')
+# Reference designator and stream in a downloaded NetCDF filename
+_REF_DES_REGEXP = re.compile(r'_(\w{1,}\-\w{1,}\-\w{1,}\-\w{1,}.*)\.nc')
+# Leading bytes of NetCDF classic (CDF1/2/5) and NetCDF4 (HDF5) files
+_NC_MAGIC = (b'CDF\x01', b'CDF\x02', b'CDF\x05', b'\x89HDF\r\n\x1a\n')
+_COVERAGE_REGEXP = re.compile(r'^\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2}$')
+# netCDF4/HDF5 is not thread-safe: header reads made in this process take this
+# lock, so timestamp_nc_files called from several threads reads one file at a
+# time
+_NC_LOCK = threading.Lock()
+# Files already renamed by timestamp_nc_files
+_TIMESTAMPED_REGEXP = re.compile(r'\-\d{8}T\d{6}\-\d{8}T\d{6}\.nc$')
 
 def main(args):
     '''Download all NetCDF files located under the specified Hyrax url.  Individual
     NetCDF files correspond to the UFrame bin sizes.  The list of downloaded files
     is printed to STDOUT.'''
     
-    nc_files = download_hyrax_nc_files(args.hyrax_url, args.destdir, args.verbose)
+    cache = None
+    if args.cache:
+        cache = DownloadCache(args.cache)
+        
+    nc_files = download_hyrax_nc_files(args.hyrax_url, args.destdir, args.verbose, max_workers=args.workers, cache=cache) or []
     
     if args.timestamp_files:
-        nc_files = timestamp_nc_files(nc_files)
+        nc_files = timestamp_nc_files(nc_files, max_workers=None, cache=cache)
+        
+    if cache:
+        cache.close()
         
     if args.json:
         sys.stdout.write('{:s}'.format(json.dumps(nc_files)))
@@ -28,89 +72,346 @@ def main(args):
         
     return
 
-def download_hyrax_nc_files(url, destdir, verbose):
+def download_hyrax_nc_files(url, destdir, verbose, session=None, max_workers=DOWNLOAD_WORKERS, buffer_size=DOWNLOAD_BUFFER_SIZE, cache=None):
     '''Download all NetCDF files located under the specified Hyrax url.  Individual
     NetCDF files correspond to the UFrame bin sizes.  File are downloaded to destdir
-    under reference designator directories which are automatically created.'''
+    under reference designator directories which are automatically created.  The
+    child directory listings are crawled and the files downloaded on a pool of
+    max_workers threads.  If cache (a DownloadCache) is given, files that have not
+    changed since they were last downloaded are not transferred again.  The local
+    files are returned in listing order.'''
     
+    if session is None:
+        session = get_session()
+        
     # Retrieve the urls pointing to all NetCDF child directories located under
     # url
-    parent_nc_dirs = parse_hyrax_parent_url(url)
+    parent_nc_dirs = _list_nc_dirs(url, session)
     if not parent_nc_dirs:
         sys.stderr.write('No valid Hyrax parent directories found: {:s}\n'.format(url))
         sys.stderr.flush()
         return
     
-    # Retrieve urls pointing to each NetCDF file in it's respective directory
-    all_nc_file_urls = []    
-    for parent_nc_dir in parent_nc_dirs:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         
-        nc_file_urls = parse_hyrax_child_url(parent_nc_dir)
+        # Retrieve urls pointing to each NetCDF file in it's respective directory
+        all_nc_file_urls = []
+        for entries in executor.map(lambda u: _list_nc_files(u, session), parent_nc_dirs):
+            all_nc_file_urls.extend([entry.url for entry in entries or []])
+                
+        if not all_nc_file_urls:
+            sys.stderr.write('No NetCDF urls found: {:s}\n'.format(url))
+            return;
         
-        for nc_file_url in nc_file_urls:
-            all_nc_file_urls.append(nc_file_url)
-            
-    if not all_nc_file_urls:
-        sys.stderr.write('No NetCDF urls found: {:s}\n'.format(url))
-        return;
-    
-    # Download all NetCDF files to destdir
-    nc_files = []    
-    for nc_url in all_nc_file_urls:
-        nc_file = download_hyrax_nc_from_url(nc_url, destdir, verbose=verbose)
-        if not nc_file:
-            continue
+        # Download all NetCDF files to destdir
+        futures = {}
+        for (i, nc_url) in enumerate(all_nc_file_urls):
+            future = executor.submit(download_hyrax_nc_from_url, nc_url, destdir, verbose=verbose, session=session, buffer_size=buffer_size, cache=cache)
+            futures[future] = i
         
-        nc_files.append(nc_file)
+        nc_files = [None for nc_url in all_nc_file_urls]
+        num_done = 0
+        for future in as_completed(futures):
+            i = futures[future]
+            num_done += 1
+            try:
+                nc_files[i] = future.result()
+            except Exception as e:
+                sys.stderr.write('Download failed: {:s} ({:s})\n'.format(all_nc_file_urls[i], str(e)))
+                
+            if verbose:
+                sys.stdout.write('[{:d}/{:d}] {:s}: {:s}\n'.format(num_done,
+                    len(all_nc_file_urls),
+                    'Downloaded' if nc_files[i] else 'Failed',
+                    all_nc_file_urls[i]))
+                sys.stdout.flush()
             
-    return nc_files
+    return [nc_file for nc_file in nc_files if nc_file]
         
-def parse_hyrax_parent_url(url):
+def parse_hyrax_parent_url(url, session=None):
+    '''Return the urls of the request directories (contents.html) listed under
+    the Hyrax url.  Raises requests.exceptions.RequestException if the listing
+    fails, rather than returning the directories listed so far.'''
     
-    r = requests.get(url)
-    if r.status_code != 200:
-        return []
-        
-    html = r.text
-    r.close()
+    return [entry.url for entry in iter_listing(url, session=session) if entry.is_dir and _HYRAX_UUID_DIR_REGEXP.search(entry.name)]
+    
+def parse_hyrax_child_url(url, session=None):
+    '''Return the urls of the NetCDF files listed in the Hyrax directory url.
+    Raises requests.exceptions.RequestException if the listing fails.'''
+    
+    return [entry.url for entry in list_hyrax_nc_files(url, session=session)]
+    
+def list_hyrax_nc_files(url, session=None):
+    '''Return a ListingEntry, including the file size and modification time when
+    the listing reports them, for each NetCDF file in the Hyrax directory url.'''
+    
+    return [entry for entry in iter_listing(url, session=session) if not entry.is_dir and entry.name.endswith('.nc')]
+    
+class DownloadScheduler(object):
+    '''Priority download queue for the NetCDF files of completed requests.  The
+    files of each request added with add_request are listed, with their sizes
+    from the Hyrax listing, and run downloads them on max_workers threads in
+    policy order:
+    
+        smallest - smallest file first
+        oldest - files of the oldest request (request_time) first
+        fair - interleave instruments so each gets an equal share of the bytes
+               downloaded, however large its requests
+               
+    If bandwidth (bytes/s) is given the combined transfer rate of all downloads
+    is capped at it.  A download is only started if destdir keeps at least
+    min_free_space bytes free after it (and the downloads in progress) finish;
+    otherwise downloads pause until space is freed or stop is called.
     
-    # Regexp to find child directories containing .nc files
-    hyrax_link_regexp = re.compile(r'<a href="(\w{10}\-\w{8}\-\w{4}\-\w{4}\-\w{4}\-\w{12}/contents.html)">')
-    matches = hyrax_link_regexp.findall(html)
+    on_request_done(request_meta, nc_files, failed) is called from the worker
+    threads once every file of a request has been tried; failed is the number
+    of files that could not be downloaded.'''
     
-    if not matches:
-        return matches
+    def __init__(self, destdir, policy=SCHEDULE_SMALLEST, max_workers=DOWNLOAD_WORKERS, bandwidth=None, min_free_space=DOWNLOAD_MIN_FREE_SPACE, verbose=False, session=None, cache=None, buffer_size=DOWNLOAD_BUFFER_SIZE, on_request_done=None):
         
-    url_tokens = os.path.split(url)
-    hyrax_urls = []
-    for m in matches:
-        hyrax_urls.append(os.path.join(url_tokens[0], m))
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError('Invalid download schedule policy: {:s}'.format(policy))
+            
+        self.destdir = destdir
+        self.policy = policy
+        self.max_workers = max_workers
+        self.min_free_space = min_free_space
+        self.verbose = verbose
+        self.session = session
+        self.cache = cache
+        self.buffer_size = buffer_size
+        self.on_request_done = on_request_done
         
-    return hyrax_urls
-    
-def parse_hyrax_child_url(url):
+        self.limiter = None
+        if bandwidth:
+            self.limiter = BandwidthLimiter(bandwidth)
+            
+        self.stats = {'files_downloaded' : 0,
+            'files_failed' : 0,
+            'bytes' : 0,
+            'pauses' : 0}
+            
+        self._queue = []
+        self._seq = itertools.count()
+        self._requests = {}
+        # Bytes of the downloads in progress, not yet on disk
+        self._reserved = 0
+        # Fair queuing virtual time and the virtual finish time of each
+        # instrument
+        self._vtime = 0
+        self._vfinish = {}
+        self._paused = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        
+    def add_request(self, hyrax_url, request_meta=None):
+        '''List the NetCDF files under the Hyrax request url and queue them.
+        Returns the number of files queued.  Nothing is queued, and 0 returned,
+        if any of the request directories fails to list, so the request is
+        retried as a whole rather than downloaded with files missing.'''
+        
+        if request_meta is None:
+            request_meta = {}
+        key = request_meta.get('requestUUID') or hyrax_url
+        
+        session = self.session or get_session()
+        parent_nc_dirs = _list_nc_dirs(hyrax_url, session)
+        entries = []
+        num_failed = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for dir_entries in executor.map(lambda u: _list_nc_files(u, session), parent_nc_dirs):
+                if dir_entries is None:
+                    num_failed += 1
+                    continue
+                entries.extend(dir_entries)
+                
+        if num_failed:
+            sys.stderr.write('Failed to list {:d} of {:d} directories, not queueing: {:s}\n'.format(num_failed, len(parent_nc_dirs), hyrax_url))
+            return 0
+        if not entries:
+            sys.stderr.write('No NetCDF urls found: {:s}\n'.format(hyrax_url))
+            return 0
+            
+        with self._cond:
+            self._requests[key] = {'request_meta' : request_meta, 'remaining' : len(entries), 'nc_files' : [], 'failed' : 0}
+            for entry in entries:
+                heapq.heappush(self._queue, (self._priority(entry, request_meta), next(self._seq), key, entry))
+            self._cond.notify_all()
+            
+        return len(entries)
+        
+    def pending(self):
+        '''Number of files waiting to be downloaded.'''
+        
+        return len(self._queue)
+        
+    def run(self):
+        '''Download the queued files and return the stats once the queue is empty
+        or stop is called.'''
+        
+        if self.session is None:
+            self.session = get_session()
+            
+        threads = [threading.Thread(target=self._worker, name='download-{:d}'.format(i), daemon=True) for i in range(max(1, self.max_workers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+        return self.stats
+        
+    def stop(self):
+        '''Stop starting new downloads.  Downloads in progress finish.'''
+        
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            
+    def _priority(self, entry, request_meta):
+        
+        size = entry.size
+        if self.policy == SCHEDULE_SMALLEST:
+            return (size is None, size or 0)
+            
+        if self.policy == SCHEDULE_OLDEST:
+            request_time = request_meta.get('request_time') or ''
+            return (not request_time, request_time)
+            
+        # Start-time fair queuing by bytes: each file of an instrument starts
+        # where its previous file finished, and an instrument that has been
+        # idle starts at the current virtual time
+        instrument = request_meta.get('instrument') or _nc_stream(entry.name)
+        vstart = max(self._vtime, self._vfinish.get(instrument, 0))
+        self._vfinish[instrument] = vstart + (size or 1)
+        
+        return (vstart,)
+        
+    def _next(self):
+        '''Return the next (key, entry) to download, waiting while there is not
+        enough free space, or None once the queue is empty or stop was called.'''
+        
+        with self._cond:
+            while not self._stopped and self._queue:
+                (priority, seq, key, entry) = self._queue[0]
+                size = entry.size or 0
+                free = self._free_space()
+                if free is None or free - self._reserved - size >= self.min_free_space:
+                    heapq.heappop(self._queue)
+                    self._reserved += size
+                    if self.policy == SCHEDULE_FAIR:
+                        self._vtime = priority[0]
+                    if self._paused:
+                        sys.stderr.write('Resuming downloads\n')
+                        self._paused = False
+                    return (key, entry)
+                    
+                if not self._paused:
+                    sys.stderr.write('Pausing downloads: {:d} bytes free on {:s}, {:d} needed for {:s}\n'.format(free,
+                        self.destdir,
+                        self.min_free_space + self._reserved + size,
+                        entry.url))
+                    self.stats['pauses'] += 1
+                    self._paused = True
+                # Wait for a download to finish or for space to be freed
+                # elsewhere
+                self._cond.wait(_FREE_SPACE_CHECK_INTERVAL)
+                
+        return None
+        
+    def _worker(self):
+        
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            (key, entry) = item
+            
+            nc_file = None
+            try:
+                nc_file = download_hyrax_nc_from_url(entry.url,
+                    self.destdir,
+                    verbose=self.verbose,
+                    session=self.session,
+                    buffer_size=self.buffer_size,
+                    cache=self.cache,
+                    throttle=self.limiter.consume if self.limiter else None)
+            except Exception as e:
+                sys.stderr.write('Download failed: {:s} ({:s})\n'.format(entry.url, str(e)))
+                
+            self._file_done(key, entry, nc_file)
+            
+    def _file_done(self, key, entry, nc_file):
+        
+        with self._cond:
+            self._reserved -= entry.size or 0
+            request = self._requests[key]
+            request['remaining'] -= 1
+            if nc_file:
+                request['nc_files'].append(nc_file)
+                self.stats['files_downloaded'] += 1
+                self.stats['bytes'] += os.path.getsize(nc_file)
+            else:
+                request['failed'] += 1
+                self.stats['files_failed'] += 1
+            done = not request['remaining']
+            if done:
+                del self._requests[key]
+            # The space reserved for this file is free again
+            self._cond.notify_all()
+            
+        if done and self.on_request_done:
+            self.on_request_done(request['request_meta'], sorted(request['nc_files']), request['failed'])
+            
+    def _free_space(self):
+        
+        if not self.min_free_space:
+            return None
+            
+        try:
+            return shutil.disk_usage(self.destdir).free
+        except OSError as e:
+            sys.stderr.write('Failed to check free space on {:s}: {:s}\n'.format(self.destdir, str(e)))
+            return None
+            
+def _list_nc_dirs(url, session):
     
-    r = requests.get(url)
-    if r.status_code != 200:
+    try:
+        return parse_hyrax_parent_url(url, session=session)
+    except requests.exceptions.RequestException as e:
+        sys.stderr.write('Failed to list Hyrax directory: {:s} ({:s})\n'.format(url, str(e)))
+        sys.stderr.flush()
         return []
         
-    html = r.text
-    r.close()
+def _list_nc_files(url, session):
+    '''Return list_hyrax_nc_files(url), or None if the listing failed.'''
     
-    hyrax_nc_regexp = re.compile(r'<a href="(.*\.nc)">')
-    matches = hyrax_nc_regexp.findall(html)
-
-    if not matches:
-        return matches
+    try:
+        return list_hyrax_nc_files(url, session=session)
+    except requests.exceptions.RequestException as e:
+        sys.stderr.write('Failed to list Hyrax directory: {:s} ({:s})\n'.format(url, str(e)))
+        sys.stderr.flush()
+        return None
         
-    url_tokens = os.path.split(url)
-    nc_urls = []
-    for m in matches:
-        nc_urls.append(os.path.join(url_tokens[0], m))
+def _nc_stream(nc_filename):
+    
+    match = _REF_DES_REGEXP.search(nc_filename)
+    if not match:
+        return nc_filename
         
-    return nc_urls
+    return match.groups()[0]
     
-def download_hyrax_nc_from_url(url, destdir, verbose=False):
+def download_hyrax_nc_from_url(url, destdir, verbose=False, session=None, buffer_size=DOWNLOAD_BUFFER_SIZE, fsync=False, cache=None, throttle=None):
+    '''Download the NetCDF file at url to destdir, reading the response into a
+    buffer_size buffer.  Set fsync=True to fsync the file before it is moved into
+    place.  If cache (a DownloadCache) holds a local copy of url, the file is
+    requested with If-None-Match/If-Modified-Since and the local copy is returned
+    if the server reports it unchanged.  Downloaded files are hashed as they are
+    written and hardlinked to an identical file already in the cache.  throttle
+    is passed to write_response_to_file.  Returns the local filename or None if
+    the download failed.'''
+    
+    if session is None:
+        session = get_session()
     
     if not os.path.exists(destdir):
         sys.stderr.write('Invalid destination: {:s}\n'.format(destdir))
@@ -141,64 +442,343 @@ def download_hyrax_nc_from_url(url, destdir, verbose=False):
     if not os.path.exists(nc_dest):
         if verbose:
             sys.stdout.write('Creating destination: {:s}\n'.format(nc_dest))
-        os.makedirs(nc_dest)
+        # Other download threads may be creating the same directory
+        os.makedirs(nc_dest, exist_ok=True)
     
     local_nc = os.path.join(nc_dest, '-'.join([uuid, url_tokens[1]]))
     if verbose:
         sys.stderr.write('Downloading NetCDF file: {:s}\n'.format(url))
         
-    try:
-        with open(local_nc, 'wb') as fid:
-            r = requests.get(url, stream=True)
-            if r.status_code != 200:
-                sys.stderr.write('Download failed: {:s}\n'.format(r.message))
-                next
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    fid.write(chunk)
-                    fid.flush()
-    except IOError as e:
-        sys.stderr.write('{:s}\n'.format(e.message))
-        return
+    # Download to a .part file, resuming a previous partial download if there
+    # is one, and only move it into place once it is complete
+    part_nc = '{:s}.part'.format(local_nc)
+    offset = 0
+    # The sizes checked and the resume offsets are those of the file itself, so
+    # ask for it uncompressed
+    headers = {'Accept-Encoding' : 'identity'}
+    entry = None
+    if os.path.isfile(part_nc):
+        offset = os.path.getsize(part_nc)
+        headers['Range'] = 'bytes={:d}-'.format(offset)
+        if verbose:
+            sys.stderr.write('Resuming download at byte {:d}: {:s}\n'.format(offset, url))
+    elif cache:
+        # Only transfer the file if it changed since it was last downloaded
+        entry = cache.lookup(url)
+        headers.update(cache.conditional_headers(entry))
+        
+    hasher = None
+    if cache:
+        hasher = new_hasher()
+        
+    with get_metrics().timer(STAGE_DOWNLOAD, url) as t:
+        try:
+            r = session.get(url, stream=True, headers=headers)
+            try:
+                # Set if the server compressed the file anyway
+                encoded = r.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+                if r.status_code == 304 and entry:
+                    cached_nc = _cached_nc_file(cache, entry, local_nc)
+                    if cached_nc:
+                        if verbose:
+                            sys.stderr.write('Unchanged, using cached file: {:s}\n'.format(cached_nc))
+                        return cached_nc
+                    # The cached copy could not be used, so fetch the file again
+                    cache.forget(url)
+                    return download_hyrax_nc_from_url(url, destdir, verbose=verbose, session=session, buffer_size=buffer_size, fsync=fsync, cache=cache, throttle=throttle)
+                elif r.status_code == 416 and offset:
+                    # The .part file is already complete if its size matches the
+                    # size reported by the server
+                    if _content_range_size(r.headers.get('Content-Range')) == offset:
+                        os.replace(part_nc, local_nc)
+                        if cache:
+                            _cache_nc_file(cache, url, local_nc, hash_file(local_nc, buffer_size=buffer_size), r.headers, verbose)
+                        return local_nc
+                    # Otherwise start over
+                    sys.stderr.write('Discarding unresumable partial download: {:s}\n'.format(part_nc))
+                    os.remove(part_nc)
+                    t.error()
+                    return download_hyrax_nc_from_url(url, destdir, verbose=verbose, session=session, buffer_size=buffer_size, fsync=fsync, cache=cache, throttle=throttle)
+                elif r.status_code == 206:
+                    # Only append if the server resumed exactly where the
+                    # .part file ends, otherwise the file would be corrupted
+                    start = _content_range_start(r.headers.get('Content-Range'))
+                    if start != offset or encoded:
+                        sys.stderr.write('Discarding partial download, server did not resume it uncompressed at byte {:d}: {:s}\n'.format(offset, part_nc))
+                        os.remove(part_nc)
+                        t.error()
+                        return download_hyrax_nc_from_url(url, destdir, verbose=verbose, session=session, buffer_size=buffer_size, fsync=fsync, cache=cache, throttle=throttle)
+                    mode = 'ab'
+                    expected_size = _content_range_size(r.headers.get('Content-Range'))
+                    # The hash covers the bytes already on disk too
+                    if hasher:
+                        hash_file(part_nc, hasher, buffer_size=buffer_size)
+                elif r.status_code == 200:
+                    # Server ignored the Range header (or there was no .part file)
+                    mode = 'wb'
+                    offset = 0
+                    expected_size = r.headers.get('Content-Length')
+                    # Content-Length is the compressed size if the server
+                    # compressed the file
+                    if expected_size is not None and not encoded:
+                        expected_size = int(expected_size)
+                    else:
+                        expected_size = None
+                else:
+                    t.error()
+                    sys.stderr.write('Download failed: {:s} ({:d} {:s})\n'.format(url, r.status_code, r.reason))
+                    return
+                    
+                with open(part_nc, mode) as fid:
+                    t.add_bytes(write_response_to_file(r, fid, buffer_size=buffer_size, fsync=fsync, hasher=hasher, throttle=throttle))
+                response_headers = r.headers
+            finally:
+                # Release the connection back to the pool
+                r.close()
+        except IOError as e:
+            t.error()
+            sys.stderr.write('Download interrupted, partial file kept for resume: {:s} ({:s})\n'.format(url, str(e)))
+            return
+        
+        # Verify the size before moving the file into place
+        size = os.path.getsize(part_nc)
+        if expected_size is not None and size != expected_size:
+            t.error()
+            sys.stderr.write('Incomplete download ({:d} of {:d} bytes), partial file kept for resume: {:s}\n'.format(size, expected_size, url))
+            return
+            
+        os.replace(part_nc, local_nc)
+        
+    if cache:
+        _cache_nc_file(cache, url, local_nc, hasher, response_headers, verbose)
+    
+    return local_nc
+
+def _cached_nc_file(cache, entry, local_nc):
+    '''Return the local copy of the unchanged file described by the cache entry.
+    A copy in the same directory as local_nc (possibly already renamed by
+    timestamp_nc_files) is used as is, otherwise it is hardlinked to local_nc.
+    Returns None if the copy could not be linked.'''
+    
+    if os.path.dirname(entry['path']) == os.path.dirname(local_nc):
+        return entry['path']
+        
+    if not link_file(entry['path'], local_nc):
+        return None
+        
+    cache.record(entry['url'], local_nc, entry['size'], entry['sha256'], etag=entry['etag'], last_modified=entry['last_modified'])
     
     return local_nc
+    
+def _cache_nc_file(cache, url, local_nc, hasher, headers, verbose=False):
+    '''Hardlink the newly downloaded local_nc to an identical file already in the
+    cache, if there is one, and record it in the cache.'''
+    
+    size = os.path.getsize(local_nc)
+    sha256 = hasher.hexdigest()
+    
+    dup_nc = cache.link_duplicate(local_nc, sha256, size)
+    if dup_nc and verbose:
+        sys.stderr.write('Linked identical file {:s} to {:s}\n'.format(local_nc, dup_nc))
+        
+    cache.record(url, local_nc, size, sha256, etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'))
+
+def write_response_to_file(r, fid, buffer_size=DOWNLOAD_BUFFER_SIZE, fsync=False, hasher=None, throttle=None):
+    '''Stream the body of the requests response r (opened with stream=True) to the
+    open binary file fid.  The body is read straight into a single preallocated
+    buffer_size buffer and written from a memoryview of it, and the file is only
+    flushed (and optionally fsynced) once at the end.  If hasher (ie: a hashlib
+    object) is given it is updated with the body as it is written.  If throttle
+    (ie: BandwidthLimiter.consume) is given it is called with the size of each
+    read.  Returns the number of bytes written.'''
+    
+    # Undo any transfer content-encoding (ie: gzip) while reading.  Callers
+    # checking the size against Content-Length should request the body with
+    # Accept-Encoding: identity
+    r.raw.decode_content = True
+    
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    num_bytes = 0
+    while True:
+        n = r.raw.readinto(view)
+        if not n:
+            break
+        fid.write(view[:n])
+        if hasher:
+            hasher.update(view[:n])
+        if throttle:
+            throttle(n)
+        num_bytes += n
+        
+    fid.flush()
+    if fsync:
+        os.fsync(fid.fileno())
+        
+    return num_bytes
+    
+def _content_range_size(content_range):
+    '''Return the total size from a Content-Range header value (ie: bytes 0-99/1234
+    or bytes */1234), or None if it is missing or unknown.'''
+    
+    if not content_range:
+        return None
+        
+    match = re.search(r'/(\d+)\s*$', content_range)
+    if not match:
+        return None
+        
+    return int(match.groups()[0])
 
-def timestamp_nc_files(nc_files):
+def _content_range_start(content_range):
+    '''Return the first byte position from a Content-Range header value (ie: 100
+    for bytes 100-1233/1234), or None if it is missing or unsatisfied.'''
+    
+    if not content_range:
+        return None
+        
+    match = re.match(r'^\s*bytes\s+(\d+)\-\d+', content_range)
+    if not match:
+        return None
+        
+    return int(match.groups()[0])
+    
+def timestamp_nc_files(nc_files, max_workers=1, quarantine_dir=None, cache=None):
+    '''Rename each NetCDF file to include the reference designator and the
+    time_coverage_start and time_coverage_end global attributes.  Only the file
+    headers are read: in the calling thread if max_workers is 1, serialized
+    with the reads of any other thread since netCDF4 is not thread-safe,
+    otherwise on a pool of max_workers processes (None for the number of cpus).
+    The pool processes are spawned rather than forked, but the pool is meant for
+    command line entry points, not for code that already runs its own threads.
+    Files that fail the integrity checks are moved to quarantine_dir
+    (default: a quarantine directory next to each file) along with a .reason file
+    describing the failure.  Files that have already been renamed are returned
+    as is.  The new names are recorded in cache (a DownloadCache), if given.
+    Returns the renamed files in the order of nc_files.'''
     
+    if not nc_files:
+        return []
+        
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+        
+    # The header reads may run in worker processes, so they are timed as one
+    # batch
+    with get_metrics().timer(STAGE_TIMESTAMP) as t:
+        if max_workers <= 1 or len(nc_files) == 1:
+            results = []
+            for nc_file in nc_files:
+                with _NC_LOCK:
+                    results.append(_nc_time_coverage(nc_file))
+        else:
+            # Spawned workers do not inherit the locks or the HDF5 state of this
+            # process
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results = list(executor.map(_nc_time_coverage, nc_files, chunksize=8))
+        if [r for r in results if r[3]]:
+            t.error()
+        
     ts_nc_files = []
-    for nc_file in nc_files:
+    for (nc_file, ts0, ts1, reason) in results:
         
+        if reason:
+            sys.stderr.write('{:s}: {:s}\n'.format(reason, nc_file))
+            quarantine_nc_file(nc_file, reason, quarantine_dir=quarantine_dir)
+            continue
+            
         file_tokens = os.path.split(nc_file)
         
+        # ie: an unchanged file returned by the download cache
+        if _TIMESTAMPED_REGEXP.search(file_tokens[1]):
+            ts_nc_files.append(nc_file)
+            continue
+            
         # match reference designator
-        ref_des_regexp = re.compile(r'_(\w{1,}\-\w{1,}\-\w{1,}\-\w{1,}.*)\.nc')
-        match = ref_des_regexp.search(file_tokens[1])
+        match = _REF_DES_REGEXP.search(file_tokens[1])
         if not match:
             sys.stderr.write('Failed to parse reference designator filename: {:s}\n'.format(nc_file))
             continue
             
-        try:
-            nci = Dataset(nc_file, 'r')
-        except RuntimeError as e:
-            sys.stderr.write('{:s}: {:s}\n'.format(e.message, nc_file))
-            os.remove(nc_file)
-            continue
-        
-        ts0 = re.sub('\-|:', '', nci.time_coverage_start[:19])
-        ts1 = re.sub('\-|:', '', nci.time_coverage_end[:19])
-        
         nc_filename = '{:s}-{:s}-{:s}.nc'.format(match.groups()[0], ts0, ts1)
         new_nc = os.path.join(file_tokens[0], nc_filename)
         
         try:
-            shutil.move(nc_file, new_nc)
-        except IOError as e:
-            sys.stderr.write('{:s}: {:s}\n'.format(e.strerr, new_nc))
+            with get_metrics().timer(STAGE_RENAME):
+                shutil.move(nc_file, new_nc)
+        except (IOError, OSError) as e:
+            sys.stderr.write('{:s}: {:s}\n'.format(e.strerror, new_nc))
             continue
             
+        if cache:
+            cache.move(nc_file, new_nc)
+            
         ts_nc_files.append(new_nc)
         
     return ts_nc_files    
+    
+def quarantine_nc_file(nc_file, reason, quarantine_dir=None):
+    '''Move nc_file to quarantine_dir (default: a quarantine directory next to
+    nc_file) and write reason to a .reason file beside it.  Returns the
+    quarantined filename or None if it could not be moved.'''
+    
+    if not quarantine_dir:
+        quarantine_dir = os.path.join(os.path.dirname(nc_file), 'quarantine')
+        
+    try:
+        os.makedirs(quarantine_dir, exist_ok=True)
+        q_nc = os.path.join(quarantine_dir, os.path.basename(nc_file))
+        shutil.move(nc_file, q_nc)
+        with open('{:s}.reason'.format(q_nc), 'w') as fid:
+            fid.write('{:s}\n'.format(reason))
+    except (IOError, OSError) as e:
+        sys.stderr.write('Failed to quarantine {:s}: {:s}\n'.format(nc_file, str(e)))
+        return
+        
+    return q_nc
+    
+def _nc_time_coverage(nc_file):
+    '''Check the integrity of nc_file and read its time coverage global
+    attributes without reading any variable data.  Returns (nc_file, ts0, ts1,
+    reason) where reason is None if the file passed, in which case ts0 and ts1
+    are the compact (ie: 20160101T000000) start and end timestamps.'''
+    
+    try:
+        size = os.path.getsize(nc_file)
+        with open(nc_file, 'rb') as fid:
+            magic = fid.read(8)
+    except (IOError, OSError) as e:
+        return (nc_file, None, None, 'Unreadable file ({:s})'.format(str(e)))
+        
+    if not size:
+        return (nc_file, None, None, 'Empty file')
+    if not magic.startswith(_NC_MAGIC):
+        return (nc_file, None, None, 'Not a NetCDF file')
+        
+    # netCDF4 loads the HDF5 library, so it is only imported once a file is read
+    from netCDF4 import Dataset
+    try:
+        nci = Dataset(nc_file, 'r')
+    except (RuntimeError, IOError, OSError) as e:
+        return (nc_file, None, None, 'Failed to open NetCDF file ({:s})'.format(str(e)))
+        
+    try:
+        attrs = nci.ncattrs()
+        for attr in ('time_coverage_start', 'time_coverage_end'):
+            if attr not in attrs:
+                return (nc_file, None, None, 'Missing {:s} global attribute'.format(attr))
+        # Numeric or array valued attributes fail the format check below
+        ts0 = str(nci.getncattr('time_coverage_start'))[:19]
+        ts1 = str(nci.getncattr('time_coverage_end'))[:19]
+        if 'time' in nci.dimensions and not len(nci.dimensions['time']):
+            return (nc_file, None, None, 'Empty time dimension')
+    finally:
+        nci.close()
+        
+    if not _COVERAGE_REGEXP.match(ts0) or not _COVERAGE_REGEXP.match(ts1):
+        return (nc_file, None, None, 'Invalid time coverage ({:s} - {:s})'.format(ts0, ts1))
+        
+    return (nc_file, re.sub(r'\-|:', '', ts0), re.sub(r'\-|:', '', ts1), None)
         
 if __name__ == '__main__':
 
@@ -212,6 +792,11 @@ if __name__ == '__main__':
         dest='json',
         action='store_true',
         help='Dump the downloaded NetCDF files names as a json array.')
+    arg_parser.add_argument('-w', '--workers',
+        dest='workers',
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help='Number of concurrent directory crawls and downloads (default: {:d})'.format(DOWNLOAD_WORKERS))
     arg_parser.add_argument('-v', '--verbose',
         dest='verbose',
         action='store_true',
@@ -220,6 +805,9 @@ if __name__ == '__main__':
         dest='timestamp_files',
         action='store_true',
         help='Rename each downloaded file to include the start and end timestamps.')
+    arg_parser.add_argument('--cache',
+        dest='cache',
+        help='SQLite download cache file.  Files that have not changed since they were last downloaded are not transferred again')
         
     parsed_args = arg_parser.parse_args()
     
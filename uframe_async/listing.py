@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+import codecs
+import re
+import sys
+from collections import namedtuple
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+from xml.etree.ElementTree import XMLPullParser, ParseError
+from requests.exceptions import HTTPError
+from uframe_async.metrics import get_metrics, STAGE_LISTING
+from uframe_async.session import get_session
+
+# Number of bytes read from the listing response between parser feeds
+LISTING_CHUNK_SIZE = 64 * 1024
+
+_SIZE_REGEXP = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', re.IGNORECASE)
+_MTIME_REGEXP = re.compile(r'^\d{4}\-\d{2}\-\d{2}[T ]\d{2}:\d{2}(:\d{2})?')
+_SIZE_MULTIPLIERS = {'' : 1,
+    'K' : 1024,
+    'M' : 1024 ** 2,
+    'G' : 1024 ** 3,
+    'T' : 1024 ** 4}
+# Hosts that returned 404 for a catalog.xml, so only their contents.html
+# listings are fetched
+_NO_CATALOG_HOSTS = set()
+
+_THREDDS_SIZE_UNITS = {'bytes' : 1,
+    'kbytes' : 1000,
+    'mbytes' : 1000 ** 2,
+    'gbytes' : 1000 ** 3,
+    'tbytes' : 1000 ** 4}
+
+class ListingEntry(namedtuple('ListingEntry', ['url', 'name', 'size', 'mtime', 'is_dir'])):
+    '''Single entry of a Hyrax/THREDDS directory listing.  For directories, url
+    points to the directory contents.html.  size is in bytes (approximate when
+    the listing reports human readable sizes) and mtime is the listing timestamp
+    string; either may be None if the listing does not report it.'''
+
+    __slots__ = ()
+
+def iter_listing(url, session=None, prefer_catalog=True):
+    '''Yield a ListingEntry for each file and subdirectory in the Hyrax directory
+    listing url (a contents.html or catalog.xml url), as the response is read.
+    If prefer_catalog=True the machine-readable catalog.xml is tried first and
+    the contents.html page is only parsed if the catalog is unavailable or
+    empty.  Once a host has returned 404 for a catalog.xml, only its
+    contents.html pages are fetched.  Raises requests.exceptions.RequestException if the listing can not
+    be fetched.'''
+
+    if session is None:
+        session = get_session()
+
+    catalog_url = re.sub(r'contents\.html$', 'catalog.xml', url)
+    if prefer_catalog and catalog_url.endswith('catalog.xml') and urlsplit(catalog_url).netloc not in _NO_CATALOG_HOSTS:
+        count = 0
+        try:
+            for entry in iter_catalog_listing(catalog_url, session=session):
+                count += 1
+                yield entry
+        except ParseError as e:
+            sys.stderr.write('Invalid catalog: {:s} ({:s})\n'.format(catalog_url, str(e)))
+        # Entries already yielded cannot be taken back, so only fall back to the
+        # html listing if the catalog produced nothing
+        if count:
+            return
+
+    html_url = re.sub(r'catalog\.xml$', 'contents.html', url)
+    for entry in iter_html_listing(html_url, session=session):
+        yield entry
+
+def iter_html_listing(url, session=None):
+    '''Incrementally parse the Hyrax contents.html page at url and yield a
+    ListingEntry for each linked file or directory as it is parsed.  Raises
+    requests.exceptions.HTTPError if the page can not be fetched, so a failed
+    listing is not mistaken for an empty directory.'''
+
+    if session is None:
+        session = get_session()
+
+    # The timer covers the whole crawl of the listing, including the time the
+    # caller spends between entries
+    with get_metrics().timer(STAGE_LISTING, url) as t:
+        r = session.get(url, stream=True)
+        try:
+            if r.status_code != 200:
+                raise HTTPError('HTTP {:d}'.format(r.status_code), response=r)
+
+            parser = _HyraxListingParser(url)
+            for text in _iter_text(r, t):
+                parser.feed(text)
+                while parser.entries:
+                    yield parser.entries.pop(0)
+            parser.close()
+            while parser.entries:
+                yield parser.entries.pop(0)
+        finally:
+            r.close()
+
+def iter_catalog_listing(url, session=None):
+    '''Incrementally parse the THREDDS/Hyrax catalog.xml at url and yield a
+    ListingEntry for each dataset and catalogRef as it is parsed.  Raises
+    xml.etree.ElementTree.ParseError if the catalog is not valid xml.'''
+
+    if session is None:
+        session = get_session()
+
+    with get_metrics().timer(STAGE_LISTING, url) as t:
+        r = session.get(url, stream=True)
+        try:
+            if r.status_code != 200:
+                # A missing catalog is expected on servers that only provide
+                # contents.html
+                if r.status_code == 404:
+                    _NO_CATALOG_HOSTS.add(urlsplit(url).netloc)
+                else:
+                    t.error()
+                return
+
+            parser = XMLPullParser(events=('end',))
+            base_url = url.rsplit('/', 1)[0] + '/'
+            for chunk in r.iter_content(chunk_size=LISTING_CHUNK_SIZE):
+                t.add_bytes(len(chunk))
+                parser.feed(chunk)
+                for entry in _catalog_entries(parser, base_url):
+                    yield entry
+            parser.close()
+            for entry in _catalog_entries(parser, base_url):
+                yield entry
+        finally:
+            r.close()
+
+def parse_size(size):
+    '''Convert a listing size string (ie: 1234, 12K or 3.4M) to an integer number
+    of bytes.  Returns None if size is not recognized.'''
+
+    if not size:
+        return None
+
+    match = _SIZE_REGEXP.match(size.strip())
+    if not match:
+        return None
+
+    (value, suffix) = match.groups()
+
+    return int(float(value) * _SIZE_MULTIPLIERS[suffix.upper()])
+
+def _iter_text(r, timer):
+
+    decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')(errors='replace')
+    for chunk in r.iter_content(chunk_size=LISTING_CHUNK_SIZE):
+        timer.add_bytes(len(chunk))
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+def _catalog_entries(parser, base_url):
+
+    for (event, elem) in parser.read_events():
+        tag = _local_name(elem.tag)
+
+        if tag == 'catalogRef':
+            href = None
+            for (k, v) in elem.attrib.items():
+                if _local_name(k) == 'href':
+                    href = v
+            if href:
+                dir_url = urljoin(base_url, href)
+                dir_url = re.sub(r'(catalog\.xml|contents\.html)$', '', dir_url)
+                if not dir_url.endswith('/'):
+                    dir_url = dir_url + '/'
+                name = elem.attrib.get('name') or dir_url.rstrip('/').rsplit('/', 1)[-1]
+                yield ListingEntry('{:s}contents.html'.format(dir_url), name, None, None, True)
+            elem.clear()
+
+        elif tag == 'dataset':
+            name = elem.attrib.get('name')
+            # Only leaf datasets are files; container datasets hold the others
+            if name and not [c for c in elem if _local_name(c.tag) == 'dataset']:
+                size = None
+                mtime = None
+                for child in elem:
+                    child_tag = _local_name(child.tag)
+                    if child_tag == 'dataSize' and child.text:
+                        units = child.attrib.get('units', 'bytes').lower()
+                        try:
+                            size = int(float(child.text) * _THREDDS_SIZE_UNITS.get(units, 1))
+                        except ValueError:
+                            pass
+                    elif child_tag == 'date' and child.attrib.get('type', 'modified') == 'modified':
+                        mtime = child.text
+                yield ListingEntry(urljoin(base_url, name), name, size, mtime, False)
+                elem.clear()
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+class _HyraxListingParser(HTMLParser):
+    '''Collects the links in a Hyrax contents.html table along with the
+    modification time and size cells of the same row.'''
+
+    def __init__(self, url):
+
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.base_url = url.rsplit('/', 1)[0] + '/'
+        self.entries = []
+        self._href = None
+        self._cells = []
+        self._in_cell = False
+        self._in_row = False
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+
+        if tag == 'tr':
+            self._finish_row()
+            self._in_row = True
+        elif tag == 'td':
+            self._in_cell = True
+            self._text = []
+        elif tag == 'a':
+            # Only the first link of a table row names the entry; links outside
+            # of a table are entries on their own
+            if not self._in_row:
+                self._finish_row()
+            if self._href is None:
+                href = dict(attrs).get('href')
+                if href and not href.startswith(('?', '#', '/', '..')) and '://' not in href:
+                    self._href = href
+
+    def handle_endtag(self, tag):
+
+        if tag == 'td' and self._in_cell:
+            self._cells.append(''.join(self._text).strip())
+            self._in_cell = False
+        elif tag in ('tr', 'table', 'body', 'html'):
+            self._finish_row()
+            self._in_row = False
+
+    def handle_data(self, data):
+
+        if self._in_cell:
+            self._text.append(data)
+
+    def close(self):
+
+        HTMLParser.close(self)
+        self._finish_row()
+
+    def _finish_row(self):
+
+        href = self._href
+        cells = self._cells
+        self._href = None
+        self._cells = []
+        if not href:
+            return
+
+        mtime = None
+        size = None
+        for cell in cells:
+            if mtime is None and _MTIME_REGEXP.match(cell):
+                mtime = cell
+            elif size is None:
+                size = parse_size(cell)
+
+        is_dir = href.endswith('/') or href.endswith('/contents.html')
+        if href.endswith('/'):
+            href = '{:s}contents.html'.format(href)
+        name = re.sub(r'/contents\.html$', '', href)
+
+        self.entries.append(ListingEntry(urljoin(self.base_url, href), name, size, mtime, is_dir))
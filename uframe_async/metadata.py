@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from requests.exceptions import RequestException
+from uframe_async.metrics import get_metrics, STAGE_METADATA
+from uframe_async.session import get_session
+
+# Default number of seconds a cached metadata/times document is considered fresh
+METADATA_TTL = 3600
+# Default maximum number of reference designators held in memory
+METADATA_MAXSIZE = 1024
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+
+class _PendingFetch(object):
+    '''In-flight metadata fetch that concurrent lookups of the same key wait on.'''
+
+    __slots__ = ('event', 'value')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+class StreamMetadataCache(object):
+    '''Thread-safe TTL/LRU cache of UFrame metadata/times documents, keyed by the
+    subsite/node/sensor url prefix (ie: http://host:12576/sensor/inv/CE01ISSM/MFD37/03-CTDBPC000/).
+    Concurrent lookups of the same key are coalesced into a single fetch.  If
+    cache_file is specified, entries are persisted to and loaded from that json
+    file so they survive between runs.'''
+
+    def __init__(self, ttl=METADATA_TTL, maxsize=METADATA_MAXSIZE, cache_file=None, session=None, timeout=120):
+
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cache_file = cache_file
+        self.session = session
+        self.timeout = timeout
+
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        if cache_file:
+            self._load()
+
+    def get(self, prefix_url, session=None, timeout=None):
+        '''Return the metadata/times json for the reference designator prefix_url,
+        fetching it if it is not cached or has expired.  session and timeout
+        override the cache defaults for the fetch.  Returns None if the metadata
+        could not be fetched.'''
+
+        with self._lock:
+            metadata = self._lookup(prefix_url)
+            if metadata is not None:
+                return metadata
+
+            pending = self._pending.get(prefix_url)
+            leader = pending is None
+            if leader:
+                pending = _PendingFetch()
+                self._pending[prefix_url] = pending
+
+        if not leader:
+            pending.event.wait()
+            return pending.value
+
+        metadata = None
+        try:
+            metadata = self._fetch(prefix_url, session, timeout)
+        finally:
+            with self._lock:
+                if metadata is not None:
+                    self._store(prefix_url, metadata)
+                del self._pending[prefix_url]
+            pending.value = metadata
+            pending.event.set()
+
+        return metadata
+
+    def invalidate(self, prefix_url):
+        '''Remove prefix_url from the cache.'''
+
+        with self._lock:
+            self._entries.pop(prefix_url, None)
+            if self.cache_file:
+                self._save()
+
+    def clear(self):
+        '''Remove all entries from the cache.'''
+
+        with self._lock:
+            self._entries.clear()
+            if self.cache_file:
+                self._save()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, prefix_url):
+
+        entry = self._entries.get(prefix_url)
+        if entry is None:
+            return None
+
+        (fetch_time, metadata) = entry
+        if time.time() - fetch_time > self.ttl:
+            del self._entries[prefix_url]
+            return None
+
+        self._entries.move_to_end(prefix_url)
+
+        return metadata
+
+    def _store(self, prefix_url, metadata):
+
+        self._entries[prefix_url] = (time.time(), metadata)
+        self._entries.move_to_end(prefix_url)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        if self.cache_file:
+            self._save()
+
+    def _fetch(self, prefix_url, session, timeout):
+
+        if session is None:
+            session = self.session or get_session()
+        if timeout is None:
+            timeout = self.timeout
+
+        metadata_url = '{:s}metadata/times'.format(prefix_url)
+        with get_metrics().timer(STAGE_METADATA, metadata_url) as t:
+            try:
+                r = session.get(metadata_url, timeout=timeout)
+            except RequestException as e:
+                t.error()
+                sys.stderr.write('Failed to fetch metadata: {:s} ({:s})\n'.format(metadata_url, str(e)))
+                sys.stderr.flush()
+                return None
+            t.add_bytes(len(r.content))
+            if r.status_code != 200:
+                t.error()
+        if r.status_code != 200:
+            sys.stderr.write('Failed to fetch metadata: {:s}\n'.format(metadata_url))
+            sys.stderr.flush()
+            return None
+
+        # ie: an html error page served with a 200
+        try:
+            return r.json()
+        except ValueError as e:
+            sys.stderr.write('Invalid metadata response: {:s} ({:s})\n'.format(metadata_url, str(e)))
+            sys.stderr.flush()
+            return None
+
+    def _load(self):
+
+        if not os.path.isfile(self.cache_file):
+            return
+
+        try:
+            with open(self.cache_file, 'r') as fid:
+                entries = json.load(fid)
+        except (IOError, ValueError) as e:
+            sys.stderr.write('Ignoring unreadable metadata cache {:s}: {:s}\n'.format(self.cache_file, str(e)))
+            return
+
+        # Entries are stored oldest first, so re-inserting preserves LRU order
+        now = time.time()
+        for (prefix_url, fetch_time, metadata) in entries:
+            if now - fetch_time > self.ttl:
+                continue
+            self._entries[prefix_url] = (fetch_time, metadata)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+
+        entries = [[k, v[0], v[1]] for (k, v) in self._entries.items()]
+
+        # Write to a temporary file and rename it into place so readers never
+        # see a partially written cache
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        (fd, tmp_file) = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fid:
+                json.dump(entries, fid)
+            os.replace(tmp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to write metadata cache {:s}: {:s}\n'.format(self.cache_file, str(e)))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+def get_metadata_cache():
+    '''Return the package-level metadata cache, creating an in-memory cache with
+    the default ttl and maxsize on first use.'''
+
+    global _metadata_cache
+
+    if _metadata_cache is None:
+        with _metadata_cache_lock:
+            if _metadata_cache is None:
+                _metadata_cache = StreamMetadataCache()
+
+    return _metadata_cache
+
+def set_metadata_cache(cache):
+    '''Replace the package-level metadata cache.  Returns cache.'''
+
+    global _metadata_cache
+
+    with _metadata_cache_lock:
+        _metadata_cache = cache
+
+    return cache
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+import atexit
+import bisect
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlsplit
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Stages timed by the package
+STAGE_VALIDATE = 'validate'
+STAGE_METADATA = 'metadata'
+STAGE_SUBMIT = 'submit'
+STAGE_POLL = 'poll'
+STAGE_LISTING = 'listing'
+STAGE_DOWNLOAD = 'download'
+STAGE_TIMESTAMP = 'timestamp'
+STAGE_RENAME = 'rename'
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+class _StageStats(object):
+
+    __slots__ = ('count', 'errors', 'bytes', 'seconds', 'max_seconds', 'buckets', 'allocated')
+
+    def __init__(self):
+
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # One count per LATENCY_BUCKETS bound plus the +Inf bucket
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.allocated = 0
+
+    def quantile(self, q):
+        '''Estimate the q quantile from the histogram buckets (upper bound of the
+        bucket it falls in).'''
+
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        total = 0
+        for (i, n) in enumerate(self.buckets):
+            total += n
+            if total >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max_seconds
+
+        return self.max_seconds
+
+class StageTimer(object):
+    '''Context manager returned by Metrics.timer.  Call add_bytes to record data
+    transferred and error to record a failure; an exception raised inside the
+    block also counts as a failure.'''
+
+    __slots__ = ('metrics', 'stage', 'host', 'failed', 'num_bytes', '_t0', '_profile', '_memory')
+
+    def __init__(self, metrics, stage, host):
+
+        self.metrics = metrics
+        self.stage = stage
+        self.host = host
+        self.failed = False
+        self.num_bytes = 0
+        self._profile = None
+        self._memory = None
+
+    def add_bytes(self, num_bytes):
+        self.num_bytes += num_bytes
+
+    def error(self):
+        self.failed = True
+
+    def __enter__(self):
+
+        self._profile = self.metrics._start_profile(self.stage)
+        if self.metrics.trace_memory and tracemalloc.is_tracing():
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._t0 = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        elapsed = time.perf_counter() - self._t0
+        if self._profile is not None:
+            self._profile.disable()
+        allocated = 0
+        if self._memory is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self._memory
+
+        self.metrics.record(self.stage,
+            self.host,
+            elapsed,
+            error=self.failed or (exc_type is not None and exc_type is not GeneratorExit),
+            num_bytes=self.num_bytes,
+            allocated=allocated,
+            profile=self._profile)
+
+class Metrics(object):
+    '''Thread-safe per-stage, per-host counters, latency histograms and bytes
+    transferred.  Stages are timed with the timer context manager:
+
+        with get_metrics().timer(STAGE_DOWNLOAD, url) as t:
+            ...
+            t.add_bytes(n)
+
+    Results are exported as a Prometheus textfile or a JSON summary.  Profiling
+    is opt-in: enable_profiling runs cProfile around the listed stages and/or
+    traces the memory allocated in each stage with tracemalloc.'''
+
+    def __init__(self):
+
+        self.started = time.time()
+        self.profile_stages = set()
+        self.trace_memory = False
+        self._stats = {}
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def timer(self, stage, url=None):
+        '''Return a StageTimer for stage.  The host is taken from url, which may
+        also be a bare host name.'''
+
+        return StageTimer(self, stage, _host(url))
+
+    def record(self, stage, host, seconds, error=False, num_bytes=0, allocated=0, profile=None):
+        '''Record one stage operation that took seconds.'''
+
+        with self._lock:
+            key = (stage, host or '')
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _StageStats()
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            stats.bytes += num_bytes
+            stats.allocated += allocated
+            if error:
+                stats.errors += 1
+            if profile is not None:
+                self._profiles.setdefault(stage, []).append(profile)
+
+    def enable_profiling(self, stages=None, memory=False):
+        '''Run cProfile around every timed operation of the listed stages and, if
+        memory=True, record the memory allocated in each stage with tracemalloc.
+        Profiles are written by dump_profiles.'''
+
+        self.profile_stages = set(stages or [])
+        self.trace_memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def summary(self):
+        '''Return a dictionary of stage -> host -> statistics.'''
+
+        summary = {}
+        with self._lock:
+            for ((stage, host), stats) in sorted(self._stats.items()):
+                entry = {'count' : stats.count,
+                    'errors' : stats.errors,
+                    'bytes' : stats.bytes,
+                    'seconds' : stats.seconds,
+                    'mean_seconds' : stats.seconds / stats.count if stats.count else None,
+                    'max_seconds' : stats.max_seconds,
+                    'p50_seconds' : stats.quantile(0.5),
+                    'p90_seconds' : stats.quantile(0.9),
+                    'p99_seconds' : stats.quantile(0.99)}
+                if self.trace_memory:
+                    entry['allocated_bytes'] = stats.allocated
+                summary.setdefault(stage, {})[host] = entry
+
+        return summary
+
+    def to_json(self):
+        '''Return the JSON summary as a string.'''
+
+        return json.dumps({'started' : self.started,
+            'elapsed' : time.time() - self.started,
+            'stages' : self.summary()}, indent=2)
+
+    def to_prometheus(self):
+        '''Return the metrics in the Prometheus text exposition format.'''
+
+        lines = []
+        with self._lock:
+            items = sorted(self._stats.items())
+
+            lines.append('# HELP uframe_async_stage_operations_total Operations completed per stage.')
+            lines.append('# TYPE uframe_async_stage_operations_total counter')
+            for ((stage, host), stats) in items:
+                lines.append('uframe_async_stage_operations_total{{{:s}}} {:d}'.format(_labels(stage, host), stats.count))
+
+            lines.append('# HELP uframe_async_stage_errors_total Failed operations per stage.')
+            lines.append('# TYPE uframe_async_stage_errors_total counter')
+            for ((stage, host), stats) in items:
+                lines.append('uframe_async_stage_errors_total{{{:s}}} {:d}'.format(_labels(stage, host), stats.errors))
+
+            lines.append('# HELP uframe_async_stage_bytes_total Bytes transferred per stage.')
+            lines.append('# TYPE uframe_async_stage_bytes_total counter')
+            for ((stage, host), stats) in items:
+                lines.append('uframe_async_stage_bytes_total{{{:s}}} {:d}'.format(_labels(stage, host), stats.bytes))
+
+            lines.append('# HELP uframe_async_stage_seconds Operation latency per stage.')
+            lines.append('# TYPE uframe_async_stage_seconds histogram')
+            for ((stage, host), stats) in items:
+                labels = _labels(stage, host)
+                total = 0
+                for (i, n) in enumerate(stats.buckets):
+                    total += n
+                    le = '{:g}'.format(LATENCY_BUCKETS[i]) if i < len(LATENCY_BUCKETS) else '+Inf'
+                    lines.append('uframe_async_stage_seconds_bucket{{{:s},le="{:s}"}} {:d}'.format(labels, le, total))
+                lines.append('uframe_async_stage_seconds_sum{{{:s}}} {:f}'.format(labels, stats.seconds))
+                lines.append('uframe_async_stage_seconds_count{{{:s}}} {:d}'.format(labels, stats.count))
+
+            if self.trace_memory:
+                lines.append('# HELP uframe_async_stage_allocated_bytes Net memory allocated per stage (tracemalloc).')
+                lines.append('# TYPE uframe_async_stage_allocated_bytes gauge')
+                for ((stage, host), stats) in items:
+                    lines.append('uframe_async_stage_allocated_bytes{{{:s}}} {:d}'.format(_labels(stage, host), stats.allocated))
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, metrics_file):
+        '''Atomically write the metrics to metrics_file: a Prometheus textfile if
+        it ends in .prom, otherwise the JSON summary.'''
+
+        if metrics_file.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+
+        try:
+            (fd, tmp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(metrics_file)), suffix='.tmp')
+            with os.fdopen(fd, 'w') as fid:
+                fid.write(text)
+            # node_exporter reads textfiles with 0644 permissions
+            os.chmod(tmp_file, 0o644)
+            os.replace(tmp_file, metrics_file)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to write metrics: {:s} ({:s})\n'.format(metrics_file, str(e)))
+
+    def dump_profiles(self, profile_prefix):
+        '''Write the combined cProfile statistics of each profiled stage to
+        profile_prefix.STAGE.prof.  Returns the files written.'''
+
+        with self._lock:
+            profiles = dict(self._profiles)
+
+        import pstats
+
+        profile_files = []
+        for (stage, stage_profiles) in sorted(profiles.items()):
+            stats = pstats.Stats(stage_profiles[0])
+            for profile in stage_profiles[1:]:
+                stats.add(profile)
+            profile_file = '{:s}.{:s}.prof'.format(profile_prefix, stage)
+            stats.dump_stats(profile_file)
+            profile_files.append(profile_file)
+
+        return profile_files
+
+    def export_at_exit(self, metrics_file=None, profile_prefix=None):
+        '''Register an atexit handler that exports the metrics to metrics_file
+        and writes the stage profiles to profile_prefix.'''
+
+        def _export():
+            if metrics_file:
+                self.export(metrics_file)
+            if profile_prefix:
+                self.dump_profiles(profile_prefix)
+
+        atexit.register(_export)
+
+    def _start_profile(self, stage):
+
+        if stage not in self.profile_stages:
+            return None
+
+        import cProfile
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            return None
+
+        return profile
+
+def get_metrics():
+    '''Return the package-level Metrics, creating it on first use.'''
+
+    global _metrics
+
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+
+    return _metrics
+
+def set_metrics(metrics):
+    '''Replace the package-level Metrics.  Returns metrics.'''
+
+    global _metrics
+
+    with _metrics_lock:
+        _metrics = metrics
+
+    return metrics
+
+def configure_metrics(metrics_file=None, profile_stages=None, profile_prefix=None, trace_memory=False):
+    '''Set up the package-level Metrics from script options: export to
+    metrics_file at exit and profile the listed stages, writing the profiles to
+    profile_prefix.STAGE.prof.  Returns the Metrics.'''
+
+    metrics = get_metrics()
+    if profile_stages or trace_memory:
+        metrics.enable_profiling(profile_stages, memory=trace_memory)
+    if metrics_file or (profile_stages and profile_prefix):
+        metrics.export_at_exit(metrics_file, profile_prefix if profile_stages else None)
+
+    return metrics
+
+def add_metrics_arguments(arg_parser):
+    '''Add the --metrics, --profile, --profile-prefix and --trace-memory options
+    to arg_parser.'''
+
+    arg_parser.add_argument('--metrics',
+        dest='metrics',
+        help='Write per-stage metrics to this file at exit: a Prometheus textfile if it ends in .prom, otherwise JSON')
+    arg_parser.add_argument('--profile',
+        dest='profile',
+        help='Comma separated stages to run under cProfile (ie: submit,download)')
+    arg_parser.add_argument('--profile-prefix',
+        dest='profile_prefix',
+        default='uframe_async',
+        help='Profiles are written to PROFILE_PREFIX.STAGE.prof (default: uframe_async)')
+    arg_parser.add_argument('--trace-memory',
+        dest='trace_memory',
+        action='store_true',
+        help='Record the memory allocated in each stage with tracemalloc')
+
+def configure_metrics_from_args(args):
+    '''configure_metrics using the options added by add_metrics_arguments.'''
+
+    profile_stages = None
+    if args.profile:
+        profile_stages = [stage.strip() for stage in args.profile.split(',') if stage.strip()]
+
+    return configure_metrics(metrics_file=args.metrics,
+        profile_stages=profile_stages,
+        profile_prefix=args.profile_prefix,
+        trace_memory=args.trace_memory)
+
+def _host(url):
+
+    if not url:
+        return ''
+    if '://' not in url:
+        return url
+
+    return urlsplit(url).netloc
+
+def _labels(stage, host):
+
+    return 'stage="{:s}",host="{:s}"'.format(_escape(stage), _escape(host))
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+import queue
+import re
+import sys
+import threading
+from requests.exceptions import RequestException
+from uframe_async import send_async_request
+from uframe_async.hyrax import parse_hyrax_parent_url, parse_hyrax_child_url, download_hyrax_nc_from_url, timestamp_nc_files, DOWNLOAD_WORKERS, DOWNLOAD_BUFFER_SIZE
+from uframe_async.poller import RequestPoller, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+from uframe_async.session import get_session
+
+# Default maximum number of items waiting between two stages
+PIPELINE_QUEUE_SIZE = 64
+
+# Marks the end of a stage queue
+_DONE = object()
+
+class AsyncRequestPipeline(object):
+    '''Submit, poll, download and timestamp asynchronous UFrame requests as one
+    pipeline of concurrent stages connected by bounded queues:
+
+        submit -> poll -> list -> download -> timestamp
+
+    A request is polled as soon as it has been submitted, the NetCDF files of a
+    request are listed and downloaded the moment its status.txt reports
+    complete, and each file is renamed with its time coverage as soon as it
+    lands.  netCDF4 is not thread-safe, so the timestamp_workers threads read
+    one file header at a time and only overlap the renames and quarantines.  A full queue blocks the stage feeding it, so memory stays bounded
+    however many requests are run.
+
+    The optional callbacks are called from the stage threads:
+    on_submitted(status) after each successful submission,
+    on_complete(request_meta) when a request completes and
+    on_downloaded(request_meta, nc_files, failed) once every file of a request
+    has been downloaded (and renamed if timestamp=True); failed is the number of
+    files that could not be downloaded.  If store (a RequestStore) is given the
+    request state is recorded in it as the requests move through the stages, and
+    if cache (a DownloadCache) is given unchanged files are not downloaded
+    again.'''
+
+    def __init__(self, destdir, submit_workers=4, poll_concurrency=16, download_workers=DOWNLOAD_WORKERS, timestamp=True, timestamp_workers=1, quarantine_dir=None, queue_size=PIPELINE_QUEUE_SIZE, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, timeout=120, time_check=True, session=None, store=None, on_submitted=None, on_complete=None, on_downloaded=None, buffer_size=DOWNLOAD_BUFFER_SIZE, cache=None):
+
+        self.destdir = destdir
+        self.submit_workers = submit_workers
+        self.download_workers = download_workers
+        self.timestamp = timestamp
+        self.timestamp_workers = timestamp_workers
+        self.quarantine_dir = quarantine_dir
+        self.timeout = timeout
+        self.time_check = time_check
+        self.session = session
+        self.store = store
+        self.on_submitted = on_submitted
+        self.on_complete = on_complete
+        self.on_downloaded = on_downloaded
+        self.buffer_size = buffer_size
+        self.cache = cache
+
+        self.stats = {'submitted' : 0,
+            'submit_failed' : 0,
+            'completed' : 0,
+            'files_downloaded' : 0,
+            'files_failed' : 0,
+            'requests_downloaded' : 0}
+
+        self._submit_queue = queue.Queue(maxsize=queue_size)
+        self._list_queue = queue.Queue(maxsize=queue_size)
+        self._download_queue = queue.Queue(maxsize=queue_size)
+        self._timestamp_queue = queue.Queue(maxsize=queue_size)
+        self._poller = RequestPoller(self._request_complete,
+            concurrency=poll_concurrency,
+            min_interval=min_interval,
+            max_interval=max_interval,
+            session=session)
+
+        # Files still outstanding for each request being downloaded
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self, urls, queued=None, completed=None):
+        '''Run the request urls through every stage and return when all of them
+        have been downloaded or stop was called.  queued and completed are
+        optional request metadata dictionaries (ie: request CSV rows) of
+        previously submitted requests that still need to be polled or
+        downloaded.  Returns the pipeline stats.'''
+
+        if self.session is None:
+            self.session = get_session()
+
+        submitters = self._start(self._submit_worker, self.submit_workers, 'submit')
+        poller = self._start(self._poll_worker, 1, 'poll')
+        listers = self._start(self._list_worker, self.download_workers, 'list')
+        downloaders = self._start(self._download_worker, self.download_workers, 'download')
+        timestampers = self._start(self._timestamp_worker, self.timestamp_workers, 'timestamp')
+
+        for request_meta in (completed or []):
+            if self._stop_event.is_set():
+                break
+            self._list_queue.put(request_meta)
+        for request_meta in (queued or []):
+            self._poller.add(request_meta)
+
+        for url in urls:
+            if self._stop_event.is_set():
+                break
+            self._submit_queue.put(url)
+
+        # Shut the stages down in order, each once everything upstream of it
+        # has drained
+        self._finish(self._submit_queue, submitters)
+        self._poller.close()
+        self._join(poller)
+        self._finish(self._list_queue, listers)
+        self._finish(self._download_queue, downloaders)
+        self._finish(self._timestamp_queue, timestampers)
+
+        return self.stats
+
+    def stop(self):
+        '''Stop submitting and polling.  Requests already complete finish
+        downloading before run returns.'''
+
+        self._stop_event.set()
+        self._poller.stop()
+
+    def pending(self):
+        '''Number of submitted requests that have not yet completed.'''
+
+        return self._poller.pending()
+
+    def _start(self, target, num_workers, name):
+
+        threads = []
+        for i in range(max(1, num_workers)):
+            thread = threading.Thread(target=self._worker_loop, args=(target,), name='{:s}-{:d}'.format(name, i), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        return threads
+
+    def _finish(self, stage_queue, threads):
+
+        for thread in threads:
+            stage_queue.put(_DONE)
+        self._join(threads)
+
+    def _join(self, threads):
+
+        for thread in threads:
+            thread.join()
+
+    def _worker_loop(self, target):
+
+        # The poll stage runs the poller rather than reading a queue
+        if target == self._poll_worker:
+            target()
+            return
+
+        stage_queue = {self._submit_worker : self._submit_queue,
+            self._list_worker : self._list_queue,
+            self._download_worker : self._download_queue,
+            self._timestamp_worker : self._timestamp_queue}[target]
+        while True:
+            item = stage_queue.get()
+            if item is _DONE:
+                return
+            try:
+                target(item)
+            except Exception as e:
+                sys.stderr.write('Pipeline {:s} failed: {:s}\n'.format(threading.current_thread().name, str(e)))
+                sys.stderr.flush()
+
+    def _submit_worker(self, url):
+
+        if self._stop_event.is_set():
+            return
+
+        status = send_async_request(url, timeout=self.timeout, time_check=self.time_check, session=self.session)
+        if not status or not status.get('requestUUID'):
+            self._count('submit_failed')
+            return
+
+        self._count('submitted')
+        if self.store:
+            self.store.add_request(status)
+        if self.on_submitted:
+            self.on_submitted(status)
+
+        self._poller.add(status)
+
+    def _poll_worker(self):
+
+        self._poller.run(wait_for_close=True)
+
+    def _request_complete(self, request_meta):
+
+        self._count('completed')
+        if self.store:
+            self.store.mark_complete(request_meta.get('requestUUID'), request_meta['completion_time'])
+        if self.on_complete:
+            self.on_complete(request_meta)
+
+        # Blocks the poller while the download stages are backed up
+        self._list_queue.put(request_meta)
+
+    def _list_worker(self, request_meta):
+
+        hyrax_url = hyrax_url_from_output_url(request_meta.get('outputURL') or '')
+        key = request_meta.get('requestUUID') or hyrax_url
+        with self._lock:
+            # Hold the request open until the listing is done so that it is not
+            # reported finished while files are still being listed
+            self._requests[key] = {'request_meta' : request_meta, 'remaining' : 1, 'nc_files' : [], 'failed' : 0}
+
+        # Every directory that fails to list, and a listing that finds no
+        # files, counts as a failure so the request is not marked downloaded
+        # with files missing
+        num_files = 0
+        num_failed = 0
+        try:
+            for nc_dir in parse_hyrax_parent_url(hyrax_url, session=self.session):
+                try:
+                    nc_urls = parse_hyrax_child_url(nc_dir, session=self.session)
+                except RequestException as e:
+                    sys.stderr.write('Failed to list Hyrax directory: {:s} ({:s})\n'.format(nc_dir, str(e)))
+                    num_failed += 1
+                    continue
+                for nc_url in nc_urls:
+                    with self._lock:
+                        self._requests[key]['remaining'] += 1
+                    self._download_queue.put((key, nc_url))
+                    num_files += 1
+        except RequestException as e:
+            sys.stderr.write('Failed to list Hyrax directory: {:s} ({:s})\n'.format(hyrax_url, str(e)))
+            num_failed += 1
+        finally:
+            if not num_files and not num_failed:
+                sys.stderr.write('No NetCDF urls found: {:s}\n'.format(hyrax_url))
+                num_failed = 1
+            with self._lock:
+                self._requests[key]['failed'] += num_failed
+            self._file_done(key, None)
+
+    def _download_worker(self, item):
+
+        (key, nc_url) = item
+        nc_file = download_hyrax_nc_from_url(nc_url, self.destdir, session=self.session, buffer_size=self.buffer_size, cache=self.cache)
+        if not nc_file:
+            self._count('files_failed')
+            self._file_done(key, None, failed=True)
+            return
+
+        self._count('files_downloaded')
+        if not self.timestamp:
+            self._file_done(key, nc_file)
+            return
+
+        self._timestamp_queue.put((key, nc_file))
+
+    def _timestamp_worker(self, item):
+
+        (key, nc_file) = item
+        ts_nc_files = timestamp_nc_files([nc_file], quarantine_dir=self.quarantine_dir, cache=self.cache)
+        if not ts_nc_files:
+            self._file_done(key, None, failed=True)
+            return
+
+        self._file_done(key, ts_nc_files[0])
+
+    def _file_done(self, key, nc_file, failed=False):
+
+        with self._lock:
+            request = self._requests[key]
+            request['remaining'] -= 1
+            if nc_file:
+                request['nc_files'].append(nc_file)
+            if failed:
+                request['failed'] += 1
+            if request['remaining']:
+                return
+            del self._requests[key]
+
+        self._count('requests_downloaded')
+        request_meta = request['request_meta']
+        # Requests with missing files are left complete so they can be retried
+        if self.store and not request['failed'] and request_meta.get('requestUUID'):
+            self.store.mark_downloaded(request_meta['requestUUID'])
+        if self.on_downloaded:
+            self.on_downloaded(request_meta, sorted(request['nc_files']), request['failed'])
+
+    def _count(self, name):
+
+        with self._lock:
+            self.stats[name] += 1
+
+def hyrax_url_from_output_url(output_url):
+    '''Return the Hyrax contents.html url of the request results for the
+    THREDDS catalog outputURL returned when the request was submitted.'''
+
+    hyrax_url = re.sub('8090/thredds/catalog/ooi/_nouser',
+        '8080/opendap/hyrax/async_results/_nouser',
+        output_url)
+
+    return re.sub('catalog.html$', 'contents.html', hyrax_url)
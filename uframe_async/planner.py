@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import datetime
+import hashlib
+import sys
+from collections import namedtuple
+from dateutil import parser
+from uframe_async.metadata import get_metadata_cache
+from uframe_async.urls import AsyncRequestUrl, parse_async_url
+
+# Columns written for each planned chunk
+PLAN_COLUMNS = ['group_id',
+    'chunk',
+    'num_chunks',
+    'instrument',
+    'stream',
+    'beginDT',
+    'endDT',
+    'request_url']
+
+class PlannedRequest(namedtuple('PlannedRequest', PLAN_COLUMNS)):
+    '''One time-window chunk of a larger asynchronous request.  Chunks split from
+    the same request share group_id and are numbered 0 to num_chunks - 1.'''
+
+    __slots__ = ()
+
+def build_async_url(server_url, instrument, telemetry, stream, beginDT, endDT, user=None, data_format='application/netcdf'):
+    '''Build an asynchronous request url for the subsite-node-sensor reference
+    designator instrument.  server_url is the sensor inventory root (ie:
+    http://host:12576/sensor/inv).  beginDT and endDT may be datetimes or
+    formatted timestamps.'''
+
+    (subsite, node, sensor) = instrument.split('-', 2)
+    url = '{:s}/{:s}/{:s}/{:s}/{:s}/{:s}?beginDT={:s}&endDT={:s}&format={:s}&limit=-1'.format(server_url.rstrip('/'),
+        subsite,
+        node,
+        sensor,
+        telemetry,
+        stream,
+        format_dt(beginDT),
+        format_dt(endDT),
+        data_format)
+    if user:
+        url = '{:s}&user={:s}'.format(url, user)
+
+    return url
+
+def plan_async_requests(url, num_chunks=None, chunk_days=None, clip=True, session=None, metadata_cache=None):
+    '''Split the asynchronous request url into time-window chunks and return a
+    list of PlannedRequests.  Specify either num_chunks (equal chunks) or
+    chunk_days (chunks of at most chunk_days days).  If clip=True the request
+    window is first clipped to the stream_beginDT/stream_endDT reported by the
+    stream metadata, so no chunks are spent on times without data.  Returns an
+    empty list if the url cannot be parsed or the window is empty.'''
+
+    request = url
+    if not isinstance(request, AsyncRequestUrl):
+        request = parse_async_url(url)
+    if not request or not request.beginDT or not request.endDT:
+        sys.stderr.write('Invalid asynchronous request url: {:s}\n'.format(str(url)))
+        return []
+
+    dt0 = _naive_utc(parser.parse(request.beginDT))
+    dt1 = _naive_utc(parser.parse(request.endDT))
+
+    if clip:
+        bounds = stream_time_bounds(request, session=session, metadata_cache=metadata_cache)
+        if bounds:
+            dt0 = max(dt0, bounds[0])
+            dt1 = min(dt1, bounds[1])
+
+    if dt0 >= dt1:
+        sys.stderr.write('No stream data in request window: {:s}\n'.format(request.url))
+        return []
+
+    windows = split_time_window(dt0, dt1, num_chunks=num_chunks, chunk_days=chunk_days)
+
+    group_id = hashlib.sha1(request.url.encode('utf-8')).hexdigest()[:12]
+    planned = []
+    for (i, (t0, t1)) in enumerate(windows):
+        beginDT = format_dt(t0)
+        endDT = format_dt(t1)
+        planned.append(PlannedRequest(group_id,
+            i,
+            len(windows),
+            request.instrument,
+            request.stream,
+            beginDT,
+            endDT,
+            replace_time_window(request, beginDT, endDT)))
+
+    return planned
+
+def split_time_window(dt0, dt1, num_chunks=None, chunk_days=None):
+    '''Split the interval dt0 to dt1 into contiguous (begin, end) datetime tuples,
+    either num_chunks equal chunks or chunks of at most chunk_days days.'''
+
+    span = dt1 - dt0
+    if chunk_days:
+        chunk = datetime.timedelta(days=chunk_days)
+        num_chunks = max(1, int(-(-span.total_seconds() // chunk.total_seconds())))
+    elif not num_chunks or num_chunks < 1:
+        num_chunks = 1
+
+    step = span / num_chunks
+    windows = []
+    for i in range(num_chunks):
+        t0 = dt0 + step * i
+        t1 = dt1 if i == num_chunks - 1 else dt0 + step * (i + 1)
+        windows.append((t0, t1))
+
+    return windows
+
+def stream_time_bounds(request, session=None, metadata_cache=None):
+    '''Return the (stream_beginDT, stream_endDT) datetimes of the request stream
+    from the metadata/times cache, or None if unavailable.'''
+
+    if not request.metadata_prefix:
+        return None
+
+    if metadata_cache is None:
+        metadata_cache = get_metadata_cache()
+
+    metadata = metadata_cache.get(request.metadata_prefix, session=session)
+    if not metadata:
+        return None
+
+    for m in metadata:
+        if m.get('stream') == request.stream:
+            return (_naive_utc(parser.parse(m['beginTime'])), _naive_utc(parser.parse(m['endTime'])))
+
+    sys.stderr.write('Invalid stream: {:s}\n'.format(request.stream))
+
+    return None
+
+def format_dt(dt):
+    '''Format dt as a UFrame request timestamp (ie: 2016-01-01T00:00:00.000Z).
+    Strings are returned unchanged.'''
+
+    if isinstance(dt, str):
+        return dt
+
+    return '{:s}.{:03d}Z'.format(dt.strftime('%Y-%m-%dT%H:%M:%S'), dt.microsecond // 1000)
+
+def _naive_utc(dt):
+
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return dt
+
+def replace_time_window(request, beginDT, endDT):
+    '''Return the url of the parsed AsyncRequestUrl request with its beginDT and
+    endDT parameters replaced.  All other parameters are kept in order.'''
+
+    (base, sep, query) = request.url.partition('?')
+    parameters = []
+    for (p, v) in request.parameters:
+        if p == 'beginDT':
+            v = beginDT
+        elif p == 'endDT':
+            v = endDT
+        parameters.append(p if v is None else '{:s}={:s}'.format(p, v))
+
+    return '{:s}?{:s}'.format(base, '&'.join(parameters))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from uframe_async.status import StatusChecker
+
+# Default seconds between the first and second check of a pending request and
+# the ceiling the per-request backoff grows to
+POLL_MIN_INTERVAL = 60
+POLL_MAX_INTERVAL = 3600
+# Maximum seconds run sleeps before checking whether stop was called
+_STOP_CHECK_INTERVAL = 5
+
+def status_url_from_output_url(output_url, tds=False):
+    '''Return the status.txt url for the request outputURL.  Unless tds=True, the
+    THREDDS catalog url is rewritten to point at the Hyrax async results
+    directory.'''
+
+    request_url = output_url
+    # Currently, we can only validate agains hyrax, not tds.
+    if not tds:
+        request_url = re.sub('8090/thredds/catalog/ooi/_nouser',
+            '8080/opendap/hyrax/async_results/_nouser',
+            output_url)
+
+    # Replace the url endpoint to point to the status.txt
+    return re.sub('catalog.html$', 'status.txt', request_url)
+
+class _PollEntry(object):
+    '''Scheduling state for a single pending request.'''
+
+    __slots__ = ('request_meta', 'status_url', 'interval', 'attempts')
+
+    def __init__(self, request_meta, status_url, interval):
+        self.request_meta = request_meta
+        self.status_url = status_url
+        self.interval = interval
+        self.attempts = 0
+
+class RequestPoller(object):
+    '''Resident poller that checks the status.txt of queued asynchronous requests
+    concurrently.  Each request is rescheduled with its own exponential backoff
+    (interval multiplied by backoff after every pending check, capped at
+    max_interval and randomized by +/- jitter).  on_complete(request_meta) is
+    called as soon as a request is seen to be complete, with
+    request_meta['completion_time'] filled in.  Requests may be added from other
+    threads while run is polling.  The checks are made by checker (default: a
+    StatusChecker using session), which sends conditional requests for statuses
+    it has already seen and batches its log output.'''
+
+    def __init__(self, on_complete, concurrency=16, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, backoff=2.0, jitter=0.25, tds=False, session=None, checker=None):
+
+        self.on_complete = on_complete
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.tds = tds
+        self.session = session
+        self.checker = checker
+        if checker is None:
+            self.checker = StatusChecker(session=session)
+
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._closed = False
+
+    def add(self, request_meta, delay=0):
+        '''Queue request_meta (a dictionary containing at least outputURL) to be
+        checked after delay seconds.  Returns False if the request has no
+        outputURL.'''
+
+        if not request_meta.get('outputURL'):
+            sys.stderr.write('No destination url specified: {:s}\n'.format(request_meta.get('request_url') or ''))
+            sys.stderr.flush()
+            return False
+
+        status_url = status_url_from_output_url(request_meta['outputURL'], tds=self.tds)
+        entry = _PollEntry(request_meta, status_url, self.min_interval)
+        self._schedule(entry, delay)
+        self._wake_event.set()
+
+        return True
+
+    def pending(self):
+        '''Number of requests that have not yet completed.'''
+
+        return len(self._queue)
+
+    def stop(self):
+        '''Ask run to return after the checks currently in flight finish.'''
+
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def close(self):
+        '''Tell a run(wait_for_close=True) that no more requests will be added,
+        so it returns once the queued requests have completed.'''
+
+        self._closed = True
+        self._wake_event.set()
+
+    def run(self, wait_for_close=False):
+        '''Poll until every queued request has completed or stop is called.  If
+        wait_for_close=True, keep waiting for requests added from other threads
+        until close is called.  Returns the number of requests still pending.'''
+
+        self._stop_event.clear()
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while (self._queue or in_flight or (wait_for_close and not self._closed)) and not self._stop_event.is_set():
+
+                # Start every check that is due, up to the concurrency limit
+                now = time.monotonic()
+                with self._lock:
+                    while self._queue and len(in_flight) < self.concurrency and self._queue[0][0] <= now:
+                        (due, seq, entry) = heapq.heappop(self._queue)
+                        future = executor.submit(self.checker.check, entry.status_url)
+                        in_flight[future] = entry
+
+                # Sleep until a check finishes or the next check is due, waking
+                # up periodically to notice stop
+                timeout = _STOP_CHECK_INTERVAL
+                with self._lock:
+                    if self._queue and len(in_flight) < self.concurrency:
+                        timeout = min(timeout, max(0, self._queue[0][0] - time.monotonic()))
+                if not in_flight:
+                    self.checker.flush()
+                    # Wake early if a request is added or stop/close is called
+                    self._wake_event.wait(timeout)
+                    self._wake_event.clear()
+                    continue
+
+                (done, not_done) = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = in_flight.pop(future)
+                    self._handle_result(entry, future)
+
+            # Let in-flight checks finish so completions are not lost
+            for (future, entry) in in_flight.items():
+                self._handle_result(entry, future)
+
+        self.checker.flush()
+
+        return len(self._queue)
+
+    def _handle_result(self, entry, future):
+
+        entry.attempts += 1
+        try:
+            completion_time = future.result()
+        except Exception as e:
+            self.checker.log('Status check failed: {:s} ({:s})\n'.format(entry.status_url, str(e)))
+            completion_time = None
+
+        if completion_time:
+            entry.request_meta['completion_time'] = completion_time
+            self.on_complete(entry.request_meta)
+            return
+
+        self._schedule(entry, entry.interval)
+        entry.interval = min(self.max_interval, entry.interval * self.backoff)
+
+    def _schedule(self, entry, delay):
+
+        if delay and self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        with self._lock:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), entry))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+# Status codes treated as the server asking us to slow down
+BACKOFF_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Default ceiling of the adaptive concurrency limit, relative to its start
+MAX_CONCURRENCY_FACTOR = 4
+
+class AdaptiveRateLimiter(object):
+    '''Token bucket rate limiter with an AIMD (additive increase, multiplicative
+    decrease) controlled request rate and concurrency limit.  While responses are
+    healthy the rate grows by rate_increase requests/s and the concurrency limit
+    by about one slot per round of requests.  On an error or a latency spike
+    (latency above latency_factor times the smoothed baseline) both are
+    multiplied by decrease, at most once per cooldown seconds.
+
+    Use acquire() before each request and release() after it, or the limiter as
+    a context manager via limiter.request().'''
+
+    def __init__(self, rate=10.0, concurrency=8, min_rate=0.5, max_rate=200.0, min_concurrency=1, max_concurrency=64, rate_increase=0.5, decrease=0.5, latency_factor=3.0, cooldown=5.0):
+
+        self.rate = float(rate)
+        self.concurrency = float(concurrency)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.rate_increase = rate_increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+
+        self.baseline_latency = None
+        self.in_flight = 0
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_decreases = 0
+
+        self._tokens = min(self.rate, self.concurrency)
+        self._last_fill = time.monotonic()
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        '''Block until a token and a concurrency slot are available.  Returns the
+        request start time to pass to release.'''
+
+        with self._cond:
+            while True:
+                self._fill()
+                if self.in_flight < int(self.concurrency) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.in_flight += 1
+                    return time.monotonic()
+
+                # Wait for a release or for the next token
+                wait = None
+                if self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                self._cond.wait(wait)
+
+    def release(self, start_time, error=False):
+        '''Release the slot taken by acquire and adjust the rate and concurrency.
+        Set error=True if the request failed or the server signalled overload.'''
+
+        latency = time.monotonic() - start_time
+        with self._cond:
+            self.in_flight -= 1
+            self.num_requests += 1
+
+            spike = False
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            elif latency > self.baseline_latency * self.latency_factor:
+                spike = True
+            else:
+                # Only healthy latencies move the baseline so a slowdown is
+                # not absorbed into it
+                self.baseline_latency = 0.9 * self.baseline_latency + 0.1 * latency
+
+            if error:
+                self.num_errors += 1
+
+            if error or spike:
+                self._decrease()
+            else:
+                self.rate = min(self.max_rate, self.rate + self.rate_increase)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / max(1.0, self.concurrency))
+
+            self._cond.notify_all()
+
+    def request(self):
+        '''Context manager that acquires on entry and releases on exit.  Call
+        error() on the returned object to report a failed request; exceptions
+        raised inside the block are reported automatically.'''
+
+        return _LimitedRequest(self)
+
+    def stats(self):
+        '''Return a dictionary of the current controller state.'''
+
+        with self._cond:
+            return {'rate' : self.rate,
+                'concurrency' : int(self.concurrency),
+                'in_flight' : self.in_flight,
+                'baseline_latency' : self.baseline_latency,
+                'requests' : self.num_requests,
+                'errors' : self.num_errors,
+                'decreases' : self.num_decreases}
+
+    def _decrease(self):
+
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+
+        self._last_decrease = now
+        self.num_decreases += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+        self._tokens = min(self._tokens, self.rate)
+
+    def _fill(self):
+
+        now = time.monotonic()
+        # Allow a burst of up to one second of requests
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._last_fill) * self.rate)
+        self._last_fill = now
+
+class _LimitedRequest(object):
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.failed = False
+
+    def error(self):
+        self.failed = True
+
+    def __enter__(self):
+        self.start_time = self.limiter.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.limiter.release(self.start_time, error=self.failed or exc_type is not None)
+
+class BandwidthLimiter(object):
+    '''Token bucket capping the combined transfer rate of every download sharing
+    it at rate bytes/s, with bursts of up to burst bytes (default: one second of
+    transfer).  Call consume(n) after reading each n bytes; it sleeps for as long
+    as the transfer is ahead of the cap.'''
+
+    def __init__(self, rate, burst=None):
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+        self._tokens = self.burst
+        self._last_fill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes):
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_fill) * self.rate)
+            self._last_fill = now
+            # Go into debt and make the caller wait it off, so concurrent
+            # downloads queue up behind each other
+            self._tokens -= num_bytes
+            wait = -self._tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+class RateLimitedAdapter(HTTPAdapter):
+    '''requests transport adapter that passes every request through an
+    AdaptiveRateLimiter for the request host.  Responses with a
+    BACKOFF_STATUS_CODES status and connection errors count as errors.  Limiters
+    are created per host with limiter_kwargs, or a single shared limiter may be
+    given.'''
+
+    def __init__(self, limiter=None, limiter_kwargs=None, **kwargs):
+
+        HTTPAdapter.__init__(self, **kwargs)
+        self.limiter = limiter
+        self.limiter_kwargs = limiter_kwargs or {}
+        self.limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def get_limiter(self, url):
+        '''Return the limiter used for url.'''
+
+        if self.limiter is not None:
+            return self.limiter
+
+        host = urlsplit(url).netloc
+        with self._limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = AdaptiveRateLimiter(**self.limiter_kwargs)
+
+        return self.limiters[host]
+
+    def send(self, request, **kwargs):
+
+        limiter = self.get_limiter(request.url)
+        start_time = limiter.acquire()
+        try:
+            response = HTTPAdapter.send(self, request, **kwargs)
+        except Exception:
+            limiter.release(start_time, error=True)
+            raise
+
+        limiter.release(start_time, error=response.status_code in BACKOFF_STATUS_CODES)
+
+        return response
+
+def add_rate_limit_arguments(arg_parser):
+    '''Add the --rate and --max-concurrency options to arg_parser.'''
+
+    arg_parser.add_argument('--rate',
+        dest='rate',
+        type=float,
+        help='Adaptively limit requests to each host, starting at RATE requests/s.  The rate and concurrency grow while responses are healthy and are halved on errors or latency spikes')
+    arg_parser.add_argument('--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        help='Maximum number of requests in flight to a host that the adaptive concurrency limit can grow to (default: {:d} times the starting concurrency)'.format(MAX_CONCURRENCY_FACTOR))
+
+def rate_limit_from_args(args, concurrency):
+    '''Return the AdaptiveRateLimiter keyword arguments for the options added by
+    add_rate_limit_arguments, starting at concurrency requests in flight, or None
+    if --rate was not specified.'''
+
+    if not args.rate:
+        return None
+
+    return {'rate' : args.rate,
+        'concurrency' : concurrency,
+        'max_concurrency' : max(concurrency, args.max_concurrency or concurrency * MAX_CONCURRENCY_FACTOR)}
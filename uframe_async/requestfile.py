@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import csv
+import json
+import os
+import sys
+
+# Request file formats: CSV with a header row, or one json object per line
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+REQUEST_FORMATS = (FORMAT_CSV, FORMAT_JSONL)
+
+_JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+
+def request_file_format(filename, fmt=None):
+    '''Return fmt if specified, otherwise the format of filename from its
+    extension: FORMAT_JSONL for .jsonl and .ndjson files, FORMAT_CSV for
+    anything else (including STDIN/STDOUT).'''
+
+    if fmt:
+        return fmt
+    if filename and filename.lower().endswith(_JSONL_EXTENSIONS):
+        return FORMAT_JSONL
+
+    return FORMAT_CSV
+
+class RequestReader(object):
+    '''Iterates over the requests in the open request file fid one row at a
+    time, yielding a dictionary for each, so memory use does not grow with the
+    size of the file.  For CSV the keys are the header columns, in order, and
+    are also available as cols; JSONL rows are yielded as parsed and cols is
+    None.  Blank lines and rows starting with # are skipped.  Unparseable JSONL
+    lines are reported to stderr and skipped.'''
+
+    def __init__(self, fid, fmt=FORMAT_CSV):
+
+        self.fid = fid
+        self.fmt = fmt
+        self.cols = None
+
+        self._csv_reader = None
+        if fmt == FORMAT_CSV:
+            self._csv_reader = csv.reader(fid)
+            self.cols = next(self._csv_reader, None) or []
+
+    def __iter__(self):
+
+        if self._csv_reader:
+            return self._iter_csv()
+
+        return self._iter_jsonl()
+
+    def close(self):
+        '''Close fid, unless it is STDIN.'''
+
+        if self.fid is not sys.stdin:
+            self.fid.close()
+
+    def _iter_csv(self):
+
+        cols = self.cols
+        num_cols = len(cols)
+        for r in self._csv_reader:
+            if not r or r[0].startswith('#'):
+                continue
+            # Short rows get empty values for the missing columns
+            if len(r) < num_cols:
+                r = r + [''] * (num_cols - len(r))
+            yield dict(zip(cols, r))
+
+    def _iter_jsonl(self):
+
+        for (line_number, line) in enumerate(self.fid, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                sys.stderr.write('Skipping invalid JSONL line {:d}: {:s}\n'.format(line_number, str(e)))
+                continue
+            if not isinstance(row, dict):
+                sys.stderr.write('Skipping JSONL line {:d}: not an object\n'.format(line_number))
+                continue
+            yield row
+
+class RequestWriter(object):
+    '''Writes request dictionaries to the open file fid one row at a time.  Each
+    row is flushed as it is written (unless flush=False), so the rows already
+    processed survive if the run is interrupted.  cols are the CSV columns, in
+    order (default: the keys of the first row written); for JSONL, cols (if
+    specified) selects the keys written.  The CSV header is written first unless
+    header=False, ie: when appending to a file that already has one.'''
+
+    def __init__(self, fid, fmt=FORMAT_CSV, cols=None, header=True, flush=True):
+
+        self.fid = fid
+        self.fmt = fmt
+        self.cols = cols
+        self.header = header
+        self.flush = flush
+        self.count = 0
+
+        self._csv_writer = None
+        if fmt == FORMAT_CSV:
+            self._csv_writer = csv.writer(fid)
+            if cols is not None:
+                self._write_header()
+
+    def write(self, row):
+        '''Write the request dictionary row.'''
+
+        if self._csv_writer:
+            if self.cols is None:
+                self.cols = list(row.keys())
+                self._write_header()
+            self._csv_writer.writerow([row.get(k) for k in self.cols])
+        else:
+            if self.cols is not None:
+                row = {k : row.get(k) for k in self.cols}
+            self.fid.write('{:s}\n'.format(json.dumps(row)))
+
+        self.count += 1
+        if self.flush:
+            self.fid.flush()
+
+    def write_rows(self, rows):
+        '''Write every request dictionary in the iterable rows as it is
+        produced.  Returns the number of rows written.'''
+
+        count = 0
+        for row in rows:
+            self.write(row)
+            count += 1
+
+        return count
+
+    def close(self):
+        '''Close fid, unless it is STDOUT.'''
+
+        if self.fid is not sys.stdout:
+            self.fid.close()
+
+    def _write_header(self):
+
+        if self.header:
+            self._csv_writer.writerow(self.cols)
+            self.header = False
+
+def open_request_reader(filename, fmt=None):
+    '''Return a RequestReader for filename ('-' for STDIN) in fmt (default: from
+    the extension).'''
+
+    fmt = request_file_format(filename, fmt)
+    if not filename or filename == '-':
+        return RequestReader(sys.stdin, fmt)
+
+    return RequestReader(open(filename, 'r'), fmt)
+
+def open_request_writer(filename=None, fmt=None, cols=None):
+    '''Return a RequestWriter appending to filename, or writing to STDOUT if
+    filename is not specified, in fmt (default: from the extension).  The CSV
+    header is only written if the file is new or empty.'''
+
+    fmt = request_file_format(filename, fmt)
+    if not filename or filename == '-':
+        return RequestWriter(sys.stdout, fmt, cols=cols)
+
+    fid = open(filename, 'a')
+    header = not os.path.getsize(filename)
+
+    return RequestWriter(fid, fmt, cols=cols, header=header)
+
+def add_request_file_arguments(arg_parser, input_format=True, output=True):
+    '''Add the request file format (unless input_format=False) and output
+    (unless output=False) options to arg_parser.'''
+
+    if input_format:
+        arg_parser.add_argument('-f', '--format',
+            dest='format',
+            choices=REQUEST_FORMATS,
+            help='Format of the request file (default: jsonl for .jsonl/.ndjson files, otherwise csv)')
+    if not output:
+        return
+    arg_parser.add_argument('-o', '--output',
+        dest='output',
+        help='Append the requests to this file, one at a time as they are processed, instead of writing them to STDOUT')
+    arg_parser.add_argument('--output-format',
+        dest='output_format',
+        choices=REQUEST_FORMATS,
+        help='Format of the requests written (default: from the --output extension, otherwise the request file format)')
+
+def request_writer_from_args(args, fmt=FORMAT_CSV, cols=None):
+    '''Return a RequestWriter configured from the add_request_file_arguments
+    options.  fmt is the format used if neither --output-format nor --output
+    is specified.'''
+
+    if args.output_format:
+        fmt = args.output_format
+    elif args.output:
+        fmt = request_file_format(args.output)
+
+    return open_request_writer(args.output, fmt=fmt, cols=cols)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
+from uframe_async.urls import parse_async_url
+
+# Default number of retries after the first attempt and the backoff between them
+RETRIES = 3
+RETRY_BACKOFF = 2.0
+RETRY_MAX_BACKOFF = 60.0
+# Default consecutive failures before a host's circuit opens and seconds it stays
+# open before a trial request is let through
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 60.0
+
+# Responses retried for idempotent requests
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Responses that mean the server refused the request without acting on it, and
+# so are also safe to retry for a data request submission
+REFUSED_STATUS_CODES = (429, 503)
+
+class CircuitOpenError(ConnectionError):
+    '''Raised instead of sending a request to a host whose circuit breaker is
+    open.'''
+
+class RetryPolicy(object):
+    '''Retry and circuit breaker settings.  A failed request is retried up to
+    retries times, waiting backoff * 2 ** attempt seconds (at most max_backoff,
+    varied by +/- jitter and never less than a Retry-After header) between
+    attempts.  Only idempotent requests are retried after the request may have
+    reached the server; asynchronous data request submissions, which queue a new
+    request every time they are received, are only retried if the connection
+    could not be made or the server refused them (REFUSED_STATUS_CODES).  After
+    breaker_threshold consecutive failures to a host its circuit opens and
+    requests fail immediately with CircuitOpenError for breaker_reset_timeout
+    seconds.  Set breaker_threshold=None to disable the breaker.'''
+
+    def __init__(self, retries=RETRIES, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF, jitter=0.25, status_codes=RETRY_STATUS_CODES, breaker_threshold=BREAKER_THRESHOLD, breaker_reset_timeout=BREAKER_RESET_TIMEOUT):
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.status_codes = status_codes
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+
+    def is_idempotent(self, request):
+        '''True if request may be sent more than once without side effects.'''
+
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            return False
+
+        return not is_async_submission(request.url)
+
+    def retry_response(self, request, response):
+        '''True if request should be retried after receiving response.'''
+
+        if self.is_idempotent(request):
+            return response.status_code in self.status_codes
+
+        return response.status_code in REFUSED_STATUS_CODES
+
+    def retry_exception(self, request, e):
+        '''True if request should be retried after it raised e.'''
+
+        if isinstance(e, CircuitOpenError):
+            return False
+
+        if not isinstance(e, (ConnectionError, Timeout)):
+            return False
+
+        if self.is_idempotent(request):
+            return True
+
+        return _not_sent(e)
+
+    def delay(self, attempt, response=None):
+        '''Seconds to wait before retry number attempt (starting at 0).'''
+
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(self.max_backoff, float(retry_after)))
+
+        return delay
+
+class CircuitBreaker(object):
+    '''Consecutive failure circuit breaker for a single host.  The circuit opens
+    after threshold consecutive failures.  Once reset_timeout seconds have passed
+    a single trial request is allowed; success closes the circuit and failure
+    opens it again.'''
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        '''True if a request may be sent now.'''
+
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            # Hold the circuit open for everyone else while the trial request
+            # is in flight.  If its outcome is never recorded another trial is
+            # allowed after reset_timeout
+            self.opened_at = now
+            self._trial = True
+            return True
+
+    def record_success(self):
+
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        '''Record a failure.  Returns True if this failure opened the circuit.'''
+
+        with self._lock:
+            self.failures += 1
+            was_open = self.opened_at is not None
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+            return not was_open and self.opened_at is not None
+
+class RetryAdapter(HTTPAdapter):
+    '''requests transport adapter that retries failed requests according to a
+    RetryPolicy and keeps a CircuitBreaker per host.  The retries and breaker
+    apply to every request made through a session with the adapter mounted.'''
+
+    def __init__(self, retry_policy=None, **kwargs):
+
+        super(RetryAdapter, self).__init__(**kwargs)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def get_breaker(self, url):
+        '''Return the CircuitBreaker for the url host or None if disabled.'''
+
+        if not self.retry_policy.breaker_threshold:
+            return None
+
+        host = urlsplit(url).netloc
+        with self._breakers_lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.retry_policy.breaker_threshold, self.retry_policy.breaker_reset_timeout)
+
+        return self.breakers[host]
+
+    def send(self, request, **kwargs):
+
+        policy = self.retry_policy
+        breaker = self.get_breaker(request.url)
+        attempt = 0
+        while True:
+            if breaker and not breaker.allow():
+                raise CircuitOpenError('Circuit open for {:s}, not sending: {:s}'.format(urlsplit(request.url).netloc, request.url), request=request)
+
+            try:
+                response = super(RetryAdapter, self).send(request, **kwargs)
+            except Exception as e:
+                if breaker and isinstance(e, (ConnectionError, Timeout)):
+                    self._record_failure(breaker, request)
+                if attempt >= policy.retries or not policy.retry_exception(request, e) or (breaker and breaker.is_open):
+                    raise
+                delay = policy.delay(attempt)
+                sys.stderr.write('Retrying in {:0.1f}s ({:s}): {:s}\n'.format(delay, e.__class__.__name__, request.url))
+                sys.stderr.flush()
+            else:
+                if breaker:
+                    if response.status_code >= 500:
+                        self._record_failure(breaker, request)
+                    else:
+                        breaker.record_success()
+                if attempt >= policy.retries or not policy.retry_response(request, response) or (breaker and breaker.is_open):
+                    return response
+                delay = policy.delay(attempt, response)
+                sys.stderr.write('Retrying in {:0.1f}s ({:d} {:s}): {:s}\n'.format(delay, response.status_code, response.reason, request.url))
+                sys.stderr.flush()
+                # Release the connection before waiting
+                response.close()
+
+            attempt += 1
+            time.sleep(delay)
+
+    def _record_failure(self, breaker, request):
+
+        if breaker.record_failure():
+            sys.stderr.write('Circuit opened after {:d} consecutive failures: {:s}\n'.format(breaker.failures, urlsplit(request.url).netloc))
+            sys.stderr.flush()
+
+def is_async_submission(url):
+    '''True if url is an asynchronous data request submission (as opposed to a
+    metadata lookup), which queues a new request on the server each time it is
+    sent.'''
+
+    request = parse_async_url(url)
+
+    return request is not None and request.telemetry != 'metadata' and request.beginDT is not None
+
+def _not_sent(e):
+
+    # The request never reached the server if the connection could not be
+    # established
+    if isinstance(e, ConnectTimeout):
+        return True
+
+    if isinstance(e, ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+
+    return False
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import threading
+import requests
+from uframe_async.ratelimit import AdaptiveRateLimiter, RateLimitedAdapter
+from uframe_async.retry import RetryAdapter, RetryPolicy
+
+# Default number of per-host connection pools cached and the maximum number of
+# keep-alive connections held in each pool
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 16
+
+_session = None
+_session_lock = threading.Lock()
+
+class _RetryRateLimitedAdapter(RetryAdapter, RateLimitedAdapter):
+    '''Retries and circuit breaking around rate limited requests.  Every attempt,
+    including retries, passes through the rate limiter.'''
+
+def create_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, host_pool_sizes=None, rate_limit=None, retry_policy=None):
+    '''Create a requests.Session with keep-alive connection pools.  pool_maxsize
+    sets the number of connections kept open to each host.  host_pool_sizes is an
+    optional dictionary mapping url prefixes (ie: 'http://ooinet.oceanobservatories.org:12576/')
+    to a pool size for that host, overriding pool_maxsize.
+
+    rate_limit enables adaptive rate limiting of every request made through the
+    session: either a dictionary of AdaptiveRateLimiter keyword arguments, used
+    to create one limiter per host, or an AdaptiveRateLimiter shared by all
+    hosts.
+
+    Failed requests are retried, and hosts that keep failing are cut off by a
+    circuit breaker, according to retry_policy (a RetryPolicy, by default
+    RetryPolicy()).  Pass RetryPolicy(retries=0, breaker_threshold=None) to
+    disable both.'''
+
+    session = requests.Session()
+
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+
+    adapter = _create_adapter(pool_connections, pool_maxsize, rate_limit, retry_policy)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # requests uses the longest matching prefix, so these take precedence over
+    # the scheme defaults above
+    if host_pool_sizes:
+        for (prefix, size) in host_pool_sizes.items():
+            session.mount(prefix, _create_adapter(1, size, rate_limit, retry_policy))
+
+    return session
+
+def _create_adapter(pool_connections, pool_maxsize, rate_limit, retry_policy):
+
+    if rate_limit is None:
+        return RetryAdapter(retry_policy=retry_policy,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=False)
+
+    if isinstance(rate_limit, AdaptiveRateLimiter):
+        return _RetryRateLimitedAdapter(retry_policy=retry_policy,
+            limiter=rate_limit,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=False)
+
+    return _RetryRateLimitedAdapter(retry_policy=retry_policy,
+        limiter_kwargs=rate_limit,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=False)
+
+def get_session():
+    '''Return the package-level shared session, creating it with the default
+    pool sizes on first use.'''
+
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+
+    return _session
+
+def set_session(session):
+    '''Replace the package-level shared session with session (ie: one created by
+    create_session or a preconfigured requests.Session).  The previous session,
+    if any, is closed.  Returns the new session.'''
+
+    global _session
+
+    with _session_lock:
+        old_session = _session
+        _session = session
+
+    if old_session is not None and old_session is not session:
+        old_session.close()
+
+    return session
+
+def configure_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, host_pool_sizes=None, rate_limit=None, retry_policy=None):
+    '''Create a new shared session with the specified pool sizes, rate limit and
+    retry policy and install it as the package-level session.  Returns the new
+    session.'''
+
+    return set_session(create_session(pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        host_pool_sizes=host_pool_sizes,
+        rate_limit=rate_limit,
+        retry_policy=retry_policy))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+from requests.exceptions import RequestException
+from uframe_async.metrics import get_metrics, STAGE_POLL
+from uframe_async.session import get_session
+
+# Default number of log messages buffered before they are written to stderr
+STATUS_LOG_BUFFER = 100
+
+class StatusChecker(object):
+    '''Conditional client for the status.txt of asynchronous requests.  The ETag
+    and Last-Modified of each pending status.txt are remembered and the next
+    check is sent with If-None-Match/If-Modified-Since, so an unchanged status
+    costs the server a 304 and no body.  With head=True the status is probed
+    with HEAD first and only fetched if its validators changed (or the server
+    sends none).  If state_file is specified, the validators are loaded from and
+    saved (by save) to that json file so they survive between runs.
+
+    Log messages are buffered and written to stderr log_buffer at a time rather
+    than one write and flush per request; call flush (or save) when done.
+    stats counts the requests sent and how many were answered without a body.
+    check may be called from several threads.'''
+
+    def __init__(self, session=None, head=False, state_file=None, timeout=120, log_pending=True, log_buffer=STATUS_LOG_BUFFER):
+
+        self.session = session
+        self.head = head
+        self.state_file = state_file
+        self.timeout = timeout
+        self.log_pending = log_pending
+        self.log_buffer = log_buffer
+
+        self.stats = Counter()
+        self._validators = {}
+        self._messages = []
+        self._lock = threading.Lock()
+
+        if state_file:
+            self._load()
+
+    def check(self, status_url):
+        '''Check status_url and return the completion time if the request has
+        completed, otherwise None.'''
+
+        session = self.session or get_session()
+
+        with self._lock:
+            validators = self._validators.get(status_url)
+
+        with get_metrics().timer(STAGE_POLL, status_url) as t:
+            try:
+                # Probe the validators without fetching the body
+                if self.head and validators:
+                    r = session.head(status_url, timeout=self.timeout)
+                    self._count('head')
+                    if r.status_code == 200 and _validators(r) == validators:
+                        self._count('unchanged')
+                        return self._pending(status_url)
+                    if r.status_code != 200:
+                        t.error()
+                        return self._invalid(status_url, r)
+
+                headers = {}
+                if validators and not self.head:
+                    (etag, last_modified) = validators
+                    if etag:
+                        headers['If-None-Match'] = etag
+                    if last_modified:
+                        headers['If-Modified-Since'] = last_modified
+                r = session.get(status_url, headers=headers, timeout=self.timeout)
+                self._count('get')
+            except RequestException as e:
+                t.error()
+                self.log('Status check failed: {:s} ({:s})\n'.format(status_url, str(e)))
+                return None
+            t.add_bytes(len(r.content))
+
+            if r.status_code == 304:
+                self._count('unchanged')
+                return self._pending(status_url)
+            if r.status_code != 200:
+                t.error()
+                return self._invalid(status_url, r)
+
+        if r.text != 'complete':
+            # Only pending statuses are remembered: a complete request is not
+            # checked again
+            response_validators = _validators(r)
+            if response_validators != (None, None):
+                with self._lock:
+                    self._validators[status_url] = response_validators
+            return self._pending(status_url)
+
+        self.forget(status_url)
+        self._count('complete')
+
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def forget(self, status_url):
+        '''Drop the validators remembered for status_url.'''
+
+        with self._lock:
+            self._validators.pop(status_url, None)
+
+    def log(self, message):
+        '''Buffer message for stderr, writing the buffer once it is full.'''
+
+        with self._lock:
+            self._messages.append(message)
+            if len(self._messages) < self.log_buffer:
+                return
+            messages = self._messages
+            self._messages = []
+
+        _write_messages(messages)
+
+    def flush(self):
+        '''Write the buffered log messages to stderr.'''
+
+        with self._lock:
+            messages = self._messages
+            self._messages = []
+
+        _write_messages(messages)
+
+    def save(self):
+        '''Flush the log and write the remembered validators to state_file.'''
+
+        self.flush()
+
+        if not self.state_file:
+            return
+
+        with self._lock:
+            entries = [[k, v[0], v[1]] for (k, v) in self._validators.items()]
+
+        # Write to a temporary file and rename it into place so readers never
+        # see a partially written file
+        state_dir = os.path.dirname(os.path.abspath(self.state_file))
+        (fd, tmp_file) = tempfile.mkstemp(dir=state_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fid:
+                json.dump(entries, fid)
+            os.replace(tmp_file, self.state_file)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to write status state {:s}: {:s}\n'.format(self.state_file, str(e)))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _pending(self, status_url):
+
+        if self.log_pending:
+            self.log('Request not yet complete: {:s}\n'.format(status_url))
+
+        return None
+
+    def _invalid(self, status_url, r):
+
+        self.log('Invalid request: {:s} ({:s})\n'.format(status_url, r.reason))
+
+        return None
+
+    def _count(self, name):
+
+        with self._lock:
+            self.stats[name] += 1
+
+    def _load(self):
+
+        if not os.path.isfile(self.state_file):
+            return
+
+        try:
+            with open(self.state_file, 'r') as fid:
+                entries = json.load(fid)
+        except (IOError, ValueError) as e:
+            sys.stderr.write('Ignoring unreadable status state {:s}: {:s}\n'.format(self.state_file, str(e)))
+            return
+
+        for (status_url, etag, last_modified) in entries:
+            self._validators[status_url] = (etag, last_modified)
+
+def _validators(r):
+    return (r.headers.get('ETag'), r.headers.get('Last-Modified'))
+
+def _write_messages(messages):
+
+    if not messages:
+        return
+
+    sys.stderr.write(''.join(messages))
+    sys.stderr.flush()
+
+def add_status_arguments(arg_parser):
+    '''Add the conditional status check options to arg_parser.'''
+
+    arg_parser.add_argument('--head',
+        dest='status_head',
+        action='store_true',
+        help='Probe each status.txt already seen with HEAD and only fetch it if its ETag/Last-Modified changed')
+    arg_parser.add_argument('--status-state',
+        dest='status_state',
+        help='JSON file used to remember the status.txt ETag/Last-Modified of pending requests between runs')
+
+def status_checker_from_args(args, session=None):
+    '''Return a StatusChecker configured from the add_status_arguments options.'''
+
+    return StatusChecker(session=session, head=args.status_head, state_file=args.status_state)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+
+import csv
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import datetime
+from uframe_async.urls import ASYNC_REQUEST_COLUMNS
+from uframe_async.requestfile import open_request_reader
+
+# Request states stored in the status column
+STATUS_QUEUED = 'queued'
+STATUS_COMPLETE = 'complete'
+STATUS_DOWNLOADED = 'downloaded'
+# Request states in the order a request moves through them
+STATUS_ORDER = [STATUS_QUEUED, STATUS_COMPLETE, STATUS_DOWNLOADED]
+
+# Default seconds a worker holds the requests it claims before they may be
+# reclaimed by another worker
+DEFAULT_LEASE_TIME = 600
+# Default number of requests claimed at a time
+DEFAULT_CLAIM_SIZE = 100
+# Default number of failed attempts after which a request is no longer claimed
+DEFAULT_MAX_FAILURES = 3
+
+# Columns kept for every request, in CSV export order
+STORE_COLUMNS = ASYNC_REQUEST_COLUMNS + ['user',
+    'completion_time',
+    'download_time',
+    'status']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    requestUUID TEXT PRIMARY KEY,
+    instrument TEXT,
+    beginDT TEXT,
+    endDT TEXT,
+    status_code INTEGER,
+    reason TEXT,
+    stream_beginDT TEXT,
+    stream_endDT TEXT,
+    valid TEXT,
+    valid_time_interval TEXT,
+    request_time TEXT,
+    outputURL TEXT,
+    request_url TEXT,
+    user TEXT,
+    completion_time TEXT,
+    download_time TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    lease_owner TEXT,
+    lease_expires REAL,
+    failures INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS requests_status_idx ON requests (status);
+CREATE INDEX IF NOT EXISTS requests_completion_time_idx ON requests (completion_time);
+CREATE INDEX IF NOT EXISTS requests_instrument_idx ON requests (instrument);
+CREATE INDEX IF NOT EXISTS requests_lease_idx ON requests (status, lease_expires);
+'''
+
+# Columns that record how far a request has progressed
+_TIME_COLUMNS = ['completion_time', 'download_time']
+_STATE_COLUMNS = _TIME_COLUMNS + ['status']
+
+# Columns added to the requests table after databases were first created
+_LEASE_COLUMNS = [('lease_owner', 'TEXT'), ('lease_expires', 'REAL'), ('failures', 'INTEGER NOT NULL DEFAULT 0')]
+
+class RequestStore(object):
+    '''SQLite store of asynchronous request state keyed by requestUUID.  Every
+    update is its own transaction, so several scripts can share one database
+    file.  Rows are returned as dictionaries using the request CSV column
+    names.
+
+    Several processes on one host split the work with leases: claim atomically
+    hands each worker requests no other worker holds, for lease_time seconds.  A
+    worker renews the leases of the requests it is still working on and releases
+    them when done; leases of a worker that died expire and the requests are
+    claimed again.  A worker that fails a request releases it with
+    record_failure, and claim can skip requests that failed too many times.  The database uses WAL, which needs shared memory, so it must
+    be on a local disk: workers on other hosts cannot share it over a network
+    filesystem.'''
+
+    def __init__(self, db_file, timeout=60):
+
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, timeout=timeout, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while another process is writing
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._upgrade()
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_request(self, request_meta):
+        '''Insert or update the request described by request_meta (a status
+        dictionary returned by send_async_request or a request CSV row).  An
+        existing request only moves forward (queued -> complete -> downloaded)
+        and keeps its completion and download times if request_meta has none.
+        Returns False if the request has no requestUUID.'''
+
+        if not request_meta.get('requestUUID'):
+            return False
+
+        row = {}
+        for col in STORE_COLUMNS:
+            value = request_meta.get(col)
+            if value == '':
+                value = None
+            row[col] = value
+        if not row['status']:
+            row['status'] = STATUS_QUEUED
+            if row['download_time']:
+                row['status'] = STATUS_DOWNLOADED
+            elif row['completion_time']:
+                row['status'] = STATUS_COMPLETE
+        if row['valid'] is not None:
+            row['valid'] = str(row['valid'])
+        if row['valid_time_interval'] is not None:
+            row['valid_time_interval'] = str(row['valid_time_interval'])
+
+        cols = ', '.join(STORE_COLUMNS)
+        values = ', '.join([':{:s}'.format(col) for col in STORE_COLUMNS])
+        updates = []
+        for col in STORE_COLUMNS:
+            if col == 'requestUUID' or col in _STATE_COLUMNS:
+                continue
+            updates.append('{:s}=excluded.{:s}'.format(col, col))
+        # Re-importing a request never moves it back to an earlier state or
+        # clears its completion/download times
+        updates.extend(['{:s}=COALESCE(excluded.{:s}, requests.{:s})'.format(col, col, col) for col in _TIME_COLUMNS])
+        updates.append('status=CASE WHEN {:s} > {:s} THEN excluded.status ELSE requests.status END'.format(_status_rank('excluded.status'), _status_rank('requests.status')))
+        updates = ', '.join(updates)
+        sql = 'INSERT INTO requests ({:s}) VALUES ({:s}) ON CONFLICT(requestUUID) DO UPDATE SET {:s}'.format(cols, values, updates)
+
+        with self._lock, self._conn:
+            self._conn.execute(sql, row)
+
+        return True
+
+    def mark_complete(self, request_uuid, completion_time=None, worker_id=None):
+        '''Record that request_uuid has completed.  If worker_id is specified the
+        request is only updated if it is not leased to another worker.  Returns
+        True if the request was queued and has been updated.'''
+
+        if not completion_time:
+            completion_time = _utc_now()
+
+        with self._lock, self._conn:
+            cursor = self._conn.execute('UPDATE requests SET completion_time=?, status=?, lease_owner=NULL, lease_expires=NULL WHERE requestUUID=? AND status=? AND (? IS NULL OR lease_owner IS NULL OR lease_owner=?)',
+                (completion_time, STATUS_COMPLETE, request_uuid, STATUS_QUEUED, worker_id, worker_id))
+
+        return cursor.rowcount == 1
+
+    def mark_downloaded(self, request_uuid, download_time=None, worker_id=None):
+        '''Record that the files for request_uuid have been downloaded.  If
+        worker_id is specified the request is only updated if it is not leased
+        to another worker.  Returns True if the request has been updated.'''
+
+        if not download_time:
+            download_time = _utc_now()
+
+        with self._lock, self._conn:
+            cursor = self._conn.execute('UPDATE requests SET download_time=?, status=?, completion_time=COALESCE(completion_time, ?), lease_owner=NULL, lease_expires=NULL WHERE requestUUID=? AND (? IS NULL OR lease_owner IS NULL OR lease_owner=?)',
+                (download_time, STATUS_DOWNLOADED, download_time, request_uuid, worker_id, worker_id))
+
+        return cursor.rowcount == 1
+
+    def get(self, request_uuid):
+        '''Return the request_uuid row or None.'''
+
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM requests WHERE requestUUID=?', (request_uuid,)).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(row)
+
+    def requests(self, status=None, instrument=None, limit=None):
+        '''Return the rows with the specified status and/or instrument, oldest
+        request first.  Both filters use an index, so pending-only queries never
+        scan completed rows.'''
+
+        where = []
+        params = []
+        if status:
+            where.append('status=?')
+            params.append(status)
+        if instrument:
+            where.append('instrument=?')
+            params.append(instrument)
+
+        sql = 'SELECT * FROM requests'
+        if where:
+            sql = '{:s} WHERE {:s}'.format(sql, ' AND '.join(where))
+        sql = '{:s} ORDER BY request_time'.format(sql)
+        if limit:
+            sql = '{:s} LIMIT {:d}'.format(sql, int(limit))
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def pending(self, limit=None):
+        '''Return the requests that have not yet completed.'''
+
+        return self.requests(status=STATUS_QUEUED, limit=limit)
+
+    def completed(self, limit=None):
+        '''Return the requests that have completed but not been downloaded.'''
+
+        return self.requests(status=STATUS_COMPLETE, limit=limit)
+
+    def counts(self):
+        '''Return a dictionary mapping status to number of requests.'''
+
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM requests GROUP BY status').fetchall()
+
+        return {row[0] : row[1] for row in rows}
+
+    def claim(self, worker_id, status=STATUS_QUEUED, lease_time=DEFAULT_LEASE_TIME, limit=DEFAULT_CLAIM_SIZE, instrument=None, max_failures=None):
+        '''Lease up to limit requests with status, oldest request first, to
+        worker_id for lease_time seconds and return them.  Only requests that are
+        not leased, or whose lease has expired, are claimed, so concurrent
+        workers never get the same request.  If max_failures is specified,
+        requests that have failed that many times are not claimed.'''
+
+        now = time.time()
+        expires = now + lease_time
+        where = ['status=?', '(lease_expires IS NULL OR lease_expires < ?)']
+        params = [worker_id, expires, status, now]
+        if max_failures:
+            where.append('failures < ?')
+            params.append(int(max_failures))
+        if instrument:
+            where.append('instrument=?')
+            params.append(instrument)
+        params.append(int(limit) if limit else -1)
+
+        # The claimed rows are selected back by owner and expiry time inside
+        # the same write transaction
+        sql = 'UPDATE requests SET lease_owner=?, lease_expires=? WHERE requestUUID IN (SELECT requestUUID FROM requests WHERE {:s} ORDER BY request_time LIMIT ?)'.format(' AND '.join(where))
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+            rows = self._conn.execute('SELECT * FROM requests WHERE lease_owner=? AND lease_expires=? ORDER BY request_time',
+                (worker_id, expires)).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def renew(self, request_uuids, worker_id, lease_time=DEFAULT_LEASE_TIME):
+        '''Extend the leases worker_id holds on request_uuids by lease_time
+        seconds from now.  Returns the request_uuids still leased to worker_id;
+        the others expired and were claimed by another worker, or were
+        completed.'''
+
+        expires = time.time() + lease_time
+        renewed = []
+        with self._lock, self._conn:
+            for chunk in _chunks(list(request_uuids)):
+                marks = ', '.join(['?'] * len(chunk))
+                self._conn.execute('UPDATE requests SET lease_expires=? WHERE lease_owner=? AND requestUUID IN ({:s})'.format(marks),
+                    [expires, worker_id] + chunk)
+                rows = self._conn.execute('SELECT requestUUID FROM requests WHERE lease_owner=? AND requestUUID IN ({:s})'.format(marks),
+                    [worker_id] + chunk).fetchall()
+                renewed.extend([row[0] for row in rows])
+
+        return renewed
+
+    def release(self, request_uuids, worker_id):
+        '''Give up the leases worker_id holds on request_uuids so other workers
+        can claim them immediately.  Returns the number of leases released.'''
+
+        count = 0
+        with self._lock, self._conn:
+            for chunk in _chunks(list(request_uuids)):
+                cursor = self._conn.execute('UPDATE requests SET lease_owner=NULL, lease_expires=NULL WHERE lease_owner=? AND requestUUID IN ({:s})'.format(', '.join(['?'] * len(chunk))),
+                    [worker_id] + chunk)
+                count += cursor.rowcount
+
+        return count
+
+    def record_failure(self, request_uuid, worker_id=None):
+        '''Count a failed attempt at request_uuid and release its lease so it can
+        be claimed again straight away.  If worker_id is specified the request is
+        only updated if it is not leased to another worker.  Returns the number
+        of times the request has failed, or 0 if it was not updated.'''
+
+        with self._lock, self._conn:
+            cursor = self._conn.execute('UPDATE requests SET failures=failures + 1, lease_owner=NULL, lease_expires=NULL WHERE requestUUID=? AND (? IS NULL OR lease_owner IS NULL OR lease_owner=?)',
+                (request_uuid, worker_id, worker_id))
+            if cursor.rowcount != 1:
+                return 0
+            row = self._conn.execute('SELECT failures FROM requests WHERE requestUUID=?', (request_uuid,)).fetchone()
+
+        return row[0]
+
+    def reclaim_expired(self):
+        '''Clear the expired leases and return how many there were.  claim
+        takes expired leases over by itself; this only tidies the database and
+        reports workers that died holding requests.'''
+
+        with self._lock, self._conn:
+            cursor = self._conn.execute('UPDATE requests SET lease_owner=NULL, lease_expires=NULL WHERE lease_expires < ?', (time.time(),))
+
+        return cursor.rowcount
+
+    def next_lease_expiry(self, status=STATUS_QUEUED, worker_id=None):
+        '''Return the earliest expiry time (time.time() seconds) of the
+        unexpired leases on requests with status, ignoring those held by
+        worker_id, or None if none are leased.  A worker that finds nothing to
+        claim waits until then for the requests of workers that may have
+        died.'''
+
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(lease_expires) FROM requests WHERE status=? AND lease_expires >= ? AND (? IS NULL OR lease_owner != ?)',
+                (status, time.time(), worker_id, worker_id)).fetchone()
+
+        return row[0]
+
+    def leases(self):
+        '''Return a dictionary mapping worker id to number of unexpired leases.'''
+
+        with self._lock:
+            rows = self._conn.execute('SELECT lease_owner, COUNT(*) FROM requests WHERE lease_expires >= ? GROUP BY lease_owner', (time.time(),)).fetchall()
+
+        return {row[0] : row[1] for row in rows}
+
+    def import_csv(self, csv_file):
+        '''Add or update every request in the request CSV (or JSONL, by
+        extension) file csv_file, reading one row at a time.  Returns the number
+        of requests imported.'''
+
+        count = 0
+        reader = open_request_reader(csv_file)
+        for request_meta in reader:
+            if self.add_request(request_meta):
+                count += 1
+            else:
+                sys.stderr.write('Skipping request with no requestUUID: {:s}\n'.format(request_meta.get('request_url') or ''))
+        reader.close()
+
+        return count
+
+    def export_csv(self, fid, status=None, cols=STORE_COLUMNS):
+        '''Write the requests, optionally only those with status, to the open file
+        fid as a request CSV.  Returns the number of requests written.'''
+
+        csv_writer = csv.writer(fid)
+        csv_writer.writerow(cols)
+        rows = self.requests(status=status)
+        for row in rows:
+            csv_writer.writerow([row.get(k) for k in cols])
+
+        return len(rows)
+
+    def _upgrade(self):
+        '''Add the lease and failure columns to a database created before they
+        existed.'''
+
+        cols = [row[1] for row in self._conn.execute('PRAGMA table_info(requests)').fetchall()]
+        if not cols:
+            return
+
+        with self._conn:
+            for (col, col_type) in _LEASE_COLUMNS:
+                if col not in cols:
+                    self._conn.execute('ALTER TABLE requests ADD COLUMN {:s} {:s}'.format(col, col_type))
+
+class LeaseRenewer(object):
+    '''Background thread that renews the leases worker_id holds on store
+    requests every lease_time / 3 seconds, so long-running work is not
+    reclaimed by other workers.  add the requests returned by claim and discard
+    each once it is finished (mark_complete and mark_downloaded clear the
+    lease).  stop releases the leases still held.'''
+
+    def __init__(self, store, worker_id, lease_time=DEFAULT_LEASE_TIME):
+
+        self.store = store
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add(self, request_uuids):
+
+        with self._lock:
+            self._held.update(request_uuids)
+
+    def discard(self, request_uuid):
+
+        with self._lock:
+            self._held.discard(request_uuid)
+
+    def held(self):
+        '''Number of requests whose leases are being renewed.'''
+
+        return len(self._held)
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._run, name='lease-renewer', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self, release=True):
+        '''Stop renewing and, unless release=False, release the leases still
+        held.'''
+
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+        with self._lock:
+            held = list(self._held)
+            self._held.clear()
+        if release and held:
+            self.store.release(held, self.worker_id)
+
+    def _run(self):
+
+        while not self._stop_event.wait(self.lease_time / 3.0):
+
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+
+            try:
+                renewed = set(self.store.renew(held, self.worker_id, self.lease_time))
+            except sqlite3.Error as e:
+                sys.stderr.write('Failed to renew leases: {:s}\n'.format(str(e)))
+                continue
+
+            lost = [request_uuid for request_uuid in held if request_uuid not in renewed]
+            with self._lock:
+                self._held.difference_update(lost)
+            for request_uuid in lost:
+                sys.stderr.write('Lease lost: {:s}\n'.format(request_uuid))
+
+def default_worker_id():
+    '''Return a worker id unique to this process: HOST:PID.'''
+
+    return '{:s}:{:d}'.format(socket.gethostname(), os.getpid())
+
+def add_lease_arguments(arg_parser):
+    '''Add the request lease options to arg_parser.'''
+
+    arg_parser.add_argument('--lease',
+        dest='lease',
+        type=float,
+        help='Claim requests from --db under leases of LEASE seconds, so several workers on this host can share the database.  Leases of workers that die are reclaimed once they expire.  The database must be on a local disk: workers on other hosts cannot share it over a network filesystem')
+    arg_parser.add_argument('--claim',
+        dest='claim_size',
+        type=int,
+        default=DEFAULT_CLAIM_SIZE,
+        help='Maximum number of requests each worker holds leases on (default: {:d})'.format(DEFAULT_CLAIM_SIZE))
+    arg_parser.add_argument('--worker-id',
+        dest='worker_id',
+        default=default_worker_id(),
+        help='Name of this worker in the lease columns (default: HOST:PID)')
+
+def _chunks(values, size=500):
+    '''Split values into lists of at most size, below the SQLite limit on query
+    parameters.'''
+
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def _status_rank(col):
+    '''SQL expression for the position of the status column col in
+    STATUS_ORDER.'''
+
+    return 'CASE {:s} {:s} ELSE -1 END'.format(col, ' '.join(["WHEN '{:s}' THEN {:d}".format(status, i) for (i, status) in enumerate(STATUS_ORDER)]))
+
+def _utc_now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
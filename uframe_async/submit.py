@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from uframe_async import send_async_request
+from uframe_async.session import get_session
+
+async def submit_async_requests(urls, max_concurrency=16, max_per_host=8, timeout=120, time_check=True, session=None):
+    '''Asynchronously send the UFrame async request urls and yield (url, status)
+    tuples in the order the requests complete.  At most max_concurrency requests
+    are in flight at once, and no more than max_per_host to any single host.
+    urls may be any iterable and is consumed lazily.  All requests share session,
+    which defaults to the package-level shared session.'''
+
+    if session is None:
+        session = get_session()
+        
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    total_sem = asyncio.Semaphore(max_concurrency)
+    host_sems = {}
+
+    async def _send(url):
+        host = urlsplit(url).netloc
+        if host not in host_sems:
+            host_sems[host] = asyncio.Semaphore(max_per_host)
+        # Take the host slot first so a busy host does not hold global slots
+        async with host_sems[host]:
+            async with total_sem:
+                status = await loop.run_in_executor(executor,
+                    _send_one,
+                    url,
+                    timeout,
+                    time_check,
+                    session)
+        return url, status
+
+    url_iter = iter(urls)
+    pending = set()
+    # Keep a bounded window of queued tasks so huge url lists are not all
+    # materialized as tasks at once
+    window = max_concurrency * 2
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    url = next(url_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(_send(url)))
+
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        executor.shutdown(wait=False)
+
+def _send_one(url, timeout, time_check, session):
+    '''Executor wrapper around send_async_request that reports, rather than
+    raises, network errors so one bad url does not abort the batch.'''
+
+    try:
+        return send_async_request(url, timeout=timeout, time_check=time_check, session=session)
+    except Exception as e:
+        sys.stderr.write('Request Failed (Reason={:s}): {:s}\n'.format(str(e), url))
+        sys.stderr.flush()
+        return {}
+
+def send_async_requests(urls, callback, max_concurrency=16, max_per_host=8, timeout=120, time_check=True, session=None):
+    '''Blocking wrapper around submit_async_requests.  callback(url, status) is
+    called as each request completes.  Returns the number of requests sent.'''
+
+    async def _run():
+        count = 0
+        async for (url, status) in submit_async_requests(urls,
+            max_concurrency=max_concurrency,
+            max_per_host=max_per_host,
+            timeout=timeout,
+            time_check=time_check,
+            session=session):
+            callback(url, status)
+            count += 1
+        return count
+
+    return asyncio.run(_run())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import re
+from collections import namedtuple
+
+# Columns written for each sent request by send_async_requests_from_urlcsv.py and
+# expected by the check and download scripts
+ASYNC_REQUEST_COLUMNS = ['instrument',
+    'beginDT',
+    'endDT',
+    'status_code',
+    'reason',
+    'stream_beginDT',
+    'stream_endDT',
+    'valid',
+    'valid_time_interval',
+    'request_time',
+    'requestUUID',
+    'outputURL',
+    'request_url']
+
+# Single pass over the url: server/sensor inventory prefix, reference designator
+# components, telemetry, stream and the raw query string
+_ASYNC_URL_REGEXP = re.compile(r'^(?P<prefix>[^?]*?/(?P<subsite>\w{8,})/(?P<node>\w{5,})/(?P<sensor>\d{2}\-\w{9,})/)(?P<telemetry>\w+)/(?P<stream>\w+)/?(?:\?(?P<query>.*))?$')
+_METADATA_PREFIX_REGEXP = re.compile(r'^https?://.*/sensor/inv/\w{8}/\w{5}/\d{2}\-\w{9}/$')
+DT_REGEXP = re.compile(r'^\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,}Z$')
+
+class AsyncRequestUrl(namedtuple('AsyncRequestUrl', ['url',
+    'instrument',
+    'subsite',
+    'node',
+    'sensor',
+    'telemetry',
+    'stream',
+    'beginDT',
+    'endDT',
+    'user',
+    'metadata_prefix',
+    'parameters'])):
+    '''Parsed UFrame asynchronous request url.  parameters is a tuple of
+    (name, value) pairs in the order they appear in the query string.
+    metadata_prefix is the reference designator url under which metadata/times
+    is found, or None if the url is not a sensor inventory url.'''
+
+    __slots__ = ()
+
+    def parameter(self, name, default=None):
+        '''Return the value of query parameter name, or default if not present.'''
+
+        for (p, v) in self.parameters:
+            if p == name:
+                return v
+
+        return default
+
+def parse_async_url(url):
+    '''Parse a UFrame asynchronous request url into an AsyncRequestUrl record.
+    Returns None if the url does not contain a subsite/node/sensor/telemetry/stream
+    path.  beginDT, endDT and user are None if not specified.  Malformed query
+    parameters (no '=') are kept with a value of None.'''
+
+    match = _ASYNC_URL_REGEXP.match(url)
+    if not match:
+        return None
+
+    parameters = []
+    beginDT = None
+    endDT = None
+    user = None
+    query = match.group('query')
+    if query:
+        for parameter in query.split('&'):
+            (p, sep, v) = parameter.partition('=')
+            if not sep:
+                v = None
+            parameters.append((p, v))
+
+            if p == 'beginDT':
+                beginDT = v
+            elif p == 'endDT':
+                endDT = v
+            elif p == 'user':
+                user = v
+
+    subsite = match.group('subsite')
+    node = match.group('node')
+    sensor = match.group('sensor')
+
+    metadata_prefix = match.group('prefix')
+    if not _METADATA_PREFIX_REGEXP.match(metadata_prefix):
+        metadata_prefix = None
+
+    return AsyncRequestUrl(url,
+        '-'.join([subsite, node, sensor]),
+        subsite,
+        node,
+        sensor,
+        match.group('telemetry'),
+        match.group('stream'),
+        beginDT,
+        endDT,
+        user,
+        metadata_prefix,
+        tuple(parameters))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import datetime
+import numpy as np
+from dateutil import parser
+from uframe_async import check_async_request_parameters
+from uframe_async.metadata import get_metadata_cache
+from uframe_async.urls import AsyncRequestUrl, parse_async_url
+
+# Columns written for each validated request by validate_async_requests.py
+VALIDATION_COLUMNS = ['request_url',
+    'instrument',
+    'beginDT',
+    'endDT',
+    'valid',
+    'valid_time_interval',
+    'stream_beginDT',
+    'stream_endDT',
+    'reason']
+
+# Verdicts of the vectorized checks, in the order they are applied
+_OK = 0
+_BAD_ORDER = 1
+_NO_PREFIX = 2
+_NO_METADATA = 3
+_NO_STREAM = 4
+_TOO_EARLY = 5
+_TOO_LATE = 6
+
+def validate_async_requests(urls, time_check=True, session=None, metadata_cache=None, timeout=120):
+    '''Validate a whole list of urls (url strings or AsyncRequestUrls) at once,
+    applying the same checks as validate_async_request.  The beginDT and endDT of
+    every request are parsed into datetime64 arrays in one pass and compared to
+    the stream time bounds, fetched once per reference designator through
+    metadata_cache (default: the package-level cache), as array operations.
+    Returns a validation dictionary for each url, in order, with the
+    VALIDATION_COLUMNS keys.  Unlike validate_async_request nothing is printed;
+    the reason is set for every request that fails a check.'''
+
+    results = []
+    # Requests that passed the parameter checks and their index in results
+    requests = []
+    rows = []
+    for url in urls:
+
+        request = url
+        if not isinstance(request, AsyncRequestUrl):
+            request = parse_async_url(url)
+        else:
+            url = request.url
+
+        valid = {'request_url' : url,
+            'instrument' : None,
+            'beginDT' : None,
+            'endDT' : None,
+            'valid' : False,
+            'valid_time_interval' : None,
+            'stream_beginDT' : None,
+            'stream_endDT' : None,
+            'reason' : ''}
+        results.append(valid)
+
+        if not request or not request.parameters:
+            valid['reason'] = 'Request contains no parameters: {:s}\n'.format(url)
+            continue
+
+        valid['instrument'] = request.instrument
+        valid['beginDT'] = request.beginDT
+        valid['endDT'] = request.endDT
+
+        reason = check_async_request_parameters(request, url)
+        if reason:
+            valid['reason'] = reason
+            continue
+
+        requests.append(request)
+        rows.append(len(results) - 1)
+
+    if not requests:
+        return results
+
+    dt0 = parse_datetimes([request.beginDT for request in requests])
+    dt1 = parse_datetimes([request.endDT for request in requests])
+
+    # One metadata lookup per reference designator.  Each (prefix, stream) pair
+    # gets an index into the stream bounds arrays; index 0 means no bounds
+    if metadata_cache is None:
+        metadata_cache = get_metadata_cache()
+    metadata_failed = set()
+    stream_index = {}
+    stream_bounds = [(None, None)]
+    for prefix in set([request.metadata_prefix for request in requests if request.metadata_prefix]):
+        metadata = metadata_cache.get(prefix, session=session, timeout=timeout)
+        if metadata is None:
+            metadata_failed.add(prefix)
+            continue
+        for m in metadata:
+            stream_index[(prefix, m['stream'])] = len(stream_bounds)
+            stream_bounds.append((m['beginTime'], m['endTime']))
+
+    has_prefix = np.array([bool(request.metadata_prefix) for request in requests])
+    has_metadata = np.array([request.metadata_prefix not in metadata_failed for request in requests])
+    bounds_index = np.array([stream_index.get((request.metadata_prefix, request.stream), 0) for request in requests])
+    stream_dt0 = parse_datetimes([b[0] for b in stream_bounds])[bounds_index]
+    stream_dt1 = parse_datetimes([b[1] for b in stream_bounds])[bounds_index]
+
+    conditions = [dt0 > dt1,
+        ~has_prefix,
+        ~has_metadata,
+        bounds_index == 0]
+    verdicts = [_BAD_ORDER, _NO_PREFIX, _NO_METADATA, _NO_STREAM]
+    if time_check:
+        conditions.extend([dt0 < stream_dt0, dt1 > stream_dt1])
+        verdicts.extend([_TOO_EARLY, _TOO_LATE])
+    verdict = np.select(conditions, verdicts, default=_OK)
+
+    for (i, request, v, b) in zip(rows, requests, verdict.tolist(), bounds_index.tolist()):
+
+        valid = results[i]
+        url = valid['request_url']
+        (stream_beginDT, stream_endDT) = stream_bounds[b]
+
+        if v == _BAD_ORDER:
+            valid['reason'] = 'Invalid time bounds (beginDT={:s} > endDT={:s}): {:s}\n'.format(request.beginDT, request.endDT, url)
+            continue
+        if v == _NO_PREFIX:
+            valid['reason'] = 'Time check ERROR: invalid url {:s}\n'.format(url)
+            continue
+        if v == _NO_METADATA:
+            valid['reason'] = 'Failed to fetch metadata: {:s}metadata/times\n'.format(request.metadata_prefix)
+            continue
+
+        # The request is valid from here on, even if the time check fails
+        valid['valid'] = True
+        if v == _NO_STREAM:
+            valid['reason'] = 'Invalid stream: {:s}\n'.format(request.stream)
+            continue
+
+        valid['stream_beginDT'] = stream_beginDT
+        valid['stream_endDT'] = stream_endDT
+        if not time_check:
+            continue
+
+        valid['valid_time_interval'] = v == _OK
+        if v == _TOO_EARLY:
+            valid['reason'] = 'Time check ERROR: Specified request beginDT is earlier than metadata beginDT ({:s} < {:s})\n'.format(request.beginDT, stream_beginDT)
+        elif v == _TOO_LATE:
+            valid['reason'] = 'Time check ERROR: Specified request endDT is later than metadata endDT ({:s} > {:s})\n'.format(request.endDT, stream_endDT)
+
+    return results
+
+def parse_datetimes(values):
+    '''Parse a sequence of UTC timestamp strings into a datetime64[us] array.
+    Values in the UFrame format (ie: 2016-01-01T00:00:00.000Z) are parsed by
+    NumPy in a single call.  If any value is not, each value is parsed on its
+    own, falling back to dateutil.  Missing or unparseable values are NaT.'''
+
+    stripped = [_strip_z(v) for v in values]
+    try:
+        return np.array(stripped, dtype='datetime64[us]')
+    except ValueError:
+        return np.array([_parse_datetime(v) for v in values], dtype='datetime64[us]')
+
+def _strip_z(value):
+
+    if not value:
+        return 'NaT'
+    if value.endswith('Z'):
+        return value[:-1]
+
+    return value
+
+def _parse_datetime(value):
+
+    try:
+        return np.datetime64(_strip_z(value), 'us')
+    except ValueError:
+        pass
+
+    try:
+        dt = parser.parse(value)
+    except (ValueError, OverflowError):
+        return np.datetime64('NaT', 'us')
+
+    # datetime64 has no time zone, so aware values are converted to naive UTC
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return np.datetime64(dt, 'us')
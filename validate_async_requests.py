@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import csv
+import argparse
+import sys
+from uframe_async.metadata import StreamMetadataCache, set_metadata_cache
+from uframe_async.validate import validate_async_requests, VALIDATION_COLUMNS
+
+def main(args):
+    '''Validate the asynchronous UFrame request urls contained in a file without
+    sending them: check the request parameters and that each beginDT and endDT
+    fall within the stream time bounds from the metadata.  The whole file is
+    validated as one batch.  Prints a CSV row with the verdict and reason for
+    each request to STDOUT.'''
+
+    # Persist stream metadata between runs if a cache file was specified
+    if args.metadata_cache:
+        set_metadata_cache(StreamMetadataCache(cache_file=args.metadata_cache))
+
+    fid = open(args.request_csv, 'r')
+    urls = [url.strip() for url in fid if url.strip() and not url.startswith('#')]
+    fid.close()
+
+    results = validate_async_requests(urls, time_check=not args.no_time_check)
+
+    csv_writer = csv.writer(sys.stdout)
+    csv_writer.writerow(VALIDATION_COLUMNS)
+    num_invalid = 0
+    for valid in results:
+        ok = valid['valid'] and valid['valid_time_interval'] is not False
+        if not ok:
+            num_invalid += 1
+        elif args.invalid:
+            continue
+        csv_writer.writerow([str(valid[k]).strip() if valid[k] is not None else '' for k in VALIDATION_COLUMNS])
+
+    sys.stderr.write('Validated {:d} requests: {:d} valid, {:d} invalid\n'.format(len(results), len(results) - num_invalid, num_invalid))
+
+    if num_invalid:
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument('request_csv',
+        help='Filename containing asynchronous UFrame request urls')
+    arg_parser.add_argument('-i', '--invalid',
+        dest='invalid',
+        action='store_true',
+        help='Only print the invalid requests')
+    arg_parser.add_argument('--no-time-check',
+        dest='no_time_check',
+        action='store_true',
+        help='Do not check the request time windows against the stream time bounds')
+    arg_parser.add_argument('--metadata-cache',
+        dest='metadata_cache',
+        help='JSON file used to cache stream metadata/times lookups between runs')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))